@@ -8,8 +8,16 @@ from nipype import config
 from fmridenoise.utils import temps
 from fmridenoise.utils.utils import copy_as_dummy_dataset, create_dataset_description_json_content
 from fmridenoise.workflows.base import init_fmridenoise_wf
+from fmridenoise.interfaces.denoising import DENOISE_MEM_MB_DEFAULT
+from fmridenoise.utils.nifti import COMPRESS_LEVEL_DEFAULT
+from fmridenoise.utils.staging import STAGING_CACHE_GB_DEFAULT
+from fmridenoise.interfaces.smoothing import SMOOTHING_CACHE_GB_DEFAULT
+from fmridenoise.interfaces.connectivity import CONNECTIVITY_KINDS
 from fmridenoise.utils.profiling import profiler_callback
+from fmridenoise.workflows.update import update_group_statistics
+from fmridenoise.workflows.rebuild import rebuild_connectivity, rerun_quality_measures
 from fmridenoise.utils.json_validator import is_valid
+from fmridenoise.parcellation import DEFAULT_ATLAS
 from fmridenoise.pipelines import (get_pipelines_paths,
                                    get_pipelines_names,
                                    get_pipeline_path,
@@ -21,6 +29,14 @@ LOW_PASS_DEFAULT = 0.08
 bids.config.set_option('extension_initial_dot', True)
 
 
+def positive_int(value: str) -> int:
+    """Argparse type of counts (of threads or processes) which must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 def get_parser() -> argparse.ArgumentParser:
     """
     Creates parser for main script.
@@ -64,6 +80,29 @@ def get_parser() -> argparse.ArgumentParser:
                                          default='fmriprep',
                                          help="Name (or list) of derivatives for which fmridenoise should be run.\
                                                By default workflow looks for fmriprep dataset.")
+    quality_measures_parser.add_argument("--atlases",
+                                         nargs='+',
+                                         default=[DEFAULT_ATLAS],
+                                         help=f"Atlases used for connectivity estimation, '{DEFAULT_ATLAS}' (shipped "
+                                              "Schaefer2018 200 parcels atlas) or paths to parcellation files "
+                                              "(with atlas entity in name) in space of images. Time series of all "
+                                              "atlases are extracted from single denoising of each image and quality "
+                                              "measures are calculated for each atlas. "
+                                              f"Default '{DEFAULT_ATLAS}'.")
+    quality_measures_parser.add_argument("--connectivity-kind",
+                                         choices=CONNECTIVITY_KINDS,
+                                         default='correlation',
+                                         help="Kind of connectivity matrices, all kinds use Ledoit-Wolf covariance "
+                                              "estimates of subjects. Tangent space connectivity is calculated at "
+                                              "geometric mean of covariances of all subjects of each pipeline. "
+                                              "Default 'correlation'.")
+    quality_measures_parser.add_argument("--skip-excluded",
+                                         action='store_true',
+                                         default=False,
+                                         help="Do not denoise images and estimate connectivity of subjects excluded "
+                                              "by motion criteria of pipeline. Quality measures are then calculated "
+                                              "only for subjects without high motion (summaries and plots for all "
+                                              "subjects are not created).")
     quality_measures_parser.add_argument("--high-pass",
                                          type=float,
                                          default=HIGH_PASS_DEFAULT,
@@ -72,6 +111,95 @@ def get_parser() -> argparse.ArgumentParser:
                                          type=float,
                                          default=LOW_PASS_DEFAULT,
                                          help=f"Low pass filter value, default {LOW_PASS_DEFAULT}")
+    quality_measures_parser.add_argument("--denoise-space",
+                                         type=str,
+                                         choices=['voxels', 'parcels'],
+                                         default='voxels',
+                                         help="Space in which confounds are regressed. 'voxels' denoises whole image, "
+                                              "'parcels' denoises parcel averaged time series only (much faster, "
+                                              "no denoised images can be saved, voxels are not standardized so "
+                                              "connectivity differs from 'voxels' denoising). Default 'voxels'.")
+    quality_measures_parser.add_argument("--denoise-mem-mb",
+                                         type=float,
+                                         default=DENOISE_MEM_MB_DEFAULT,
+                                         help="Memory budget (in megabytes) for voxelwise denoising (or parcels "
+                                              "averaging in parcels denoise space) of single image. Images are "
+                                              "read in blocks fitting the budget, memory declared "
+                                              "for denoising nodes is adjusted accordingly. "
+                                              f"Default {DENOISE_MEM_MB_DEFAULT}.")
+    quality_measures_parser.add_argument("--save-denoised-bold",
+                                         help="Save denoised fMRI files (voxels denoise space only). By default "
+                                              "denoised images are only averaged within parcels for connectivity "
+                                              "estimation and never written to disk.",
+                                         action="store_true",
+                                         default=False)
+    quality_measures_parser.add_argument("--compress-level",
+                                         type=int,
+                                         choices=range(10),
+                                         default=COMPRESS_LEVEL_DEFAULT,
+                                         help="Gzip compression level of saved denoised fMRI files, 0 saves "
+                                              f"uncompressed .nii files. Default {COMPRESS_LEVEL_DEFAULT}.")
+    quality_measures_parser.add_argument("--intermediate-compress-level",
+                                         type=int,
+                                         choices=range(10),
+                                         default=COMPRESS_LEVEL_DEFAULT,
+                                         help="Gzip compression level of smoothed and denoised fMRI files in "
+                                              "working directory, 0 (fastest, but uses most disk space) keeps them "
+                                              f"uncompressed. Default {COMPRESS_LEVEL_DEFAULT}.")
+    quality_measures_parser.add_argument("--compress-threads",
+                                         type=positive_int,
+                                         default=1,
+                                         help="Number of threads compressing each fMRI file. Default 1.")
+    quality_measures_parser.add_argument("--staging-cache",
+                                         type=str,
+                                         help="Directory for uncompressed copies of input fMRI files. Each file is "
+                                              "decompressed once (also across runs) and memory mapped by all steps "
+                                              "reading it. Disabled by default.")
+    quality_measures_parser.add_argument("--staging-cache-gb",
+                                         type=float,
+                                         default=STAGING_CACHE_GB_DEFAULT,
+                                         help="Maximal size (in gigabytes) of staging cache, least recently used "
+                                              f"files are removed above it. Default {STAGING_CACHE_GB_DEFAULT}.")
+    quality_measures_parser.add_argument("--smoothing-cache",
+                                         type=str,
+                                         help="Directory for persistent cache of smoothed fMRI files. Images are "
+                                              "smoothed once and reused by all further runs (with any pipelines "
+                                              "or working directory). Disabled by default.")
+    quality_measures_parser.add_argument("--smoothing-cache-gb",
+                                         type=float,
+                                         default=SMOOTHING_CACHE_GB_DEFAULT,
+                                         help="Maximal size (in gigabytes) of smoothing cache, least recently used "
+                                              f"files are removed above it. Default {SMOOTHING_CACHE_GB_DEFAULT}.")
+    quality_measures_parser.add_argument("--smoothing-threads",
+                                         type=positive_int,
+                                         default=1,
+                                         help="Number of threads smoothing each fMRI file. Default 1.")
+    quality_measures_parser.add_argument("--qcfc-permutations",
+                                         type=int,
+                                         default=0,
+                                         help="Number of permutations of mean FD across subjects used to control "
+                                              "family-wise error of FC-FD correlations (max-statistic method). "
+                                              "Adds percent of significant corrected correlations to quality "
+                                              "measures. Default 0 (disabled), 1000 or more is recommended.")
+    quality_measures_parser.add_argument("--qcfc-procs",
+                                         type=positive_int,
+                                         default=1,
+                                         help="Number of processes calculating QC-FC permutations (and threads "
+                                              "calculating bootstrap samples). Default 1.")
+    quality_measures_parser.add_argument("--bootstrap-samples",
+                                         type=int,
+                                         default=0,
+                                         help="Number of bootstrap samples (subjects resampled with replacement) "
+                                              "used to estimate 95%% confidence intervals of QC-FC quality "
+                                              "measures, shown as error bars in plots. Default 0 (disabled), "
+                                              "1000 or more is recommended.")
+    quality_measures_parser.add_argument("--precision",
+                                         type=str,
+                                         choices=['float64', 'float32'],
+                                         default='float64',
+                                         help="Floating point precision of smoothing, denoising and connectivity "
+                                              "estimation. 'float32' halves memory usage and size of denoised "
+                                              "images. Default 'float64'.")
     quality_measures_parser.add_argument("-w", "--workdir",
                                          type=str,
                                          default="/tmp/fmridenoise",
@@ -94,6 +222,82 @@ def get_parser() -> argparse.ArgumentParser:
                                          help="Perform everything except actually running workflow",
                                          action="store_true",
                                          default=False)
+    # group statistics update parser
+    update_parser = subparsers.add_parser(name='update',
+                                          help='merges subjects from fmridenoise outputs into persistent group '
+                                               'statistics, so quality measures of growing cohort are updated '
+                                               'using connectivity matrices of new subjects only')
+    update_parser.set_defaults(which='update')
+    update_parser.add_argument("state_dir",
+                               help="Directory with group statistics (created if missing). Quality measures of all "
+                                    "merged subjects are saved there.")
+    update_parser.add_argument("fmridenoise_dirs",
+                               nargs='+',
+                               help="fmridenoise derivatives directories (outputs of fmridenoise compare) with "
+                                    "subjects to merge. Subjects already merged are skipped.")
+    update_parser.add_argument("--atlas",
+                               default=DEFAULT_ATLAS,
+                               help="Atlas of connectivity matrices to merge, one of atlases given to fmridenoise "
+                                    f"compare. Group statistics of each atlas are kept separately. Default "
+                                    f"'{DEFAULT_ATLAS}'.")
+    update_parser.add_argument("--distance-matrix",
+                               help="Distance matrix of atlas parcels (.npy) used by distance dependence quality "
+                                    "measure. Default is distance matrix of atlas (computed and saved in state_dir "
+                                    "for atlases other than default).")
+    # connectivity rebuild parser
+    connectivity_parser = subparsers.add_parser(name='connectivity',
+                                                help='recalculates subjects and group connectivity matrices from '
+                                                     'parcels time series saved by fmridenoise compare, without '
+                                                     'denoising. Quality measures are not recalculated.')
+    connectivity_parser.set_defaults(which='connectivity')
+    connectivity_parser.add_argument("fmridenoise_dir",
+                                     help="fmridenoise derivatives directory (output of fmridenoise compare), "
+                                          "connectivity matrices are replaced in place")
+    connectivity_parser.add_argument("--atlases",
+                                     nargs='+',
+                                     default=[DEFAULT_ATLAS],
+                                     help="Atlases of saved time series, the same as given to fmridenoise "
+                                          f"compare. Default '{DEFAULT_ATLAS}'.")
+    connectivity_parser.add_argument("--connectivity-kind",
+                                     choices=CONNECTIVITY_KINDS,
+                                     default='correlation',
+                                     help="Kind of connectivity matrices. Default 'correlation'.")
+    # quality measures rerun parser
+    qc_parser = subparsers.add_parser(name='qc',
+                                      help='reruns group stages of fmridenoise compare (group confounds, group '
+                                           'connectivity, quality measures and report) from subjects confounds '
+                                           'summaries and connectivity matrices saved by fmridenoise compare, '
+                                           'without denoising')
+    qc_parser.set_defaults(which='qc')
+    qc_parser.add_argument("fmridenoise_dir",
+                           help="fmridenoise derivatives directory (output of fmridenoise compare), group outputs "
+                                "and report are replaced in place")
+    qc_parser.add_argument("-p", "--pipelines",
+                           nargs='+',
+                           help='Pipelines of derivatives, can be both paths to json files with pipeline or name of '
+                                'pipelines from package. Subjects are included by motion criteria of these '
+                                'pipelines (e.g. changed fd_th), numbers of outlier scans are not recounted. '
+                                'Default all pipelines from package.',
+                           default="all")
+    qc_parser.add_argument("--atlases",
+                           nargs='+',
+                           default=[DEFAULT_ATLAS],
+                           help="Atlases of saved connectivity matrices, the same as given to fmridenoise compare. "
+                                f"Default '{DEFAULT_ATLAS}'.")
+    qc_parser.add_argument("--qcfc-permutations",
+                           type=int,
+                           default=0,
+                           help="Number of permutations of mean FD across subjects (see fmridenoise compare). "
+                                "Default 0 (disabled).")
+    qc_parser.add_argument("--qcfc-procs",
+                           type=positive_int,
+                           default=1,
+                           help="Number of processes calculating QC-FC permutations (and threads calculating "
+                                "bootstrap samples). Default 1.")
+    qc_parser.add_argument("--bootstrap-samples",
+                           type=int,
+                           default=0,
+                           help="Number of bootstrap samples (see fmridenoise compare). Default 0 (disabled).")
     # tools parser
     dummy_dataset_parser = subparsers.add_parser(name='dummy',
                                                  help='creates dummy copy of existing dataset. Dummy dataset '
@@ -185,6 +389,25 @@ def compare(args: argparse.Namespace) -> None:
                                    pipelines_paths=pipelines,
                                    high_pass=args.high_pass,
                                    low_pass=args.low_pass,
+                                   denoise_space=args.denoise_space,
+                                   denoise_mem_mb=args.denoise_mem_mb,
+                                   precision=args.precision,
+                                   save_denoised_bold=args.save_denoised_bold,
+                                   compress_level=args.compress_level,
+                                   intermediate_compress_level=args.intermediate_compress_level,
+                                   compress_threads=args.compress_threads,
+                                   staging_cache=abspath(args.staging_cache) if args.staging_cache else None,
+                                   staging_cache_gb=args.staging_cache_gb,
+                                   smoothing_cache=abspath(args.smoothing_cache) if args.smoothing_cache else None,
+                                   smoothing_cache_gb=args.smoothing_cache_gb,
+                                   smoothing_threads=args.smoothing_threads,
+                                   qcfc_permutations=args.qcfc_permutations,
+                                   qcfc_procs=args.qcfc_procs,
+                                   bootstrap_samples=args.bootstrap_samples,
+                                   atlases=[atlas if atlas == DEFAULT_ATLAS else abspath(atlas)
+                                            for atlas in args.atlases],
+                                   connectivity_kind=args.connectivity_kind,
+                                   skip_excluded=args.skip_excluded,
                                    base_dir=args.workdir)
     # creating graph from workflow
     if args.graph is not None:
@@ -211,6 +434,36 @@ def compare(args: argparse.Namespace) -> None:
     return 0
 
 
+def update(args):
+    logging.basicConfig(level=logging.INFO)
+    for path in update_group_statistics(args.state_dir, args.fmridenoise_dirs,
+                                        atlas=args.atlas if args.atlas == DEFAULT_ATLAS else abspath(args.atlas),
+                                        distance_matrix_file=args.distance_matrix):
+        print(path)
+
+
+def connectivity(args):
+    logging.basicConfig(level=logging.INFO)
+    for path in rebuild_connectivity(args.fmridenoise_dir,
+                                     atlases=[atlas if atlas == DEFAULT_ATLAS else abspath(atlas)
+                                              for atlas in args.atlases],
+                                     kind=args.connectivity_kind):
+        print(path)
+
+
+def qc(args):
+    logging.basicConfig(level=logging.INFO)
+    for path in rerun_quality_measures(args.fmridenoise_dir,
+                                       pipelines=[load_pipeline_from_json(path)
+                                                  for path in parse_pipelines(args.pipelines)],
+                                       atlases=[atlas if atlas == DEFAULT_ATLAS else abspath(atlas)
+                                                for atlas in args.atlases],
+                                       n_permutations=args.qcfc_permutations,
+                                       n_bootstrap=args.bootstrap_samples,
+                                       n_procs=args.qcfc_procs):
+        print(path)
+
+
 def dummy(args):
     copy_as_dummy_dataset(source_bids_dir=args.bids_dir,
                           new_path=args.output_directory,
@@ -228,6 +481,12 @@ def main() -> int:
         return 1
     if args.which == 'compare':
         compare(args)
+    elif args.which == 'update':
+        update(args)
+    elif args.which == 'connectivity':
+        connectivity(args)
+    elif args.which == 'qc':
+        qc(args)
     elif args.which == 'dummy':
         dummy(args)
     else:
@@ -7,7 +7,7 @@ from nipype.utils.filemanip import copyfile
 from nipype.interfaces.base import (BaseInterfaceInputSpec, SimpleInterface,
     traits, TraitedSpec,
     Directory, Str, ImageFile,
-    OutputMultiPath)
+    OutputMultiPath, isdefined)
 from traits.trait_base import Undefined
 from traits.trait_types import Dict, List, Either, File, Int
 from fmridenoise.pipelines import load_pipeline_from_json, is_IcaAROMA
@@ -16,8 +16,12 @@ import os
 from itertools import product
 import typing as t
 from fmridenoise.utils.entities import build_path, parse_file_entities_with_pipelines
+from fmridenoise.utils.nifti import copy_nifti
+from fmridenoise.utils.staging import get_staging_cache, STAGING_CACHE_GB_DEFAULT
 import logging
+from nipype import logging as nipype_logging
 logger = logging.getLogger(__name__)
+iflogger = nipype_logging.getLogger('nipype.interface')
 
 
 def _lists_to_entities(subjects: list, tasks: list, sessions: t.List[str], runs: t.List[str]):
@@ -133,6 +137,45 @@ class BIDSGrab(SimpleInterface):
         return result[0] if len(result) == 1 else ''
 
 
+class BIDSStageInputSpec(BaseInterfaceInputSpec):
+    fmri_prep = ImageFile(desc="Preprocessed fMRI file")
+    fmri_prep_aroma = ImageFile(desc="ICA-Aroma preprocessed fMRI file")
+    cache_dir = Directory(
+        exists=True,
+        mandatory=True,
+        desc="Staging cache directory")
+    cache_gb = traits.Float(
+        STAGING_CACHE_GB_DEFAULT,
+        usedefault=True,
+        desc="Maximal total size (in gigabytes) of staged files")
+
+
+class BIDSStageOutputSpec(TraitedSpec):
+    fmri_prep = ImageFile()
+    fmri_prep_aroma = ImageFile()
+
+
+class BIDSStage(SimpleInterface):
+    """
+    Stages fMRI files selected by BIDSGrab in uncompressed staging cache (see
+    fmridenoise.utils.staging.StagingCache), so they are decompressed once
+    and memory mapped by all further readers. Missing files (empty paths)
+    are passed unchanged. Cache hit and miss statistics (accumulated within
+    process) are logged after each staging.
+    """
+    input_spec = BIDSStageInputSpec
+    output_spec = BIDSStageOutputSpec
+
+    def _run_interface(self, runtime):
+        cache = get_staging_cache(self.inputs.cache_dir, self.inputs.cache_gb * 2 ** 30)
+        for field in ('fmri_prep', 'fmri_prep_aroma'):
+            path = getattr(self.inputs, field)
+            if isdefined(path):
+                self._results[field] = cache.stage(path) if path else path
+        iflogger.info(f"Staging cache {self.inputs.cache_dir}: {cache.stats()}")
+        return runtime
+
+
 class BIDSValidateInputSpec(BaseInterfaceInputSpec):
 
     # Root directory only required argument
@@ -490,6 +533,15 @@ class BIDSDataSinkInputSpec(BaseInterfaceInputSpec):
     )
     in_file = File(
         desc="File from tmp to save in BIDS directory")
+    compress_level = traits.Range(
+        low=0, high=9,
+        mandatory=False,
+        desc="Gzip compression level of saved NIfTI files, 0 saves uncompressed .nii files. "
+             "If undefined NIfTI files are copied as they are")
+    compress_threads = Int(
+        1,
+        usedefault=True,
+        desc="Number of threads compressing NIfTI files")
 
 
 class BIDSDataSinkOutputSpec(TraitedSpec):
@@ -498,13 +550,15 @@ class BIDSDataSinkOutputSpec(TraitedSpec):
 
 class BIDSDataSink(IOBase):
     """
-    Copies files created by workflow to bids-like folder.
+    Copies files created by workflow to bids-like folder. If compress_level
+    is defined, NIfTI files are (de)compressed to match it, so intermediate
+    images can be kept uncompressed and compressed only when saved.
     """
     input_spec = BIDSDataSinkInputSpec
     output_spec = BIDSDataSinkOutputSpec
     output_dir_pattern = "{bids_dir}/derivatives/{derivative}/[ses-{session}/][sub-{subject}/]"
     output_path_pattern = output_dir_pattern + "[sub-{subject}_][ses-{session}_][task-{task}_][run-{run}_]" \
-                          "[pipeline-{pipeline}_][desc-{desc}_]{suffix}.{extension}"
+                          "[atlas-{atlas}_][pipeline-{pipeline}_][desc-{desc}_]{suffix}.{extension}"
 
     _always_run = True
 
@@ -513,8 +567,14 @@ class BIDSDataSink(IOBase):
             return {'out_file': Undefined}
         entities = parse_file_entities_with_pipelines(self.inputs.in_file)
         entities.update(self.inputs.base_entities)
+        nifti = entities.get('extension') in ('.nii', '.nii.gz') and isdefined(self.inputs.compress_level)
+        if nifti:
+            entities['extension'] = '.nii.gz' if self.inputs.compress_level > 0 else '.nii'
         os.makedirs(build_path(entities, self.output_dir_pattern), exist_ok=True)
         path = build_path(entities, self.output_path_pattern)
         assert not os.path.exists(path), f"File already exists, overwriting protection: {path}"
-        copyfile(self.inputs.in_file, path, copy=True)
+        if nifti:
+            copy_nifti(self.inputs.in_file, path, self.inputs.compress_level, self.inputs.compress_threads)
+        else:
+            copyfile(self.inputs.in_file, path, copy=True)
         return {'out_file': path}
@@ -4,7 +4,7 @@ from os.path import join
 import pandas as pd
 import numpy as np
 from bids.layout.writing import build_path
-from traits.trait_types import Dict, Str, List, Directory
+from traits.trait_types import Dict, Str, List, Directory, Bool
 from nipype.interfaces.base import (BaseInterfaceInputSpec, File, TraitedSpec, 
     SimpleInterface)
 import typing as t
@@ -12,6 +12,23 @@ from fmridenoise.utils.entities import parse_file_entities_with_pipelines, build
     assert_all_entities_equal
 
 
+def motion_inclusion(pipeline: dict, mean_fd: float, max_fd: float, spikes_fraction: float) -> bool:
+    """
+    Decides if subject should be included in connectivity analysis by motion
+    criteria of pipeline (see Confounds 'include' summary field).
+
+    Args:
+        pipeline: denoising pipeline, subjects are always included by
+            pipelines without spikes strategy
+        mean_fd: mean framewise displacement
+        max_fd: highest framewise displacement
+        spikes_fraction: fraction of outlier scans
+    """
+    if not pipeline['spikes']:
+        return True
+    return not (mean_fd > pipeline['spikes']['fd_th'] or max_fd > 5 or spikes_fraction > 0.2)
+
+
 class ConfoundsInputSpec(BaseInterfaceInputSpec):
     pipeline = Dict(
         mandatory=True,
@@ -37,6 +54,11 @@ class ConfoundsOutputSpec(TraitedSpec):
     conf_summary = File(
         exists=True,
         desc="Confounds summary JSON")
+    sample_mask = File(
+        exists=True,
+        desc="Sample mask table (1 for retained and 0 for censored volumes)")
+    include = Bool(
+        desc="Subject is included in connectivity analysis (not excluded by motion criteria)")
 
 
 class Confounds(SimpleInterface):
@@ -52,6 +74,13 @@ class Confounds(SimpleInterface):
     identical base but different extensions, since they are describing the same 
     piece of data. They are created by replacing regressors suffix from original
     filenames with expression pipeline-<pipeline_name>.
+
+    Outlier scans are handled according to spikes mode of the pipeline. In
+    'regress' mode (default) one spike regressor is created for each outlier
+    scan. In 'censor' mode outlier scans are not modelled but marked in sample
+    mask table, so they are removed from data before denoising. Sample mask
+    table is created for every pipeline (retaining all volumes if nothing is
+    censored).
     
     Summary contains fields:
         'mean_fd': 
@@ -71,12 +100,16 @@ class Confounds(SimpleInterface):
             Number of outlier scans (only if spikes strategy is specified).
         'perc_spikes':
             Percentage of outlier scans (only if spikes strategy is specified).
+        'n_censored':
+            Number of censored scans (only if spikes mode is 'censor').
     """
     input_spec = ConfoundsInputSpec
     output_spec = ConfoundsOutputSpec
     conf_prep_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}_desc-{desc}.tsv"
     conf_summary_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}" \
                            "_desc-{desc}_summary.json"
+    sample_mask_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}" \
+                          "_desc-{desc}_sampleMask.tsv"
 
     def _retain(self, regressor_names: t.List[str]):
         """
@@ -133,18 +166,28 @@ class Confounds(SimpleInterface):
 
         self._retain(acompcor_regressors)
 
-    def _create_spike_regressors(self):
-        if not self.inputs.pipeline['spikes']:
-            return
+    @property
+    def _censoring(self) -> bool:
+        spikes = self.inputs.pipeline['spikes']
+        return bool(spikes) and spikes.get('mode', 'regress') == 'censor'
 
+    def _find_outliers(self) -> t.List[int]:
         fd_th = self.inputs.pipeline['spikes']['fd_th']
         dvars_th = self.inputs.pipeline['spikes']['dvars_th']
 
         outliers = (self.conf_raw['framewise_displacement'] > fd_th) \
                  | (self.conf_raw['std_dvars'] > dvars_th) 
-        outliers = list(outliers[outliers].index)
+        return list(outliers[outliers].index)
 
-        if outliers:
+    def _create_spike_regressors(self):
+        if not self.inputs.pipeline['spikes']:
+            return
+
+        outliers = self._find_outliers()
+
+        if self._censoring:
+            self.sample_mask[outliers] = False
+        elif outliers:
             spikes = np.zeros((self.n_volumes, len(outliers)))
             for i, outlier in enumerate(outliers):
                 spikes[outlier, i] = 1.
@@ -175,6 +218,8 @@ class Confounds(SimpleInterface):
         if self.inputs.pipeline['spikes']:
             self.conf_summary['n_spikes'] = self.n_spikes 
             self.conf_summary['perc_spikes'] = self.n_spikes / self.n_volumes * 100
+        if self._censoring:
+            self.conf_summary['n_censored'] = int(np.sum(~self.sample_mask))
 
         if session:
             self.conf_summary['session'] = session
@@ -185,14 +230,10 @@ class Confounds(SimpleInterface):
         '''Decide if subject should be included in connectivity analysis'''
         if not self.inputs.pipeline['spikes']:
             return True
-
-        mean_fd = self.conf_raw['framewise_displacement'].mean()
-        max_fd = self.conf_raw['framewise_displacement'].max()
-        fd_th = self.inputs.pipeline['spikes']['fd_th']
-
-        if mean_fd > fd_th or max_fd > 5 or self.n_spikes / self.n_volumes > 0.2:
-            return False
-        return True
+        return motion_inclusion(self.inputs.pipeline,
+                                self.conf_raw['framewise_displacement'].mean(),
+                                self.conf_raw['framewise_displacement'].max(),
+                                self.n_spikes / self.n_volumes)
 
     def _run_interface(self, runtime):
 
@@ -202,6 +243,7 @@ class Confounds(SimpleInterface):
             self.conf_json = json.load(json_file)
         self.n_volumes = len(self.conf_raw)
         self.conf_prep = pd.DataFrame()
+        self.sample_mask = np.ones(self.n_volumes, dtype=bool)
 
         # entities
         entities = parse_file_entities_with_pipelines(self.inputs.conf_raw)
@@ -219,11 +261,15 @@ class Confounds(SimpleInterface):
         entities['pipeline'] = self.inputs.pipeline['name']
         conf_prep = join(self.inputs.output_dir, build_path(entities, self.conf_prep_pattern, False))
         conf_summary = join(self.inputs.output_dir, build_path(entities, self.conf_summary_pattern, False))
+        sample_mask = join(self.inputs.output_dir, build_path(entities, self.sample_mask_pattern, False))
         self.conf_prep.to_csv(conf_prep, sep='\t', index=False, na_rep=0)
         with open(conf_summary, 'w') as f:
             json.dump(self.conf_summary, f)
+        pd.DataFrame({'sample_mask': self.sample_mask.astype(int)}).to_csv(sample_mask, sep='\t', index=False)
         self._results['conf_prep'] = conf_prep
         self._results['conf_summary'] = conf_summary
+        self._results['sample_mask'] = sample_mask
+        self._results['include'] = self.conf_summary['include']
         return runtime
 
 
@@ -1,34 +1,255 @@
+import os
+import typing as t
+import warnings
+
 import numpy as np
 from bids.layout import parse_file_entities
 from bids.layout.writing import build_path
 from nipype.interfaces.base import (BaseInterfaceInputSpec, TraitedSpec,
                                     SimpleInterface, File, Directory,
-                                    traits)
+                                    traits, isdefined)
 import nibabel as nb
-from nilearn.input_data import NiftiLabelsMasker
-from nilearn.connectome import ConnectivityMeasure
-from fmridenoise.parcellation import get_parcellation_file_path
+from fmridenoise.parcellation import (DEFAULT_ATLAS, get_atlas_parcellation_file, get_atlas_full_name,
+                                      get_atlas_label, get_atlas_distance_matrix_file, parcel_index)
 from fmridenoise.pipelines import extract_pipeline_from_path
+from fmridenoise.utils.connectome import CONNECTOME_DTYPE, save_connectome, load_connectome
+from fmridenoise.utils.numeric import column_means
 from fmridenoise.utils.entities import build_path, parse_file_entities_with_pipelines, assert_all_entities_equal
 from fmridenoise.utils.plotting import make_carpetplot
+from fmridenoise.utils.signal import standardize
+from fmridenoise.utils.traits import Optional, remove_undefined
+from nilearn.connectome import sym_matrix_to_vec, vec_to_sym_matrix
 from nilearn.plotting import plot_matrix
 from os.path import join, exists
 
 
+# connectivity kinds; subjects connectomes of tangent kind are Ledoit-Wolf
+# covariances, projected to tangent space by GroupConnectivity
+CONNECTIVITY_KINDS = ('correlation', 'partial_correlation', 'tangent')
+# number of subjects covariances processed at once in tangent space projection
+_TANGENT_CHUNK_SIZE = 64
+# floating point precision of saved parcels time series
+TIME_SERIES_DTYPE = np.float32
+
+
+def ledoit_wolf_covariances(time_series: np.ndarray, assume_centered: bool = False) -> np.ndarray:
+    """
+    Ledoit-Wolf shrunk covariance matrices of stack of time series (... x
+    time points x parcels), the same as sklearn LedoitWolf fitted to each of
+    them. Covariances of all time series are calculated with single batched
+    matrix product, shrinkage is derived from covariances and squared norms
+    of time points.
+
+    Returns:
+        Covariance matrices (... x parcels x parcels) in precision of time
+        series.
+    """
+    signals = time_series if assume_centered else time_series - time_series.mean(axis=-2, keepdims=True)
+    n_samples, n_features = signals.shape[-2:]
+    covariance = np.matmul(np.swapaxes(signals, -1, -2), signals)
+    covariance /= n_samples
+    if n_features == 1:
+        return covariance
+    # shrinkage as sklearn.covariance.ledoit_wolf_shrinkage
+    diagonal = np.einsum('...ii->...i', covariance)
+    mu = diagonal.sum(axis=-1) / n_features
+    beta_ = (np.einsum('...ti,...ti->...t', signals, signals) ** 2).sum(axis=-1)
+    delta_ = (covariance ** 2).sum(axis=(-2, -1))
+    beta = (beta_ / n_samples - delta_) / (n_features * n_samples)
+    delta = (delta_ - n_features * mu ** 2) / n_features
+    beta = np.minimum(beta, delta)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shrinkage = np.where(beta == 0, 0, beta / delta)
+    covariance *= (1 - shrinkage)[..., np.newaxis, np.newaxis]
+    diagonal += (shrinkage * mu)[..., np.newaxis]
+    return covariance
+
+
+def _covariance_to_correlation(covariance: np.ndarray) -> np.ndarray:
+    """Scales stack of covariance matrices in place to correlation matrices
+    (as nilearn cov_to_corr)."""
+    diagonal = np.einsum('...ii->...i', covariance)
+    scale = 1 / np.sqrt(diagonal)
+    covariance *= scale[..., np.newaxis, :]
+    covariance *= scale[..., :, np.newaxis]
+    diagonal[...] = 1
+    return covariance
+
+
+def correlation_matrices(time_series: np.ndarray, fisher_z: bool = False) -> np.ndarray:
+    """
+    Correlation matrices of stack of parcels time series (... x time points x
+    parcels, e.g. pipelines x time points x parcels), the same as
+    nilearn ConnectivityMeasure(kind='correlation') with its default
+    Ledoit-Wolf shrunk covariance estimator gives for each of them. Time
+    series are standardized (in their precision) and their covariances are
+    calculated with ledoit_wolf_covariances.
+
+    Args:
+        time_series: time series stack, not modified
+        fisher_z: apply Fisher z-transform (arctanh) to correlations in
+            place, diagonal is set to zero
+
+    Returns:
+        Correlation matrices (... x parcels x parcels) in precision of time
+        series.
+    """
+    signals = time_series - time_series.mean(axis=-2, keepdims=True)
+    std = signals.std(axis=-2, keepdims=True)
+    std[std < np.finfo(std.dtype).eps] = 1
+    signals /= std
+    correlation = _covariance_to_correlation(ledoit_wolf_covariances(signals, assume_centered=True))
+    if fisher_z:
+        np.einsum('...ii->...i', correlation)[...] = 0
+        np.arctanh(correlation, out=correlation)
+    return correlation
+
+
+def partial_correlation_matrices(time_series: np.ndarray) -> np.ndarray:
+    """
+    Partial correlation matrices of stack of parcels time series (... x time
+    points x parcels), the same as nilearn
+    ConnectivityMeasure(kind='partial correlation') with its default
+    Ledoit-Wolf shrunk covariance estimator gives for each of them.
+    Covariances are calculated with ledoit_wolf_covariances and inverted in
+    batch.
+    """
+    partial_correlation = _covariance_to_correlation(np.linalg.inv(ledoit_wolf_covariances(time_series)))
+    partial_correlation *= -1
+    np.einsum('...ii->...i', partial_correlation)[...] = 1
+    return partial_correlation
+
+
+def connectivity_matrices(time_series: np.ndarray, kind: str) -> np.ndarray:
+    """
+    Subjects connectivity matrices of given kind (see CONNECTIVITY_KINDS) of
+    stack of parcels time series. For tangent kind Ledoit-Wolf covariances
+    are returned, they are projected to tangent space at group level (see
+    project_to_tangent_space).
+    """
+    if kind == 'correlation':
+        return correlation_matrices(time_series)
+    if kind == 'partial_correlation':
+        return partial_correlation_matrices(time_series)
+    if kind == 'tangent':
+        return ledoit_wolf_covariances(time_series)
+    raise ValueError(f"Unknown connectivity kind {kind}, expected one of {CONNECTIVITY_KINDS}")
+
+
+def subjects_connectome_kind(kind: str) -> str:
+    """Kind of matrices saved in subjects connectomes of connectivity kind."""
+    return 'covariance' if kind == 'tangent' else kind
+
+
+def _form_symmetric(function, eigenvalues: np.ndarray, eigenvectors: np.ndarray) -> np.ndarray:
+    """Stack of symmetric matrices with given eigenvectors and eigenvalues
+    transformed by function (as nilearn _form_symmetric)."""
+    return np.matmul(eigenvectors * function(eigenvalues)[..., np.newaxis, :], np.swapaxes(eigenvectors, -1, -2))
+
+
+def _map_eigenvalues(function, symmetric: np.ndarray) -> np.ndarray:
+    """Matrix function of stack of symmetric matrices applied to their
+    eigenvalues (as nilearn _map_eigenvalues)."""
+    return _form_symmetric(function, *np.linalg.eigh(symmetric))
+
+
+def _matrix_chunks(group_edges: np.ndarray) -> t.Iterator[t.Tuple[int, np.ndarray]]:
+    """Yields start index and double precision matrices of consecutive chunks
+    of _TANGENT_CHUNK_SIZE subjects edges vectors."""
+    for start in range(0, len(group_edges), _TANGENT_CHUNK_SIZE):
+        yield start, vec_to_sym_matrix(np.asarray(group_edges[start:start + _TANGENT_CHUNK_SIZE], dtype=np.float64))
+
+
+def geometric_mean(group_edges: np.ndarray, max_iter: int = 30, tol: float = 1e-7) -> np.ndarray:
+    """
+    Geometric mean of covariance matrices given as edges vectors (subjects x
+    edges, e.g. memory mapped group connectome), calculated with the same
+    gradient descent as by nilearn ConnectivityMeasure(kind='tangent').
+    Covariances are read and whitened in chunks of subjects at each
+    iteration, so memory does not grow with number of subjects.
+    """
+    gmean = vec_to_sym_matrix(column_means(group_edges))
+    norm_old = np.inf
+    step = 1.
+    for _ in range(max_iter):
+        vals_gmean, vecs_gmean = np.linalg.eigh(gmean)
+        gmean_inv_sqrt = _form_symmetric(np.sqrt, 1. / vals_gmean, vecs_gmean)
+        logs_mean = np.zeros_like(gmean)
+        for _, covariances in _matrix_chunks(group_edges):
+            logs_mean += _map_eigenvalues(np.log, gmean_inv_sqrt @ covariances @ gmean_inv_sqrt).sum(axis=0)
+        logs_mean /= len(group_edges)
+        if np.any(np.isnan(logs_mean)):
+            raise FloatingPointError("Nan value after logarithm operation.")
+        norm = np.linalg.norm(logs_mean)
+        vals_log, vecs_log = np.linalg.eigh(logs_mean)
+        gmean_sqrt = _form_symmetric(np.sqrt, vals_gmean, vecs_gmean)
+        gmean = gmean_sqrt @ _form_symmetric(np.exp, vals_log * step, vecs_log) @ gmean_sqrt
+        if norm < norm_old:
+            norm_old = norm
+        elif norm > norm_old:
+            step = step / 2.
+            norm = norm_old
+        if norm / gmean.size < tol:
+            break
+    else:
+        warnings.warn(f"Maximum number of iterations {max_iter} reached without getting to the requested "
+                      f"tolerance level {tol}.")
+    return gmean
+
+
+def project_to_tangent_space(group_edges: np.ndarray) -> None:
+    """
+    Replaces covariance matrices given as edges vectors (subjects x edges)
+    in place with their projections to tangent space at their geometric
+    mean, the same as nilearn ConnectivityMeasure(kind='tangent') fitted to
+    all subjects gives. Subjects are processed in chunks (see
+    geometric_mean).
+    """
+    whitening = _map_eigenvalues(lambda x: 1. / np.sqrt(x), geometric_mean(group_edges))
+    for start, covariances in _matrix_chunks(group_edges):
+        group_edges[start:start + len(covariances)] = sym_matrix_to_vec(
+            _map_eigenvalues(np.log, whitening @ covariances @ whitening))
+
+
 class ConnectivityInputSpec(BaseInterfaceInputSpec):
     fmri_denoised = File(
         exists=True,
-        desc='Denoised fMRI file',
-        mandatory=True)
+        desc='Denoised fMRI file, required (if time_series is not given) for included subject',
+        xor=['time_series'])
+    time_series = File(
+        exists=True,
+        desc='Denoised parcels time series file (time points x parcels), loaded in precision, required (if '
+             'fmri_denoised is not given) for included subject',
+        xor=['fmri_denoised'])
     output_dir = Directory(
         exists=True,
         desc='Output path')
+    precision = traits.Enum(
+        'float64', 'float32',
+        usedefault=True,
+        desc='Floating point precision of parcels time series extraction')
+    atlas = traits.Str(
+        DEFAULT_ATLAS,
+        usedefault=True,
+        desc='Atlas (default atlas or parcellation file) of parcels time series')
+    kind = traits.Enum(
+        *CONNECTIVITY_KINDS,
+        usedefault=True,
+        desc='Connectivity kind, for tangent kind covariance matrix is saved')
+    include = traits.Bool(
+        True,
+        usedefault=True,
+        desc='If False (subject excluded by motion criteria and not denoised) no outputs are created')
 
 
 class ConnectivityOutputSpec(TraitedSpec):
     corr_mat = File(
         exists=True,
-        desc='Connectivity matrix',
+        desc='Connectivity matrix (see fmridenoise.utils.connectome)',
+        mandatory=True)
+    parcels_time_series = File(
+        exists=True,
+        desc='Parcels time series (time points x parcels) saved in TIME_SERIES_DTYPE',
         mandatory=True)
     carpet_plot = File(
         exists=True,
@@ -41,78 +262,183 @@ class ConnectivityOutputSpec(TraitedSpec):
 
 
 class Connectivity(SimpleInterface):
+    """
+    Calculates connectivity matrix of given kind of parcels time series (see
+    connectivity_matrices). Matrix is saved as
+    vector of CONNECTOME_DTYPE edges with atlas of parcellation and number of
+    parcels (see fmridenoise.utils.connectome.save_connectome). Parcels time
+    series are saved in TIME_SERIES_DTYPE, so connectivity can be recalculated
+    without denoising (see fmridenoise.workflows.rebuild). Atlas entity is added
+    to names of outputs for atlases other than default one.
+    """
     input_spec = ConnectivityInputSpec
     output_spec = ConnectivityOutputSpec
-    conn_file_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}_connMat.npy"
-    carpet_plot_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}_carpetPlot.png"
-    matrix_plot_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_pipeline-{pipeline}_matrixPlot.png"
+    conn_file_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}][_atlas-{atlas}]_pipeline-{pipeline}" \
+                        "_connMat.npz"
+    carpet_plot_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}][_atlas-{atlas}]_pipeline-{pipeline}" \
+                          "_carpetPlot.png"
+    matrix_plot_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}][_atlas-{atlas}]_pipeline-{pipeline}" \
+                          "_matrixPlot.png"
+    time_series_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}][_atlas-{atlas}]_pipeline-{pipeline}" \
+                          "_timeseries.npy"
 
     def _run_interface(self, runtime):
-        fname = self.inputs.fmri_denoised
-        entities = parse_file_entities(fname)
-        bold_img = nb.load(fname)
-        parcellation_file = get_parcellation_file_path(entities['space'])
-        masker = NiftiLabelsMasker(labels_img=parcellation_file, standardize=True)
-        time_series = masker.fit_transform(bold_img, confounds=None)
-
-        corr_measure = ConnectivityMeasure(kind='correlation')
-        corr_mat = corr_measure.fit_transform([time_series])[0]
+        if not self.inputs.include:
+            return runtime
+        if isdefined(self.inputs.time_series):
+            fname = self.inputs.time_series
+            entities = parse_file_entities(fname)
+            time_series = np.load(fname).astype(self.inputs.precision, copy=False)
+        elif isdefined(self.inputs.fmri_denoised):
+            fname = self.inputs.fmri_denoised
+            entities = parse_file_entities(fname)
+            bold_img = nb.load(fname)
+            parcellation_file = get_atlas_parcellation_file(self.inputs.atlas, entities['space'])
+            time_series = standardize(parcel_index(parcellation_file, bold_img).parcel_means(
+                bold_img.get_fdata(dtype=self.inputs.precision), dtype=self.inputs.precision))
+        else:
+            raise ValueError("Either time_series or fmri_denoised is required for included subject")
+        atlas = get_atlas_full_name(self.inputs.atlas)
+        entities['atlas'] = get_atlas_label(self.inputs.atlas)
+
+        corr_mat = connectivity_matrices(time_series, self.inputs.kind)
         entities['pipeline'] = extract_pipeline_from_path(fname)
         conn_file = join(self.inputs.output_dir, build_path(entities, self.conn_file_pattern, False))
         carpet_plot_file = join(self.inputs.output_dir, build_path(entities, self.carpet_plot_pattern, False))
         matrix_plot_file = join(self.inputs.output_dir, build_path(entities, self.matrix_plot_pattern, False))
+        time_series_file = join(self.inputs.output_dir, build_path(entities, self.time_series_pattern, False))
 
         make_carpetplot(time_series, carpet_plot_file)
         mplot = plot_matrix(corr_mat,  vmin=-1, vmax=1)
         mplot.figure.savefig(matrix_plot_file)
 
-        np.save(conn_file, corr_mat)
+        save_connectome(conn_file, corr_mat, atlas, subjects_connectome_kind(self.inputs.kind))
+        np.save(time_series_file, time_series.astype(TIME_SERIES_DTYPE))
 
         self._results['corr_mat'] = conn_file
         self._results['carpet_plot'] = carpet_plot_file
         self._results['matrix_plot'] = matrix_plot_file
+        self._results['parcels_time_series'] = time_series_file
 
         return runtime
 
 
 class GroupConnectivityInputSpec(BaseInterfaceInputSpec):
     corr_mat = traits.List(
-        File(exists=True),
+        Optional(File(exists=True)),
         mandatory=True,
-        desc='Connectivity matrix file')
+        desc='Connectivity matrix file, undefined for subjects excluded (and not denoised)')
 
     output_dir = Directory(
         exists=True,
         mandatory=True,
         desc='Output path')
 
+    kind = traits.Enum(
+        *CONNECTIVITY_KINDS,
+        usedefault=True,
+        desc='Connectivity kind, subjects covariance matrices are projected to tangent space for tangent kind')
+
 
 class GroupConnectivityOutputSpec(TraitedSpec):
     group_corr_mat = File(
         exists=True,
-        desc='Connectivity matrix',
+        desc='Group connectivity matrix (subjects x edges)',
         mandatory=True)
 
 
 class GroupConnectivity(SimpleInterface):
+    """
+    Stacks edges vectors of subjects connectomes into single (subjects x
+    edges) CONNECTOME_DTYPE array saved as .npy file. Number of edges is
+    given by first connectome, the file is preallocated and connectomes are
+    written to it one by one through memory map, so group connectome is never
+    held in memory. Undefined connectivity matrices (of subjects excluded
+    and not denoised) are left out, if all are undefined group connectome is
+    not created. For tangent kind subjects covariances are
+    projected in place to tangent space at their geometric mean (see
+    project_to_tangent_space).
+    """
     input_spec = GroupConnectivityInputSpec
     output_spec = GroupConnectivityOutputSpec
-    group_corr_pattern = "[ses-{session}_]task-{task}_[run-{run}_]pipeline-{pipeline}_groupCorrMat.npy"
+    group_corr_pattern = "[ses-{session}_]task-{task}_[run-{run}_][atlas-{atlas}_]pipeline-{pipeline}_groupCorrMat.npy"
 
     def _run_interface(self, runtime):
+        corr_mats = list(remove_undefined(self.inputs.corr_mat))
+        if not corr_mats:
+            warnings.warn("No connectivity matrices given (all subjects excluded), group connectivity matrix "
+                          "is not created")
+            return runtime
         # noinspection PyUnreachableCode
         if __debug__:  # sanity check
-            entities = [parse_file_entities_with_pipelines(path) for path in self.inputs.corr_mat]
-            assert_all_entities_equal(entities, "session", "task", "run", "pipeline")
-        n_corr_mat = len(self.inputs.corr_mat)
-        n_rois = 200
-        group_corr_mat = np.zeros((n_corr_mat, n_rois, n_rois))
-        for i, file in enumerate(self.inputs.corr_mat):
-            group_corr_mat[i, :, :] = np.load(file)
-        entities = parse_file_entities_with_pipelines(self.inputs.corr_mat[0])
+            entities = [parse_file_entities_with_pipelines(path) for path in corr_mats]
+            assert_all_entities_equal(entities, "session", "task", "run", "atlas", "pipeline")
+        first = load_connectome(corr_mats[0])
+        kind = subjects_connectome_kind(self.inputs.kind)
+        entities = parse_file_entities_with_pipelines(corr_mats[0])
         group_corr_file = join(self.inputs.output_dir, build_path(entities, self.group_corr_pattern, False))
         assert not exists(group_corr_file), f"Group connectivity file already exists {group_corr_file}"
-        np.save(group_corr_file, group_corr_mat)
+        group_corr_mat = np.lib.format.open_memmap(group_corr_file, mode='w+', dtype=CONNECTOME_DTYPE,
+                                                   shape=(len(corr_mats), len(first.edges)))
+        try:
+            for i, file in enumerate(corr_mats):
+                connectome = first if i == 0 else load_connectome(file)
+                if connectome.kind != kind:
+                    raise ValueError(f"Connectivity matrix {file} is {connectome.kind} matrix, "
+                                     f"expected {kind} matrix for {self.inputs.kind} connectivity")
+                if (connectome.atlas, connectome.n_rois) != (first.atlas, first.n_rois):
+                    raise ValueError(f"Connectivity matrix {file} of atlas {connectome.atlas} "
+                                     f"({connectome.n_rois} regions) differs from {corr_mats[0]} "
+                                     f"of atlas {first.atlas} ({first.n_rois} regions)")
+                group_corr_mat[i] = connectome.edges
+            if self.inputs.kind == 'tangent':
+                project_to_tangent_space(group_corr_mat)
+        except Exception:
+            del group_corr_mat
+            os.remove(group_corr_file)
+            raise
+        group_corr_mat.flush()
+        del group_corr_mat
 
         self._results['group_corr_mat'] = group_corr_file
         return runtime
+
+
+class AtlasSelectorInputSpec(BaseInterfaceInputSpec):
+    atlas = traits.Str(
+        mandatory=True,
+        desc='Atlas (default atlas or parcellation file)')
+    output_dir = Directory(
+        exists=True,
+        mandatory=True,
+        desc='Output path of computed distance matrices')
+
+
+class AtlasSelectorOutputSpec(TraitedSpec):
+    atlas = traits.Str(
+        desc='Atlas (default atlas or parcellation file)')
+    atlas_label = traits.Str(
+        desc='Atlas entity of files created with atlas, undefined for default atlas')
+    distance_matrix = File(
+        exists=True,
+        desc='Distance matrix of atlas parcels')
+
+
+class AtlasSelector(SimpleInterface):
+    """
+    Provides atlas entity and distance matrix of atlas. Used as atlas
+    iterable, so time series of all atlases are created by single denoising
+    and connectivity and quality measures are calculated for each atlas.
+    Distance matrices of atlases other than default one are computed (see
+    fmridenoise.parcellation.get_atlas_distance_matrix_file).
+    """
+    input_spec = AtlasSelectorInputSpec
+    output_spec = AtlasSelectorOutputSpec
+
+    def _run_interface(self, runtime):
+        self._results['atlas'] = self.inputs.atlas
+        label = get_atlas_label(self.inputs.atlas)
+        if label:
+            self._results['atlas_label'] = label
+        self._results['distance_matrix'] = get_atlas_distance_matrix_file(self.inputs.atlas, self.inputs.output_dir)
+        return runtime
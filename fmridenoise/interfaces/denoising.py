@@ -1,12 +1,111 @@
 from os.path import join, exists
+import logging
+import typing as t
+import numpy as np
 import pandas as pd
 import nibabel as nb
+import nilearn
 from traits.trait_base import Undefined
-from nilearn.image import clean_img
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec, TraitedSpec, SimpleInterface,
-    ImageFile, File, Directory, traits)
+    ImageFile, File, Directory, traits, isdefined)
 from fmridenoise.utils.entities import parse_file_entities, build_path
+from fmridenoise.parcellation import DEFAULT_ATLAS, get_atlas_parcellation_file, get_atlas_label, parcel_index
+from fmridenoise.utils.signal import confounds_projector, apply_projector, denoise_img_atlases, parcel_means_blockwise
+from fmridenoise.utils.cache import cached_array, content_hash, file_hash
+from fmridenoise.utils.nifti import COMPRESS_LEVEL_DEFAULT, nifti_path
+
+logger = logging.getLogger(__name__)
+DENOISE_MEM_MB_DEFAULT = 2048
+
+
+def load_confounds(conf_prep: str) -> t.Optional[np.ndarray]:
+    """Load confounds from tsv file.
+
+    Returns:
+        None if conf_prep is empty file (in case of null pipeline), otherwise
+        np.ndarray of confounds.
+    """
+    try:
+        return pd.read_csv(conf_prep, delimiter='\t').values
+    except pd.errors.EmptyDataError:
+        return None
+
+
+def filtering_kwargs(low_pass: float, high_pass: float, tr_dict: dict, task: str) -> dict:
+    """Creates dictionary of optional temporal filtering keyword arguments
+    passed to clean_img (or nilearn.signal.clean). Undefined cut-off values are
+    skipped. Empty if no temporal filtering is requested, otherwise TR for given
+    task is also included.
+    """
+    kwargs = dict()
+    if low_pass is not Undefined:
+        kwargs.update(low_pass=low_pass)
+    if high_pass is not Undefined:
+        kwargs.update(high_pass=high_pass)
+    if kwargs:
+        kwargs.update(t_r=tr_dict[task])
+    return kwargs
+
+
+def load_sample_mask(sample_mask: str) -> t.Optional[np.ndarray]:
+    """Load sample mask from tsv file.
+
+    Returns:
+        None if all volumes are retained, otherwise np.ndarray of indices of
+        retained volumes.
+    """
+    mask = pd.read_csv(sample_mask, delimiter='\t')['sample_mask'].values.astype(bool)
+    return None if mask.all() else np.flatnonzero(mask)
+
+
+def pipeline_projector(conf_prep: str, n_volumes: int, filtering_kwargs: dict,
+                       sample_mask: t.Optional[str] = None, cache_dir: t.Optional[str] = None) -> np.ndarray:
+    """Creates confounds projector (see confounds_projector) for confounds
+    table, optional sample mask table and temporal filtering. If cache_dir is
+    given projectors are cached there, keyed by content of confounds and
+    sample mask files, number of volumes and filtering parameters, so
+    confounds are neither loaded nor factorised again for the same design.
+    """
+    key = content_hash('projector', nilearn.__version__, file_hash(conf_prep),
+                       sample_mask and file_hash(sample_mask), n_volumes, sorted(filtering_kwargs.items()))
+    return cached_array(
+        cache_dir, key,
+        lambda: confounds_projector(
+            n_volumes,
+            load_confounds(conf_prep),
+            load_sample_mask(sample_mask) if sample_mask else None,
+            **filtering_kwargs))
+
+
+def parcellation_labels(img: nb.Nifti1Image, space: str, atlas: str = DEFAULT_ATLAS) -> np.ndarray:
+    """Parcellation labels of atlas for given space resampled to grid of image
+    (in the same way as NiftiLabelsMasker resamples labels to data, see
+    fmridenoise.parcellation.parcel_index)."""
+    return parcel_index(get_atlas_parcellation_file(atlas, space), img).labels_img
+
+
+def atlas_entities(entities: dict, atlas: str) -> dict:
+    """Entities of files created with atlas (atlas entity is set only for
+    atlases other than default one)."""
+    label = get_atlas_label(atlas)
+    return {**entities, 'atlas': label} if label else entities
+
+
+def select_fmri_file(pipeline: dict, fmri_prep: str, fmri_prep_aroma: str) -> str:
+    """Selects preprocessed fmri file (either with or without aroma) according
+    to aroma option in pipeline dictionary.
+    """
+    if not pipeline['aroma']:
+        if fmri_prep is Undefined:
+            raise FileNotFoundError('for pipeline using aroma ' + \
+                                    'file fmri_prep_aroma is required')
+        return fmri_prep
+    else:
+        if fmri_prep_aroma is Undefined:
+            raise FileNotFoundError('for pipeline without aroma ' + \
+                                    'file fmri_prep is required')
+        return fmri_prep_aroma
 
 
 class DenoiseInputSpec(BaseInterfaceInputSpec):
@@ -25,6 +124,11 @@ class DenoiseInputSpec(BaseInterfaceInputSpec):
         exists=True,
         desc='Confounds file'
         )
+    sample_mask = File(
+        mandatory=False,
+        exists=True,
+        desc='Sample mask file, censored volumes are removed before denoising'
+    )
 
     pipeline = traits.Dict(
         mandatory=True,
@@ -47,13 +151,61 @@ class DenoiseInputSpec(BaseInterfaceInputSpec):
         mandatory=False,
         desc="Low-pass filter"
     )
+    mem_mb = traits.Float(
+        DENOISE_MEM_MB_DEFAULT,
+        usedefault=True,
+        desc='Memory budget (in megabytes) for denoising working arrays'
+    )
+    precision = traits.Enum(
+        'float64', 'float32',
+        usedefault=True,
+        desc='Floating point precision of denoising and denoised image'
+    )
+    projector_cache = Directory(
+        exists=True,
+        mandatory=False,
+        desc='Directory for caching confounds projectors'
+    )
+    atlases = traits.List(
+        traits.Str(),
+        [DEFAULT_ATLAS],
+        usedefault=True,
+        desc='Atlases (default atlas or parcellation files) for which parcels time series are created'
+    )
+    save_denoised_bold = traits.Bool(
+        True,
+        usedefault=True,
+        desc='Save denoised fMRI file, otherwise only parcels time series are created'
+    )
+    compress_level = traits.Range(
+        low=0, high=9,
+        value=COMPRESS_LEVEL_DEFAULT,
+        usedefault=True,
+        desc='Gzip compression level of denoised fMRI file, 0 saves uncompressed .nii file'
+    )
+    compress_threads = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of threads compressing denoised fMRI file'
+    )
+    include = traits.Bool(
+        True,
+        usedefault=True,
+        desc='If False (subject excluded by motion criteria) denoising is skipped and no outputs are created'
+    )
 
 
 class DenoiseOutputSpec(TraitedSpec):
     fmri_denoised = File(
-        mandatory=True,
         exists=True,
-        desc='Denoised fMRI file',
+        desc='Denoised fMRI file, created only if save_denoised_bold is set',
+    )
+    time_series = traits.List(
+        File(exists=True),
+        desc='Denoised parcels time series file (time points x parcels) for each atlas'
+    )
+    mem_peak_mb = traits.Float(
+        desc='Measured peak memory (in megabytes) allocated by denoising (traced with tracemalloc)'
     )
 
 
@@ -61,8 +213,33 @@ class Denoise(SimpleInterface):
     """ Denoise functional images using filtered confounds.
 
     This interface uses filtered confounds table and temporal (bandpass) 
-    filtering to denoise functional images. It wraps around nilearn clean_img
-    function to create and save denoised file. 
+    filtering to denoise functional images. Denoising gives the same results
+    as nilearn clean_img function (with detrending and standardization), but
+    image is processed in blocks of slices so that memory usage is bounded by
+    mem_mb megabytes instead of whole image kept (multiple times) in memory.
+    Detrending, filtering and confounds regression are precomputed as single
+    projector matrix applied to each block. If projector_cache directory is
+    given, projectors are stored there and reused by every denoising with the
+    same confounds, number of volumes and temporal filtering.
+
+    If sample_mask is given, volumes marked as censored are removed before
+    detrending and filtering (as in nilearn.signal.clean), so denoised image
+    contains only retained volumes. If include is False (subject excluded by
+    motion criteria of pipeline) nothing is denoised and no time series are
+    created.
+
+    Denoised voxels are averaged within parcels as soon as each block is
+    cleaned, so parcels time series (as extracted by NiftiLabelsMasker with
+    standardization from denoised image) are always created, for each of
+    atlases at once. Denoised image
+    itself is written only if save_denoised_bold is set (default), which
+    allows to skip writing, compressing and reading back large 4D images when
+    only connectivity is needed.
+
+    Denoising is done in float64 precision by default. With precision set to
+    float32 working arrays and denoised image use half of memory and disk
+    space at the cost of single precision accuracy (sufficient for
+    connectivity estimation).
 
     At least one of two inputs should be passed to this interface depending on
     denoising strategy. If denoising assumes aroma, fmri_prep_aroma file should
@@ -77,12 +254,20 @@ class Denoise(SimpleInterface):
 
     Output filename reflecting denoised filename is created by adding suffix
         'pipeline-<pipeline_name>_desc-denoised_bold'
-    to existing filename (desc-preproc is replaced with desc-denoised).
+    to existing filename (desc-preproc is replaced with desc-denoised). Image
+    is compressed with compress_level using compress_threads threads (see
+    fmridenoise.utils.nifti.gzip_file) or saved as uncompressed .nii file if
+    compress_level is 0. Parcels time series are saved as .npy files with suffix
+        '[atlas-<atlas_label>_]pipeline-<pipeline_name>_timeseries'
+    where atlas entity is set for atlases other than default one (see
+    fmridenoise.parcellation.get_atlas_label).
     """
     input_spec = DenoiseInputSpec
     output_spec = DenoiseOutputSpec
     fmri_denoised_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_space-{space}_pipeline-{pipeline}" \
                             "_desc-denoised_bold.nii.gz"
+    time_series_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}][_atlas-{atlas}]" \
+                          "_pipeline-{pipeline}_timeseries.npy"
 
     def _validate_fmri_prep_files(self):
         """Check if correct file is provided according to aroma option in 
@@ -92,16 +277,8 @@ class Denoise(SimpleInterface):
             _fmri_file (attibute): 
                 preprocessed fmri file (either with or without aroma)
         """
-        if not self.inputs.pipeline['aroma']: 
-            if self.inputs.fmri_prep is Undefined:
-                raise FileNotFoundError('for pipeline using aroma ' + \
-                                        'file fmri_prep_aroma is required')
-            self._fmri_file = self.inputs.fmri_prep     
-        else:
-            if self.inputs.fmri_prep_aroma is Undefined:
-                raise FileNotFoundError('for pipeline without aroma ' + \
-                                        'file fmri_prep is required')
-            self._fmri_file = self.inputs.fmri_prep_aroma
+        self._fmri_file = select_fmri_file(
+            self.inputs.pipeline, self.inputs.fmri_prep, self.inputs.fmri_prep_aroma)
         return self._fmri_file
 
     def _load_confouds(self):
@@ -113,11 +290,7 @@ class Denoise(SimpleInterface):
                 Either None (for null pipeline) or np.ndarray of confounds if 
                 conf_prep is not empty.
         """
-        try:
-            self._confounds = pd.read_csv(
-                self.inputs.conf_prep, delimiter='\t').values
-        except pd.errors.EmptyDataError:
-            self._confounds = None
+        self._confounds = load_confounds(self.inputs.conf_prep)
 
     def _validate_filtering(self, task):
         """Validate input arguments related to temporal filtering.
@@ -127,32 +300,300 @@ class Denoise(SimpleInterface):
                 Dictionary of optional keyword arguments passed to clean_img.
                 Empty if no temporal filtering is requested.         
         """
-        self._filtering_kwargs = dict()
-        if self.inputs.low_pass is not Undefined:
-            self._filtering_kwargs.update(low_pass=self.inputs.low_pass)
-        if self.inputs.high_pass is not Undefined:
-            self._filtering_kwargs.update(high_pass=self.inputs.high_pass)
-        if self._filtering_kwargs:
-            self._filtering_kwargs.update(
-                t_r=self.inputs.tr_dict[task])
+        self._filtering_kwargs = filtering_kwargs(
+            self.inputs.low_pass, self.inputs.high_pass, self.inputs.tr_dict, task)
 
     def _run_interface(self, runtime):
+        if not self.inputs.include:
+            logger.info(f"Denoising of excluded subject with {self.inputs.conf_prep} skipped")
+            self._results['time_series'] = []
+            return runtime
 
         fmri_file = self._validate_fmri_prep_files()
         entities = parse_file_entities(fmri_file)
         self._validate_filtering(entities['task'])
-        self._load_confouds()
         entities = parse_file_entities(self._fmri_file)
-        fmri_denoised = clean_img(
-            nb.load(self._fmri_file), 
-            confounds=self._confounds, 
-            **self._filtering_kwargs)
+        img = nb.load(self._fmri_file)
+        projector = pipeline_projector(
+            self.inputs.conf_prep,
+            img.shape[-1],
+            self._filtering_kwargs,
+            self.inputs.sample_mask if isdefined(self.inputs.sample_mask) else None,
+            self.inputs.projector_cache if isdefined(self.inputs.projector_cache) else None)
 
         entities['pipeline'] = self.inputs.pipeline['name']
-        fmri_denoised_fname = join(self.inputs.output_dir, build_path(entities, self.fmri_denoised_pattern, False))
-        assert not exists(fmri_denoised_fname), f"Denoising is run twice at {self._fmri_file} " \
-                                                f"with result {fmri_denoised_fname}"
-        nb.save(fmri_denoised, fmri_denoised_fname)
-        self._results['fmri_denoised'] = fmri_denoised_fname
+        fmri_denoised_fname = nifti_path(
+            join(self.inputs.output_dir, build_path(entities, self.fmri_denoised_pattern, False)),
+            self.inputs.compress_level)
+        time_series_fnames = [
+            join(self.inputs.output_dir, build_path(atlas_entities(entities, atlas), self.time_series_pattern, False))
+            for atlas in self.inputs.atlases]
+        for time_series_fname in time_series_fnames:
+            assert not exists(time_series_fname), f"Denoising is run twice at {self._fmri_file} " \
+                                                  f"with result {time_series_fname}"
+        time_series, mem_peak = denoise_img_atlases(
+            self._fmri_file, [projector],
+            [parcellation_labels(img, entities['space'], atlas) for atlas in self.inputs.atlases],
+            self.inputs.mem_mb,
+            dtype=self.inputs.precision,
+            out_files=[fmri_denoised_fname] if self.inputs.save_denoised_bold else None,
+            compress_level=self.inputs.compress_level,
+            n_threads=self.inputs.compress_threads)
+        for time_series_fname, (atlas_time_series, ) in zip(time_series_fnames, time_series):
+            np.save(time_series_fname, atlas_time_series)
+        logger.info(f"Denoised {self._fmri_file} with peak of {mem_peak / 2 ** 20:.0f} MB allocated")
+        if self.inputs.save_denoised_bold:
+            self._results['fmri_denoised'] = fmri_denoised_fname
+        self._results['time_series'] = time_series_fnames
+        self._results['mem_peak_mb'] = mem_peak / 2 ** 20
+
+        return runtime
+
+
+class PipelinesDenoiseInputSpec(BaseInterfaceInputSpec):
+    fmri_prep = ImageFile(
+        mandatory=False,
+        exists=True,
+        desc='Preprocessed fMRI file'
+    )
+    fmri_prep_aroma = ImageFile(
+        mandatory=False,
+        exists=True,
+        desc='ICA-Aroma preprocessed fMRI file'
+    )
+    conf_prep = traits.List(
+        File(exists=True),
+        mandatory=True,
+        desc='Confounds file for each pipeline'
+    )
+    sample_mask = traits.List(
+        File(exists=True),
+        mandatory=False,
+        desc='Sample mask file for each pipeline, censored volumes are removed before denoising'
+    )
+    pipeline = traits.List(
+        traits.Dict(),
+        mandatory=True,
+        desc='Denoising pipelines'
+    )
+    output_dir = Directory(
+        exists=True,
+        desc='Output path',
+        mandatory=True
+    )
+    tr_dict = traits.Dict(
+        mandatory=False,
+        desc='TR values for all tasks'
+    )
+    high_pass = traits.Float(
+        mandatory=False,
+        desc='High cut-off frequency in Hertz'
+    )
+    low_pass = traits.Float(
+        mandatory=False,
+        desc="Low-pass filter"
+    )
+    denoise_space = traits.Enum(
+        'voxels', 'parcels',
+        usedefault=True,
+        desc="Space in which confounds are regressed: 'voxels' cleans every voxel of "
+             "the image, 'parcels' cleans parcel averaged time series"
+    )
+    mem_mb = traits.Float(
+        DENOISE_MEM_MB_DEFAULT,
+        usedefault=True,
+        desc='Memory budget (in megabytes) for working arrays of voxelwise denoising (or parcels averaging '
+             'in parcels denoise space)'
+    )
+    precision = traits.Enum(
+        'float64', 'float32',
+        usedefault=True,
+        desc='Floating point precision of denoising and denoised images (or time series)'
+    )
+    projector_cache = Directory(
+        exists=True,
+        mandatory=False,
+        desc='Directory for caching confounds projectors'
+    )
+    atlases = traits.List(
+        traits.Str(),
+        [DEFAULT_ATLAS],
+        usedefault=True,
+        desc='Atlases (default atlas or parcellation files) for which parcels time series are created'
+    )
+    save_denoised_bold = traits.Bool(
+        True,
+        usedefault=True,
+        desc='Save denoised fMRI files in voxels denoise space, otherwise only parcels time series are created'
+    )
+    compress_level = traits.Range(
+        low=0, high=9,
+        value=COMPRESS_LEVEL_DEFAULT,
+        usedefault=True,
+        desc='Gzip compression level of denoised fMRI files, 0 saves uncompressed .nii files'
+    )
+    compress_threads = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of threads compressing denoised fMRI files'
+    )
+    include = traits.List(
+        traits.Bool(),
+        mandatory=False,
+        desc='Inclusion of subject (by motion criteria) for each pipeline, pipelines of excluded subject are '
+             'skipped'
+    )
+
+
+class PipelinesDenoiseOutputSpec(TraitedSpec):
+    fmri_denoised = traits.List(
+        File(exists=True),
+        desc='Denoised fMRI file for each pipeline (in order of pipeline input), '
+             'created only in voxels denoise space with save_denoised_bold set'
+    )
+    time_series = traits.List(
+        File(exists=True),
+        desc='Denoised parcels time series for each pipeline (in order of pipeline input) '
+             'and atlas (in order of atlases input)'
+    )
+    mem_peak_mb = traits.Float(
+        desc='Measured peak memory (in megabytes) allocated by voxelwise denoising (or parcels averaging) '
+             '(traced with tracemalloc)'
+    )
+
+
+class PipelinesDenoise(SimpleInterface):
+    """ Denoise functional images using multiple pipelines at once.
 
+    Batched version of Denoise interface. It takes one preprocessed fMRI file
+    (and optionally its ICA-Aroma counterpart) together with confounds tables
+    and pipelines joined over all denoising strategies. Each distinct input
+    image is read only once and then cleaned with every pipeline that uses
+    it, so N pipelines cost one image read instead of N.
+
+    Cleaning is the same as in Denoise: image is processed in blocks of slices
+    within mem_mb memory budget and every block is cleaned with projectors of
+    all pipelines using the image. Parcels time series are created for every
+    pipeline and atlas, denoised images only if save_denoised_bold is set.
+
+    If denoise_space is 'parcels', voxelwise cleaning is skipped. Instead raw
+    signals are averaged within parcels once per image (read in blocks within
+    mem_mb memory budget, see parcel_means_blockwise) and each pipeline
+    confounds and temporal filters are applied to parcels time series, for a
+    fraction of the cost. Denoised time series are saved as .npy files (time
+    points x parcels) instead of fMRI images.
+
+    Connectivity of parcels mode approximates voxelwise denoising. Detrending,
+    filtering and confounds regression are linear, so time series are the
+    same as parcels averages of voxelwise denoised image without
+    standardization, and connectomes are the same if voxels of each parcel
+    differ only in offset and scale. Voxelwise denoising however standardizes
+    every denoised voxel before averaging (weighting voxels by inverse of
+    their standard deviation after denoising), while here raw voxels signals
+    are averaged with equal weights. Connectomes differ as much as these
+    weights do: the deviation has no fixed bound, it grows with heterogeneity
+    of voxels time courses within parcels and with degrees of freedom lost to
+    confounds (on short synthetic scans mean absolute differences of
+    correlations were 0.04-0.24, with single edges differing by more than 1).
+    Quality measures should be compared only between pipelines denoised in
+    the same space.
+
+    If include is given, pipelines which exclude subject are skipped and
+    image is not read at all if all pipelines using it are skipped.
+
+    Outputs are returned in the same order as pipeline input (time series of
+    each pipeline in order of atlases input, skipped pipelines omitted) and
+    follow Denoise naming convention.
+    """
+    input_spec = PipelinesDenoiseInputSpec
+    output_spec = PipelinesDenoiseOutputSpec
+    fmri_denoised_pattern = Denoise.fmri_denoised_pattern
+    time_series_pattern = Denoise.time_series_pattern
+
+    def _group_by_fmri_file(self) -> t.Dict[str, t.List[int]]:
+        """Groups pipelines indices by preprocessed fmri file they require."""
+        if len(self.inputs.conf_prep) != len(self.inputs.pipeline):
+            raise ValueError(f"Number of confounds files ({len(self.inputs.conf_prep)}) does not match "
+                             f"number of pipelines ({len(self.inputs.pipeline)})")
+        if isdefined(self.inputs.sample_mask) and len(self.inputs.sample_mask) != len(self.inputs.pipeline):
+            raise ValueError(f"Number of sample mask files ({len(self.inputs.sample_mask)}) does not match "
+                             f"number of pipelines ({len(self.inputs.pipeline)})")
+        if isdefined(self.inputs.include) and len(self.inputs.include) != len(self.inputs.pipeline):
+            raise ValueError(f"Number of inclusion flags ({len(self.inputs.include)}) does not match "
+                             f"number of pipelines ({len(self.inputs.pipeline)})")
+        groups = {}
+        for i, pipeline in enumerate(self.inputs.pipeline):
+            if isdefined(self.inputs.include) and not self.inputs.include[i]:
+                logger.info(f"Denoising of excluded subject with pipeline {pipeline['name']} skipped")
+                continue
+            fmri_file = select_fmri_file(pipeline, self.inputs.fmri_prep, self.inputs.fmri_prep_aroma)
+            groups.setdefault(fmri_file, []).append(i)
+        return groups
+
+    def _output_path(self, entities: dict, pipeline: dict, pattern: str, atlas: str = DEFAULT_ATLAS) -> str:
+        path = join(self.inputs.output_dir, build_path({**atlas_entities(entities, atlas), 'pipeline': pipeline['name']},
+                                                       pattern, False))
+        assert not exists(path), f"Denoising is run twice with result {path}"
+        return path
+
+    def _projector(self, index: int, n_volumes: int, kwargs: dict) -> np.ndarray:
+        sample_mask = self.inputs.sample_mask[index] if isdefined(self.inputs.sample_mask) else None
+        cache_dir = self.inputs.projector_cache if isdefined(self.inputs.projector_cache) else None
+        return pipeline_projector(self.inputs.conf_prep[index], n_volumes, kwargs, sample_mask, cache_dir)
+
+    def _denoise_voxels(self, img: nb.Nifti1Image, entities: dict, indices: t.List[int], kwargs: dict) -> None:
+        projectors = [self._projector(i, img.shape[-1], kwargs) for i in indices]
+        out_files = [self._output_path(entities, self.inputs.pipeline[i],
+                                       nifti_path(self.fmri_denoised_pattern, self.inputs.compress_level))
+                     for i in indices] if self.inputs.save_denoised_bold else None
+        time_series, mem_peak = denoise_img_atlases(
+            img.get_filename(), projectors,
+            [parcellation_labels(img, entities['space'], atlas) for atlas in self.inputs.atlases],
+            self.inputs.mem_mb, dtype=self.inputs.precision, out_files=out_files,
+            compress_level=self.inputs.compress_level, n_threads=self.inputs.compress_threads)
+        logger.info(f"Denoised {img.get_filename()} with {len(indices)} pipelines with "
+                    f"peak of {mem_peak / 2 ** 20:.0f} MB allocated")
+        self._mem_peak = max(self._mem_peak, mem_peak)
+        for j, i in enumerate(indices):
+            for atlas, atlas_time_series in zip(self.inputs.atlases, time_series):
+                time_series_file = self._output_path(entities, self.inputs.pipeline[i], self.time_series_pattern,
+                                                     atlas)
+                np.save(time_series_file, atlas_time_series[j])
+                self._time_series[i].append(time_series_file)
+            if out_files:
+                self._fmri_denoised[i] = out_files[j]
+
+    def _denoise_parcels(self, img: nb.Nifti1Image, entities: dict, indices: t.List[int], kwargs: dict) -> None:
+        signals, mem_peak = parcel_means_blockwise(
+            img.get_filename(), [parcellation_labels(img, entities['space'], atlas) for atlas in self.inputs.atlases],
+            self.inputs.mem_mb, dtype=self.inputs.precision)
+        logger.info(f"Averaged {img.get_filename()} within parcels with peak of {mem_peak / 2 ** 20:.0f} MB "
+                    f"allocated")
+        self._mem_peak = max(self._mem_peak, mem_peak)
+        for i in indices:
+            projector = self._projector(i, img.shape[-1], kwargs)
+            for atlas, atlas_signals in zip(self.inputs.atlases, signals):
+                time_series = apply_projector(atlas_signals, projector)
+                time_series_file = self._output_path(entities, self.inputs.pipeline[i], self.time_series_pattern,
+                                                     atlas)
+                np.save(time_series_file, time_series.astype(self.inputs.precision))
+                self._time_series[i].append(time_series_file)
+
+    def _run_interface(self, runtime):
+        self._fmri_denoised = [None] * len(self.inputs.pipeline)
+        self._time_series = [[] for _ in self.inputs.pipeline]
+        self._mem_peak = 0
+        for fmri_file, indices in self._group_by_fmri_file().items():
+            entities = parse_file_entities(fmri_file)
+            kwargs = filtering_kwargs(
+                self.inputs.low_pass, self.inputs.high_pass, self.inputs.tr_dict, entities['task'])
+            img = nb.load(fmri_file)
+            if self.inputs.denoise_space == 'parcels':
+                self._denoise_parcels(img, entities, indices, kwargs)
+            else:
+                self._denoise_voxels(img, entities, indices, kwargs)
+        self._results['time_series'] = [path for paths in self._time_series for path in paths]
+        if self.inputs.denoise_space == 'voxels' and self.inputs.save_denoised_bold:
+            self._results['fmri_denoised'] = [path for path in self._fmri_denoised if path is not None]
+        self._results['mem_peak_mb'] = self._mem_peak / 2 ** 20
         return runtime
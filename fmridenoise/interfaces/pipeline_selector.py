@@ -1,6 +1,7 @@
-from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec
+from nipype.interfaces.base import SimpleInterface, BaseInterfaceInputSpec, TraitedSpec, isdefined
 from traits.trait_types import List, Dict, File, Str, Float, Bool
-from fmridenoise.pipelines import load_pipeline_from_json
+from fmridenoise.pipelines import load_pipeline_from_json, extract_pipeline_from_path
+from fmridenoise.utils.entities import parse_file_entities_with_pipelines
 from fmridenoise.utils.json_validator import is_valid
 import os
 
@@ -31,6 +32,52 @@ class PipelineSelector(SimpleInterface):
 
         return runtime
 
+class SelectPipelineFileInputSpecification(BaseInterfaceInputSpec):
+    pipeline = Dict(
+        mandatory=True,
+        desc="Pipeline for which file is selected")
+    in_files = List(
+        File(exists=True),
+        mandatory=True,
+        desc="Files created for multiple pipelines")
+    atlas = Str(
+        mandatory=False,
+        desc="Atlas entity of selected file, if undefined file without atlas entity is selected")
+    allow_missing = Bool(
+        False,
+        usedefault=True,
+        desc="Leave out_file undefined if no file is found (e.g. denoising skipped for excluded subject)")
+
+
+class SelectPipelineFileOutPutSpecification(TraitedSpec):
+    out_file = File(
+        exists=True,
+        desc="File created for selected pipeline")
+
+
+class SelectPipelineFile(SimpleInterface):
+    """
+    Selects single file created for given pipeline (based on pipeline entity in filename)
+    and atlas (based on atlas entity) from list of files. Used to split output of node
+    joined over pipelines back into pipeline (and atlas) iterables.
+    """
+    input_spec = SelectPipelineFileInputSpecification
+    output_spec = SelectPipelineFileOutPutSpecification
+
+    def _run_interface(self, runtime):
+        atlas = self.inputs.atlas if isdefined(self.inputs.atlas) else None
+        selected = [path for path in self.inputs.in_files
+                    if extract_pipeline_from_path(os.path.basename(path)) == self.inputs.pipeline['name']
+                    and parse_file_entities_with_pipelines(path).get('atlas') == atlas]
+        if not selected and self.inputs.allow_missing:
+            return runtime
+        if len(selected) != 1:
+            raise ValueError(f"Expected exactly one file for pipeline {self.inputs.pipeline['name']} "
+                             f"and atlas {atlas} but found {len(selected)} in {self.inputs.in_files}")
+        self._results['out_file'] = selected[0]
+        return runtime
+
+
 # rudimentary test # TODO: Move to this to proper unittests
 if __name__ == '__main__':
     from nipype import Node
@@ -1,28 +1,32 @@
 from nipype.interfaces.base import (
-    BaseInterfaceInputSpec, TraitedSpec, SimpleInterface, Str, File, traits)
+    BaseInterfaceInputSpec, TraitedSpec, SimpleInterface, Str, File, traits, isdefined)
 import typing as t
 import numpy as np
 import pandas as pd
-from nilearn.connectome import sym_matrix_to_vec, vec_to_sym_matrix
-from scipy.stats import pearsonr, spearmanr
+from nilearn.connectome import vec_to_sym_matrix
 from os.path import join
 import warnings
 
 from traits.trait_base import Undefined, _Undefined
 from traits.trait_types import List, Int, Instance, Dict
 
+from fmridenoise.utils.connectome import load_group_connectome
 from fmridenoise.utils.dataclasses.excluded_subjects import ExcludedSubjects
 from fmridenoise.utils.entities import build_path, parse_file_entities_with_pipelines, assert_all_entities_equal
 from fmridenoise.utils.plotting import (make_motion_plot, make_kdeplot,
                                         make_catplot, make_violinplot, make_corr_matrix_plot)
 from fmridenoise.utils.error_data import ErrorData
+from fmridenoise.parcellation import DistanceRanks, load_distance_ranks
+from fmridenoise.utils.numeric import pearsonr_columns, normalized_ranks, column_means
+from fmridenoise.utils.permutations import max_abs_correlation_null, fwe_corrected_pvalues
+from fmridenoise.utils.bootstrap import bootstrap_fc_fd_measures, confidence_interval, ci_columns
 from fmridenoise.utils.traits import Optional
 
 
 class QualityMeasuresInputSpec(BaseInterfaceInputSpec):
     group_corr_mat = File(exists=True,
-                          desc='Group connectivity matrix',
-                          mandatory=True)
+                          desc='Group connectivity matrix (subjects x edges), can be undefined only if '
+                               'all_subjects is False and all subjects are excluded')
 
     group_conf_summary = File(exists=True,
                               desc='Group confounds summmary',
@@ -37,6 +41,23 @@ class QualityMeasuresInputSpec(BaseInterfaceInputSpec):
     pipeline = traits.Dict(mandatory=True,
                            desc="Pipeline")
 
+    n_permutations = traits.Int(0, usedefault=True,
+                                desc="Number of FD permutations for family-wise error corrected percent of "
+                                     "significant FC-FD correlations, 0 disables permutations")
+
+    n_bootstrap = traits.Int(0, usedefault=True,
+                             desc="Number of bootstrap samples (subjects resampled with replacement) for "
+                                  "confidence intervals of quality measures, 0 disables bootstrap")
+
+    n_procs = traits.Int(1, usedefault=True,
+                         desc="Number of processes calculating permutations (and threads calculating bootstrap "
+                              "samples)")
+
+    all_subjects = traits.Bool(True, usedefault=True,
+                               desc="Calculate quality measures for all subjects (beside subjects without high "
+                                    "motion), otherwise group connectivity matrix may contain only included "
+                                    "subjects (connectomes of excluded subjects are not created)")
+
 
 class QualityMeasuresOutputSpec(TraitedSpec):
     fc_fd_summary = traits.List(
@@ -91,7 +112,7 @@ class QualityMeasuresOutputSpec(TraitedSpec):
 class QualityMeasures(SimpleInterface):
     input_spec = QualityMeasuresInputSpec
     output_spec = QualityMeasuresOutputSpec
-    plot_pattern = "[ses-{session}_]task-{task}_[run-{run}_]pipeline-{pipeline}_desc-{desc}.svg"
+    plot_pattern = "[ses-{session}_]task-{task}_[run-{run}_][atlas-{atlas}_]pipeline-{pipeline}_desc-{desc}.svg"
     pval_tresh = 0.05
 
     def _validate_group_conf_summary(self, group_conf_summary: pd.DataFrame):
@@ -107,7 +128,7 @@ class QualityMeasures(SimpleInterface):
             # Checks if data frame contains proper columns
             # confounds_fields - from confound output definition
         all_possible_fields = {'subject', 'task', 'session', 'mean_fd', 'max_fd', 'n_conf', 'include', 'n_spikes',
-                               'perc_spikes', 'run'}
+                               'perc_spikes', 'n_censored', 'run'}
         mandatory_fields = {'subject', 'task', 'mean_fd', 'max_fd', 'n_conf', 'include'}
         provided_fields = set(group_conf_summary.columns)
         excess_fields = provided_fields - all_possible_fields
@@ -169,27 +190,47 @@ class QualityMeasures(SimpleInterface):
         """
         return np.sum(fc_fd_pval < cls.pval_tresh) / len(fc_fd_pval) * 100
 
+    @classmethod
+    def _perc_fc_fd_fwe(cls, fc_fd_corr: np.ndarray, group_conf_summary: pd.DataFrame, group_corr_vec: np.ndarray,
+                        n_permutations: int, n_procs: int, rows: t.Optional[np.ndarray] = None) -> float:
+        """
+        Calculates percent of significant FC-FD correlations with family-wise
+        error controlled by max-statistic permutation test (mean FD permuted
+        across subjects).
+        """
+        null = max_abs_correlation_null(group_corr_vec, group_conf_summary['mean_fd'].values,
+                                        n_permutations, n_procs, rows=rows)
+        return cls._perc_fc_fd_uncorr(fwe_corrected_pvalues(fc_fd_corr, null))
+
     @staticmethod
-    def _distance_dependence(fc_fd_corr: np.ndarray, distance_vector: np.ndarray) -> float:
+    def _distance_dependence(fc_fd_corr: np.ndarray, distance_ranks: np.ndarray) -> float:
         """
-        Calculates percent of significant FC-FD correlations (uncorrected).
+        Calculates Spearman correlation between FC-FD correlations and distance
+        given by its precomputed normalized ranks.
         """
-        return spearmanr(a=fc_fd_corr, b=distance_vector)[0]
+        return normalized_ranks(fc_fd_corr) @ distance_ranks
+
+    @staticmethod
+    def _tdof_loss(group_conf_summary: pd.DataFrame) -> float:
+        """
+        Calculates mean loss of temporal degrees of freedom: number of confounds
+        and number of censored volumes (if any volumes are censored).
+        """
+        tdof_loss = group_conf_summary['n_conf']
+        if 'n_censored' in group_conf_summary:
+            tdof_loss = tdof_loss + group_conf_summary['n_censored'].fillna(0)
+        return tdof_loss.mean()
 
     @staticmethod
     def calculate_fc_fd_correlations(group_conf_summary: pd.DataFrame,
-                                     group_corr_vec: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+                                     group_corr_vec: np.ndarray,
+                                     rows: t.Optional[np.ndarray] = None) -> t.Tuple[np.ndarray, np.ndarray]:
         """
         Calculates correlations between edges weights and mean framewise displacement.
+        Rows of group_corr_vec (subjects of group_conf_summary) can be selected by index rows.
         """
         assert not group_corr_vec.size == 0, "Empty arguments in calculate_fc_fd_correlations"
-        n_edges = group_corr_vec.shape[1]
-        fc_fd_corr, fc_fd_pval = np.zeros(n_edges), np.zeros(n_edges)
-        fd = group_conf_summary['mean_fd'].values
-        for i in range(n_edges):
-            fc = group_corr_vec[:, i]
-            corr = pearsonr(x=fc, y=fd)
-            fc_fd_corr[i], fc_fd_pval[i] = corr
+        fc_fd_corr, fc_fd_pval = pearsonr_columns(group_corr_vec, group_conf_summary['mean_fd'].values, rows)
 
         if np.isnan(fc_fd_corr).any():
             fc_fd_corr = np.nan_to_num(fc_fd_corr)
@@ -200,16 +241,26 @@ class QualityMeasures(SimpleInterface):
     @classmethod
     def _quality_measure(cls,
                          group_conf_summary: pd.DataFrame,
-                         distance_vec: np.ndarray,
+                         distance_ranks: np.ndarray,
                          group_corr_vec: np.ndarray,
-                         all_subjects: bool) -> t.Tuple[dict, np.ndarray, np.ndarray, t.List[str]]:
+                         all_subjects: bool,
+                         n_permutations: int = 0,
+                         n_bootstrap: int = 0,
+                         n_procs: int = 1) -> t.Tuple[dict, np.ndarray, np.ndarray, t.List[str]]:
         """
         Calculates
         Args:
             group_conf_summary: Conf summary for all subjects
-            distance_vec: Distance matrix flatten into vector
-            group_corr_vec:
+            distance_ranks: Normalized ranks of distance matrix flatten into vector
+            group_corr_vec: edges weights (subjects x edges), can be memory mapped (it is read in chunks
+                of edges, rows of subjects without high motion are selected chunk by chunk), for 'low motion'
+                subjects it can contain only rows of included subjects
             all_subjects: True if all subjects should be included, False if only 'low motion' subjects
+            n_permutations: number of permutations for family-wise error corrected percent of significant
+                FC-FD correlations (included in summary if greater than 0)
+            n_bootstrap: number of bootstrap samples for confidence intervals of FC-FD measures (included in
+                summary as <measure>_ci_low and <measure>_ci_high if greater than 0)
+            n_procs: number of processes calculating permutations and threads calculating bootstrap samples
 
         Returns:
            Tuple with:
@@ -221,87 +272,126 @@ class QualityMeasures(SimpleInterface):
         # select part of original dataset based on 'Include' parameter (all subjects or without high motion
         if all_subjects:
             group_conf_subsummary = group_conf_summary
-            group_corr_subvec = group_corr_vec
+            rows = None
         else:
             group_conf_subsummary = group_conf_summary[
                 group_conf_summary['include'] == True]
-            group_corr_subvec = group_corr_vec[group_conf_summary['include'].values.astype(bool), :]
+            rows = np.flatnonzero(group_conf_summary['include'].values.astype(bool)) \
+                if len(group_corr_vec) == len(group_conf_summary) else None
 
-        fc_fd_corr, fc_fd_pval = cls.calculate_fc_fd_correlations(group_conf_subsummary, group_corr_subvec)
+        fc_fd_corr, fc_fd_pval = cls.calculate_fc_fd_correlations(group_conf_subsummary, group_corr_vec, rows)
         summary = {'perc_fc_fd_uncorr': cls._perc_fc_fd_uncorr(fc_fd_pval),
                    'median_pearson_fc_fd': np.median(np.abs(fc_fd_corr)),
-                   'distance_dependence': cls._distance_dependence(fc_fd_corr, distance_vec),
+                   'distance_dependence': cls._distance_dependence(fc_fd_corr, distance_ranks),
 
-                   'tdof_loss': group_conf_subsummary['n_conf'].mean(),
+                   'tdof_loss': cls._tdof_loss(group_conf_subsummary),
                    'n_subjects': len(group_conf_summary),
                    'n_excluded': len(group_conf_summary) - len(group_conf_subsummary),
                    'all': all_subjects,
                    }
-        edges_weight = group_corr_subvec.mean(axis=0)
+        if n_permutations > 0:
+            summary['perc_fc_fd_fwe'] = cls._perc_fc_fd_fwe(fc_fd_corr, group_conf_subsummary, group_corr_vec,
+                                                            n_permutations, n_procs, rows)
+        if n_bootstrap > 0 and len(group_conf_subsummary) >= 3:
+            samples = bootstrap_fc_fd_measures(group_corr_vec, group_conf_subsummary['mean_fd'].values,
+                                               distance_ranks, n_bootstrap, cls.pval_tresh, n_procs, rows=rows)
+            for measure, measure_samples in samples.items():
+                low, high = ci_columns(measure)
+                summary[low], summary[high] = confidence_interval(measure_samples)
+        edges_weight = column_means(group_corr_vec, rows)
         excluded_subjects = group_conf_summary[group_conf_summary['include'] == False]['subject']
         return summary, edges_weight, fc_fd_corr, excluded_subjects
 
     def _calculate_quality_measures(
             self,
             group_conf_summary: pd.DataFrame,
-            group_corr_mat: np.ndarray,
-            distance_matrix: np.ndarray) -> \
+            group_corr_vec: np.ndarray,
+            distance_ranks: DistanceRanks) -> \
             t.Tuple[t.List[dict], np.ndarray, np.ndarray, np.ndarray, np.ndarray, t.Set[str]]:
         quality_measures = []
-        excluded_subjects_names = set()
-        group_corr_vec = sym_matrix_to_vec(group_corr_mat)
-        distance_vec = sym_matrix_to_vec(distance_matrix)
-        # all subjects
-        summary, edges_weight, fc_fd_corr_vector, excluded_subjects = self._quality_measure(
-            group_conf_summary,
-            distance_vec,
-            group_corr_vec, True)
-        quality_measures.append(summary)
-        excluded_subjects_names |= set(excluded_subjects)
+        excluded_subjects_names = set(group_conf_summary[group_conf_summary['include'] == False]['subject'])
+        edges_weight = Undefined
+        fc_fd_corr_vector = Undefined
+        if self.inputs.all_subjects:
+            summary, edges_weight, fc_fd_corr_vector, _ = self._quality_measure(
+                group_conf_summary,
+                distance_ranks.normalized_ranks,
+                group_corr_vec, True, self.inputs.n_permutations, self.inputs.n_bootstrap, self.inputs.n_procs)
+            quality_measures.append(summary)
         edges_weight_clean = Undefined
         fc_fd_corr_vector_clean = Undefined
         if self._enough_clean_subjects:
             # clean subjects (no high motion)
-            summary, edges_weight_clean, fc_fd_corr_vector_clean, excluded_subjects = self._quality_measure(
-                group_conf_summary, distance_vec, group_corr_vec, False)
+            summary, edges_weight_clean, fc_fd_corr_vector_clean, _ = self._quality_measure(
+                group_conf_summary, distance_ranks.normalized_ranks, group_corr_vec, False, self.inputs.n_permutations,
+                self.inputs.n_bootstrap, self.inputs.n_procs)
             quality_measures.append(summary)
-            excluded_subjects_names |= set(excluded_subjects)
         return quality_measures, edges_weight, edges_weight_clean, fc_fd_corr_vector, fc_fd_corr_vector_clean, \
             excluded_subjects_names
 
+    def _all_excluded(self, group_conf_summary: pd.DataFrame) -> None:
+        """
+        Sets outputs when no group connectivity matrix is given (connectomes
+        of excluded subjects were not created and all subjects are excluded).
+        """
+        if self.inputs.all_subjects or group_conf_summary['include'].any():
+            raise ValueError("Group connectivity matrix is required unless all subjects are excluded "
+                             "and all_subjects is False")
+        base_entities = parse_file_entities_with_pipelines(self.inputs.group_conf_summary)
+        self._results['fc_fd_summary'] = []
+        self._results['excluded_subjects'] = ExcludedSubjects(
+            pipeline_name=self.inputs.pipeline['name'],
+            task=base_entities.get('task'),
+            session=base_entities.get('session'),
+            run=base_entities.get('run'),
+            excluded=set(group_conf_summary['subject'])
+        )
+
     def _run_interface(self, runtime):
+        if not isdefined(self.inputs.group_corr_mat):
+            group_conf_summary_df = pd.read_csv(self.inputs.group_conf_summary, sep='\t', header=0)
+            self._validate_group_conf_summary(group_conf_summary_df)
+            self._all_excluded(group_conf_summary_df)
+            return runtime
         # noinspection PyUnreachableCode
         if __debug__:
             entities = [parse_file_entities_with_pipelines(self.inputs.group_conf_summary),
                         parse_file_entities_with_pipelines(self.inputs.group_corr_mat)]
             assert_all_entities_equal(entities, "session", "run", "task", "pipeline")
+        atlas = parse_file_entities_with_pipelines(self.inputs.group_corr_mat).get('atlas')
         group_conf_summary_df = pd.read_csv(self.inputs.group_conf_summary, sep='\t', header=0)
-        group_corr_mat_arr = np.load(self.inputs.group_corr_mat)
-        distance_matrix_arr = np.load(self.inputs.distance_matrix)
+        group_corr_vec_arr = load_group_connectome(self.inputs.group_corr_mat, mmap_mode='r')
         self._validate_group_conf_summary(group_conf_summary_df)
+        if len(group_corr_vec_arr) != len(group_conf_summary_df) and (
+                self.inputs.all_subjects or len(group_corr_vec_arr) != group_conf_summary_df['include'].sum()):
+            raise ValueError(f"Group connectivity matrix has {len(group_corr_vec_arr)} subjects, expected all "
+                             f"{len(group_conf_summary_df)} subjects of group confounds summary"
+                             f"{'' if self.inputs.all_subjects else ' or its included subjects'}")
 
         summaries, edges_weight, edges_weight_clean, group_corr_vec, group_corr_vec_clean, exclude_list = \
             self._calculate_quality_measures(
                 group_conf_summary_df,
-                group_corr_mat_arr,
-                distance_matrix_arr)
+                group_corr_vec_arr,
+                load_distance_ranks(self.inputs.distance_matrix))
         pipeline_name = self.inputs.pipeline['name']
         for summary in summaries:
             summary['pipeline'] = pipeline_name
         # creating plots
-        base_entities = parse_file_entities_with_pipelines(self.inputs.group_conf_summary)
+        base_entities = {**parse_file_entities_with_pipelines(self.inputs.group_conf_summary), 'atlas': atlas}
         motion_plot_path = join(self.inputs.output_dir, build_path({**base_entities,
                                                                     'desc': 'motionCriterion_plot'},
                                                                    self.plot_pattern, strict=False))
         make_motion_plot(group_conf_summary_df, motion_plot_path)
-        corr_matrix_plot = build_path({**base_entities,
-                                       'desc': 'fcFdCorrMatrix_plot'},
-                                      self.plot_pattern, strict=False)
-        corr_matrix_plot = make_corr_matrix_plot(
-            data=vec_to_sym_matrix(group_corr_vec),
-            title=corr_matrix_plot.strip('.svg'),
-            ylabel=base_entities['pipeline'],
-            output_path=join(self.inputs.output_dir, corr_matrix_plot))
+        corr_matrix_plot = Undefined
+        if group_corr_vec is not Undefined:
+            corr_matrix_plot = build_path({**base_entities,
+                                           'desc': 'fcFdCorrMatrix_plot'},
+                                          self.plot_pattern, strict=False)
+            corr_matrix_plot = make_corr_matrix_plot(
+                data=vec_to_sym_matrix(group_corr_vec),
+                title=corr_matrix_plot.strip('.svg'),
+                ylabel=base_entities['pipeline'],
+                output_path=join(self.inputs.output_dir, corr_matrix_plot))
         corr_matrix_plot_no_high_motion = Undefined
         if self._enough_clean_subjects:
             corr_matrix_plot_no_high_motion = build_path(
@@ -315,10 +405,12 @@ class QualityMeasures(SimpleInterface):
                 output_path=join(self.inputs.output_dir, corr_matrix_plot_no_high_motion))
         # setting output values
         self._results['fc_fd_summary'] = summaries
-        self._results['edges_weight'] = {pipeline_name: edges_weight}
+        if edges_weight is not Undefined:
+            self._results['edges_weight'] = {pipeline_name: edges_weight}
         if edges_weight_clean is not Undefined:
             self._results['edges_weight_clean'] = {pipeline_name: edges_weight_clean}
-        self._results['fc_fd_corr_values'] = {pipeline_name: group_corr_vec}
+        if group_corr_vec is not Undefined:
+            self._results['fc_fd_corr_values'] = {pipeline_name: group_corr_vec}
         if group_corr_vec_clean is not Undefined:
             self._results['fc_fd_corr_values_clean'] = {pipeline_name: group_corr_vec_clean}
         self._results['excluded_subjects'] = ExcludedSubjects(
@@ -345,11 +437,13 @@ class PipelinesQualityMeasuresInputSpec(BaseInterfaceInputSpec):
     )
 
     fc_fd_corr_values = traits.List(
-        traits.Dict(
-            exists=True,
-            desc='Pearson r values for correlation '
-                 'between FD and FC calculated for each edge'),
-        desc="Pearson r values for correlation for each pipeline"
+        Optional(
+            Dict(
+                exists=True,
+                desc='Pearson r values for correlation '
+                     'between FD and FC calculated for each edge')),
+        desc="Pearson r values for correlation for each pipeline (undefined if quality measures for all "
+             "subjects were not calculated)"
     )
     fc_fd_corr_values_clean = traits.List(
         Optional(
@@ -361,10 +455,11 @@ class PipelinesQualityMeasuresInputSpec(BaseInterfaceInputSpec):
         desc="Pearson r values for correlation for each pipeline (no high motion)"
     )
     edges_weight = traits.List(
-        Dict(
-            mandatory=True,
-            desc="Weights of individual edges"),
-        desc="Mean weights of individual edges for each pipeline"
+        Optional(
+            Dict(
+                desc="Weights of individual edges")),
+        desc="Mean weights of individual edges for each pipeline (undefined if quality measures for all "
+             "subjects were not calculated)"
     )
 
     edges_weight_clean = traits.List(
@@ -378,6 +473,8 @@ class PipelinesQualityMeasuresInputSpec(BaseInterfaceInputSpec):
     task = Str(mandatory=True)
     session = Str(mandatory=False)
     run = Int(mandatory=False)
+    atlas = Str(mandatory=False,
+                desc="Atlas entity of quality measures, undefined for default atlas")
 
     output_dir = File(
         desc="Output path")
@@ -440,8 +537,8 @@ class PipelinesQualityMeasuresOutputSpec(TraitedSpec):
 class PipelinesQualityMeasures(SimpleInterface):
     input_spec = PipelinesQualityMeasuresInputSpec
     output_spec = PipelinesQualityMeasuresOutputSpec
-    plot_pattern = "[ses-{session}_]task-{task}_[run-{run}_]desc-{desc}_plot.svg"
-    data_files_pattern = '[ses-{session}_]task-{task}[_run-{run}][_desc-{desc}]_{suffix}.{extension}'
+    plot_pattern = "[ses-{session}_]task-{task}_[run-{run}_][atlas-{atlas}_]desc-{desc}_plot.svg"
+    data_files_pattern = '[ses-{session}_]task-{task}[_run-{run}][_atlas-{atlas}][_desc-{desc}]_{suffix}.{extension}'
 
     @staticmethod
     def pipeline_summaries_to_dataframe(pipelines_fd_fd_summary_raw: t.List[t.List[t.Dict]]) -> pd.DataFrame:
@@ -466,7 +563,7 @@ class PipelinesQualityMeasures(SimpleInterface):
 
     @staticmethod
     def edges_weight_to_dataframe(
-            edges_weight: t.List[t.Dict[str, np.ndarray]],
+            edges_weight: t.List[t.Union[_Undefined, t.Dict[str, np.ndarray]]],
             edges_weight_clean: t.List[t.Union[_Undefined, t.Dict[str, np.ndarray]]]) -> t.Tuple[
         pd.DataFrame, pd.DataFrame]:
         """
@@ -483,21 +580,21 @@ class PipelinesQualityMeasures(SimpleInterface):
         pipelines_edges_weight_clean = pd.DataFrame()
 
         for edges, edges_clean in zip(edges_weight, edges_weight_clean):
-            pipeline_name = list(edges.keys())[0]
-            pipelines_edges_weight = pd.concat([pipelines_edges_weight,
-                                                pd.DataFrame(edges,
-                                                             columns=[pipeline_name])],
-                                               axis=1)
+            if edges is not Undefined:
+                pipelines_edges_weight = pd.concat([pipelines_edges_weight,
+                                                    pd.DataFrame(edges,
+                                                                 columns=list(edges.keys()))],
+                                                   axis=1)
             if edges_clean is not Undefined:
                 pipelines_edges_weight_clean = pd.concat([pipelines_edges_weight_clean,
                                                           pd.DataFrame(edges_clean,
-                                                                       columns=[pipeline_name])],
+                                                                       columns=list(edges_clean.keys()))],
                                                          axis=1)
         return pipelines_edges_weight, pipelines_edges_weight_clean
 
     @staticmethod
     def fc_fd_corr_values_to_dataframe(
-            fc_fd_corr_values: t.List[t.Dict[str, np.ndarray]],
+            fc_fd_corr_values: t.List[t.Union[_Undefined, t.Dict[str, np.ndarray]]],
             fc_fd_corr_values_clean: t.List[t.Union[_Undefined, t.Dict[str, np.ndarray]]]) -> t.Tuple[
         pd.DataFrame, pd.DataFrame]:
         """
@@ -514,40 +611,47 @@ class PipelinesQualityMeasures(SimpleInterface):
         pipelines_fc_fd_values_clean = pd.DataFrame()
 
         for corr, corr_clean in zip(fc_fd_corr_values, fc_fd_corr_values_clean):
-            pipeline_name = list(corr.keys())[0]
-            pipelines_fc_fd_values = pd.concat([pipelines_fc_fd_values,
-                                                pd.DataFrame(corr,
-                                                             columns=[pipeline_name])],
-                                               axis=1)
+            if corr is not Undefined:
+                pipelines_fc_fd_values = pd.concat([pipelines_fc_fd_values,
+                                                    pd.DataFrame(corr,
+                                                                 columns=list(corr.keys()))],
+                                                   axis=1)
             if corr_clean is not Undefined:
                 pipelines_fc_fd_values_clean = pd.concat([pipelines_fc_fd_values_clean,
                                                           pd.DataFrame(corr_clean,
-                                                                       columns=[pipeline_name])],
+                                                                       columns=list(corr_clean.keys()))],
                                                          axis=1)
         return pipelines_fc_fd_values, pipelines_fc_fd_values_clean
 
     def _make_summary_figures(self, entities_dict: dict) -> None:
         """
-        Makes summary figures for all quality measures
+        Makes summary figures for all quality measures, figures for all subjects
+        are omitted if quality measures for all subjects were not calculated
         """
-        path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'pipelinesEdgesDensity'},
-                                                       self.plot_pattern, strict=False))
-        self.plot_pipelines_edges_density = make_kdeplot(data=self.pipelines_edges_weight,
-                                                         title="Density of edge weights (all subjects)",
-                                                         output_path=path)
+        all_subjects = self.pipelines_fc_fd_summary[self.pipelines_fc_fd_summary['all'] == True]
+        self.plot_pipelines_edges_density = Undefined
+        self.plot_fc_fd_pearson = Undefined
+        self.plot_distance_dependence = Undefined
+        if not self.pipelines_edges_weight.empty:
+            path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'pipelinesEdgesDensity'},
+                                                           self.plot_pattern, strict=False))
+            self.plot_pipelines_edges_density = make_kdeplot(data=self.pipelines_edges_weight,
+                                                             title="Density of edge weights (all subjects)",
+                                                             output_path=path)
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'pipelinesEdgesDensityNoHighMotion'},
                                                        self.plot_pattern, strict=False))
         self.plot_pipelines_edges_density_clean = make_kdeplot(data=self.pipelines_edges_weight_clean,
                                                                title="Density of edge weights (no high motion)",
                                                                output_path=path)
-        path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'fcFdPearson'},
-                                                       self.plot_pattern, strict=False))
-        self.plot_fc_fd_pearson = make_catplot(x="median_pearson_fc_fd",
-                                               y='pipeline',
-                                               data=self.pipelines_fc_fd_summary[
-                                                   self.pipelines_fc_fd_summary['all'] == True],
-                                               xlabel="Median QC-FC (Pearson's r)",
-                                               output_path=path)
+        if not all_subjects.empty:
+            path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'fcFdPearson'},
+                                                           self.plot_pattern, strict=False))
+            self.plot_fc_fd_pearson = make_catplot(x="median_pearson_fc_fd",
+                                                   y='pipeline',
+                                                   data=all_subjects,
+                                                   xlabel="Median QC-FC (Pearson's r)",
+                                                   output_path=path,
+                                                   xerr=ci_columns("median_pearson_fc_fd"))
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'fcFdPearsonNoHighMotion'},
                                                        self.plot_pattern, strict=False))
         self.plot_fc_fd_pearson_no_high_motion = make_catplot(
@@ -555,7 +659,8 @@ class PipelinesQualityMeasures(SimpleInterface):
             y='pipeline',
             data=self.pipelines_fc_fd_summary[self.pipelines_fc_fd_summary['all'] == False],
             xlabel="Median QC-FC (Pearson's r) (no high motion)",
-            output_path=path)
+            output_path=path,
+            xerr=ci_columns("median_pearson_fc_fd"))
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'percFcFdUncorr'},
                                                        self.plot_pattern, strict=False))
         self.perc_plot_fc_fd_uncorr = make_catplot(x="perc_fc_fd_uncorr",
@@ -563,14 +668,15 @@ class PipelinesQualityMeasures(SimpleInterface):
                                                    data=self.pipelines_fc_fd_summary,
                                                    xlabel="QC-FC uncorrected (%)",
                                                    output_path=path)
-        path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'distanceDependence'},
-                                                       self.plot_pattern, strict=False))
-        self.plot_distance_dependence = make_catplot(x="distance_dependence",
-                                                     y='pipeline',
-                                                     data=self.pipelines_fc_fd_summary[
-                                                         self.pipelines_fc_fd_summary['all'] == True],
-                                                     xlabel="Distance-dependence",
-                                                     output_path=path)
+        if not all_subjects.empty:
+            path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'distanceDependence'},
+                                                           self.plot_pattern, strict=False))
+            self.plot_distance_dependence = make_catplot(x="distance_dependence",
+                                                         y='pipeline',
+                                                         data=all_subjects,
+                                                         xlabel="Distance-dependence",
+                                                         output_path=path,
+                                                         xerr=ci_columns("distance_dependence"))
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'distanceDependenceNoHighMotion'},
                                                        self.plot_pattern, strict=False))
         self.plot_distance_dependence_no_high_motion = make_catplot(
@@ -578,7 +684,8 @@ class PipelinesQualityMeasures(SimpleInterface):
             y='pipeline',
             data=self.pipelines_fc_fd_summary[self.pipelines_fc_fd_summary['all'] == False],
             xlabel="Distance-dependence (no high motion)",
-            output_path=path)
+            output_path=path,
+            xerr=ci_columns("distance_dependence"))
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'tdofLoss'},
                                                        self.plot_pattern, strict=False))
         self.plot_tdof_loss = make_catplot(x="tdof_loss",
@@ -586,11 +693,12 @@ class PipelinesQualityMeasures(SimpleInterface):
                                            data=self.pipelines_fc_fd_summary,
                                            xlabel="fDOF-loss",
                                            output_path=path)
-        path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'violinPlot'},
-                                                       self.plot_pattern, strict=False))
-        self.plot_violin_plot = make_violinplot(data=self.pipelines_fc_fd_values,
-                                                xlabel="fc_fd_correlation",
-                                                output_path=path)
+        if not self.pipelines_fc_fd_values.empty:
+            path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'violinPlot'},
+                                                           self.plot_pattern, strict=False))
+            self.plot_violin_plot = make_violinplot(data=self.pipelines_fc_fd_values,
+                                                    xlabel="fc_fd_correlation",
+                                                    output_path=path)
         path = join(self.inputs.output_dir, build_path({**entities_dict, 'desc': 'violinPlotNoHighMotion'},
                                                        self.plot_pattern, strict=False))
         self.plot_violin_plot = make_violinplot(data=self.pipelines_fc_fd_values_clean,
@@ -599,6 +707,8 @@ class PipelinesQualityMeasures(SimpleInterface):
 
     def _run_interface(self, runtime):
         self.pipelines_fc_fd_summary = self.pipeline_summaries_to_dataframe(self.inputs.fc_fd_summary)
+        if self.pipelines_fc_fd_summary.empty:
+            raise ValueError("No quality measures of any pipeline (all subjects excluded by all pipelines)")
         self.pipelines_edges_weight, self.pipelines_edges_weight_clean = self.edges_weight_to_dataframe(
             self.inputs.edges_weight, self.inputs.edges_weight_clean)
         self.pipelines_fc_fd_values, self.pipelines_fc_fd_values_clean = self.fc_fd_corr_values_to_dataframe(
@@ -608,6 +718,8 @@ class PipelinesQualityMeasures(SimpleInterface):
             self.entities_dict['run'] = self.inputs.run
         if self.inputs.session:
             self.entities_dict['session'] = self.inputs.session
+        if self.inputs.atlas:
+            self.entities_dict['atlas'] = self.inputs.atlas
         figures_entites = self.entities_dict.copy()
 
         self._make_summary_figures(figures_entites)
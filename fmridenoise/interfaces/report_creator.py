@@ -125,10 +125,11 @@ class ReportCreator(SimpleInterface):
                     and isinstance(plots_list, list)):
                 plots_pipeline[plots_type] = list(remove_undefined(plots_list))
 
+        # plots without atlas entity (default atlas) are grouped under atlas None
         unique_entities = set(
-            map(lambda path: frozendict(filter(
-                lambda pair: pair[0] in ['session', 'task', 'run'],
-                parse_file_entities_with_pipelines(path).items())),
+            map(lambda path: frozendict({'atlas': None, **dict(filter(
+                lambda pair: pair[0] in ['session', 'task', 'run', 'atlas'],
+                parse_file_entities_with_pipelines(path).items()))}),
                 chain(*chain(plots_all_pipelines.values(), plots_pipeline.values()))))
 
         unique_pipelines = set(pipeline['name'] for pipeline in self.inputs.pipelines)
@@ -139,25 +140,27 @@ class ReportCreator(SimpleInterface):
 
         for entity in unique_entities:
 
-            entity_data = {'entity_name': build_path(entity, "[ses-{session}] task-{task} [run-{run}]"),
-                           'entity_id': build_path(entity, "[ses-{session}-]task-{task}[-run-{run}]"),
+            entity_data = {'entity_name': build_path(entity, "[ses-{session}] task-{task} [run-{run}] [atlas-{atlas}]"),
+                           'entity_id': build_path(entity, "[ses-{session}-]task-{task}[-run-{run}][-atlas-{atlas}]"),
                            'excluded_subjects': set(),
                            'warnings': [],
                            'errors': [],
                            'pipeline': []}
+            # excluded subjects and warnings do not depend on atlas
+            entity_without_atlas = {key: value for key, value in entity.items() if key != 'atlas'}
             # Manage excluded subjects
             for excluded in self.inputs.excluded_subjects:
-                if is_entity_subset(excluded.entities, entity):
+                if is_entity_subset(excluded.entities, entity_without_atlas):
                     entity_data['excluded_subjects'] |= excluded.excluded
             entity_data['excluded_subjects'] = str(entity_data['excluded_subjects']).lstrip('{').rstrip(
                         '}') if len(entity_data['excluded_subjects']) > 1 else []
             # Manage errors and warnings
             for error in self.inputs.warnings:
-                if is_entity_subset(error.entities, entity):
-                    if error.critical:
-                        entity_data['errors'].append(error.build_message())
-                    else:
-                        entity_data['warnings'].append(error.build_message())
+                if is_entity_subset(error.entities, entity_without_atlas):
+                    messages = entity_data['errors'] if error.critical else entity_data['warnings']
+                    # the same warnings are reported for each atlas
+                    if error.build_message() not in messages:
+                        messages.append(error.build_message())
 
             # Manage plots for all_pipelines
             for plots_type, plots_list in plots_all_pipelines.items():
@@ -1,12 +1,21 @@
 from bids.layout import parse_file_entities
+import numpy as np
+import scipy
+from nipype import logging
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec, TraitedSpec,
-    ImageFile, SimpleInterface, Directory)
-from nibabel import load, save
-from nilearn.image import smooth_img
-from os.path import join, exists
+    ImageFile, SimpleInterface, Directory, traits, isdefined)
+from nipype.utils.filemanip import copyfile
+from nibabel import load
+from os.path import join, exists, basename
 from traits.trait_types import Bool
+from fmridenoise.utils.cache import FileCache, content_hash, file_hash, shared_file_cache
 from fmridenoise.utils.entities import build_path
+from fmridenoise.utils.nifti import COMPRESS_LEVEL_DEFAULT, nifti_path, save_img
+from fmridenoise.utils.smoothing import SMOOTHING_VERSION, smooth_img
+
+iflogger = logging.getLogger('nipype.interface')
+SMOOTHING_CACHE_GB_DEFAULT = 50
 
 
 class SmoothInputSpec(BaseInterfaceInputSpec):
@@ -19,6 +28,38 @@ class SmoothInputSpec(BaseInterfaceInputSpec):
     output_directory = Directory(
         exists=True,
     )
+    precision = traits.Enum(
+        'float64', 'float32',
+        usedefault=True,
+        desc='Floating point precision of smoothing, float32 forces single precision data and output image '
+             '(default float64 keeps data type handling of nilearn smooth_img)'
+    )
+    compress_level = traits.Range(
+        low=0, high=9,
+        value=COMPRESS_LEVEL_DEFAULT,
+        usedefault=True,
+        desc='Gzip compression level of smoothed fMRI file, 0 saves uncompressed .nii file'
+    )
+    compress_threads = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of threads compressing smoothed fMRI file'
+    )
+    n_threads = traits.Int(
+        1,
+        usedefault=True,
+        desc='Number of threads smoothing blocks of volumes'
+    )
+    cache_dir = Directory(
+        exists=True,
+        mandatory=False,
+        desc='Directory of persistent smoothing cache shared across workflow runs'
+    )
+    cache_gb = traits.Float(
+        SMOOTHING_CACHE_GB_DEFAULT,
+        usedefault=True,
+        desc='Maximal total size (in gigabytes) of smoothing cache'
+    )
 
 
 class SmoothOutputSpec(TraitedSpec):
@@ -28,18 +69,51 @@ class SmoothOutputSpec(TraitedSpec):
 
 
 class Smooth(SimpleInterface):
+    """ Smooth fMRI image with Gaussian kernel of fwhm millimeters.
+
+    Smoothing gives the same results as nilearn smooth_img (three separable
+    1D Gaussian passes), but blocks of volumes are smoothed in place by
+    n_threads threads (see fmridenoise.utils.smoothing.smooth_array).
+
+    If cache_dir is given, smoothed images are stored in persistent cache
+    (see fmridenoise.utils.cache.FileCache) keyed by content of input file,
+    kernel width, precision, smoothing version (SMOOTHING_VERSION) and scipy
+    version (its filters smooth images), so the same image is
+    smoothed only once across workflow runs and working directories. Cached
+    image is hard linked (or copied) to output_directory. Least recently used
+    images are evicted when cache exceeds cache_gb gigabytes.
+    """
     input_spec = SmoothInputSpec
     output_spec = SmoothOutputSpec
     smooth_file_pattern = "sub-{subject}[_ses-{session}]_task-{task}[_run-{run}]_space-{space}_desc-Smoothed_bold.nii.gz"
+    fwhm = 6
+
+    def _smooth(self, output_path: str) -> None:
+        smoothed = smooth_img(load(self.inputs.fmri_prep), self.fwhm, self.inputs.n_threads,
+                              dtype=np.float32 if self.inputs.precision == 'float32' else None)
+        save_img(smoothed, output_path, self.inputs.compress_level, self.inputs.compress_threads)
+
+    def _smooth_cached(self, output_path: str) -> None:
+        cache = shared_file_cache(FileCache, self.inputs.cache_dir, self.inputs.cache_gb * 2 ** 30)
+        key = content_hash('smooth', SMOOTHING_VERSION, scipy.__version__, file_hash(self.inputs.fmri_prep),
+                           self.fwhm, self.inputs.precision)
+        cached = cache.get(key, basename(output_path))
+        if cached is None:
+            cached = cache.put(key, basename(output_path), self._smooth)
+        copyfile(cached, output_path, copy=True, use_hardlink=True)
+        iflogger.info(f"Smoothing cache {self.inputs.cache_dir}: {cache.stats()}")
 
     def _run_interface(self, runtime):
         if exists(self.inputs.fmri_prep):
-            img = load(self.inputs.fmri_prep)
-            smoothed = smooth_img(img, fwhm=6)
             entities = parse_file_entities(self.inputs.fmri_prep)
-            output_path = join(self.inputs.output_directory, build_path(entities, self.smooth_file_pattern, False))
+            output_path = nifti_path(
+                join(self.inputs.output_directory, build_path(entities, self.smooth_file_pattern, False)),
+                self.inputs.compress_level)
             assert not exists(output_path), f"Smoothing is run twice at {output_path}"
-            save(smoothed, output_path)
+            if isdefined(self.inputs.cache_dir):
+                self._smooth_cached(output_path)
+            else:
+                self._smooth(output_path)
             self._results['fmri_smoothed'] = output_path
         elif self.inputs.is_file_mandatory:
             raise FileExistsError(f"Mandatory fMRI image file doesn't exists (input arg {self.inputs.fmri_prep})")
@@ -1,6 +1,20 @@
 import glob
+import os
+import re
+import typing as t
+from functools import lru_cache
 from os.path import dirname, join
 
+import nibabel as nb
+import numpy as np
+from nibabel.affines import apply_affine
+from nilearn.connectome import sym_matrix_to_vec
+from nilearn.image import resample_img
+from scipy.spatial.distance import cdist
+from scipy.stats import rankdata
+
+from fmridenoise.utils.numeric import normalized_ranks
+
 
 def get_parcellation_file_path(space: str) -> str:
     spaces = glob.glob(join(dirname(__file__), "*.nii.gz"))
@@ -12,8 +26,184 @@ def get_parcellation_file_path(space: str) -> str:
     return spaces[0]
 
 
+# --atlases keyword of shipped parcellation (selected by space of images),
+# other atlases are given as paths of parcellation files
+DEFAULT_ATLAS = 'default'
+
+
+def get_atlas_parcellation_file(atlas: str, space: str) -> str:
+    """Parcellation file of atlas (DEFAULT_ATLAS or parcellation file path)
+    for images in given space."""
+    return get_parcellation_file_path(space) if atlas == DEFAULT_ATLAS else atlas
+
+
+def get_atlas_name(parcellation_file: str) -> str:
+    """Atlas entities of parcellation file name shared by all files of the atlas
+    (e.g. atlas-Schaefer2018_desc-200Parcels7Networks)."""
+    match = re.search(r'atlas-[a-zA-Z0-9]+(_desc-[a-zA-Z0-9]+)?', os.path.basename(parcellation_file))
+    if match is None:
+        raise ValueError(f"Atlas entity not found in parcellation file name: {parcellation_file}")
+    return match.group(0)
+
+
+def get_atlas_label(atlas: str) -> t.Optional[str]:
+    """
+    Value of atlas entity of files created with atlas (DEFAULT_ATLAS or
+    parcellation file path) built from its atlas entities, e.g.
+    Schaefer2018desc400Parcels7Networks. Files created with default atlas
+    have no atlas entity (None).
+    """
+    if atlas == DEFAULT_ATLAS:
+        return None
+    return re.sub(r'[-_]', '', get_atlas_name(atlas)[len('atlas-'):])
+
+
+def get_atlas_full_name(atlas: str) -> str:
+    """Atlas entities (see get_atlas_name) of atlas (DEFAULT_ATLAS or
+    parcellation file path)."""
+    return get_atlas_name(get_distance_matrix_file_path() if atlas == DEFAULT_ATLAS else atlas)
+
+
 def get_distance_matrix_file_path() -> str:
     ret = glob.glob(join(dirname(__file__), "*.npy"))
     if len(ret) != 1:
         raise ValueError(f"Unexpected number of parcelation files ({len(ret)}) found. Expected single file.")
-    return ret[0]
\ No newline at end of file
+    return ret[0]
+
+
+def get_distance_ranks_file_path() -> str:
+    ret = glob.glob(join(dirname(__file__), "*.npz"))
+    if len(ret) != 1:
+        raise ValueError(f"Unexpected number of distance ranks files ({len(ret)}) found. Expected single file.")
+    return ret[0]
+
+
+def compute_distance_matrix(parcellation_file: str) -> np.ndarray:
+    """
+    Euclidean distances (in millimeters) between centroids of parcels,
+    ordered by label value (as parcels time series).
+    """
+    img = nb.load(parcellation_file)
+    labels = np.asarray(img.dataobj).astype(int)
+    voxels = np.nonzero(labels)
+    values, parcels = np.unique(labels[voxels], return_inverse=True)
+    n_parcels = len(values)
+    counts = np.bincount(parcels, minlength=n_parcels)
+    centroids = np.stack([np.bincount(parcels, weights=indices, minlength=n_parcels) / counts
+                          for indices in voxels], axis=1)
+    centroids = apply_affine(img.affine, centroids)
+    return cdist(centroids, centroids)
+
+
+def get_atlas_distance_matrix_file(atlas: str, output_dir: str) -> str:
+    """
+    Distance matrix file of atlas (DEFAULT_ATLAS or parcellation file path).
+    Distance matrix of shipped parcellation is shipped with it, matrices of
+    other atlases are computed (see compute_distance_matrix) and saved in
+    output_dir, unless already there.
+    """
+    if atlas == DEFAULT_ATLAS:
+        return get_distance_matrix_file_path()
+    distance_matrix_file = join(output_dir, f"{get_atlas_name(atlas)}_dseg_desc-distance-matrix.npy")
+    if not os.path.exists(distance_matrix_file):
+        np.save(distance_matrix_file, compute_distance_matrix(atlas))
+    return distance_matrix_file
+
+
+class DistanceRanks(t.NamedTuple):
+    """
+    Distance matrix flattened in the same way as connectivity matrices
+    (sym_matrix_to_vec) with its ranks and ranks centered and scaled to unit
+    norm, so Spearman correlation of any edge-wise vector with distance is a
+    dot product of its normalized ranks with normalized_ranks.
+    """
+    distance_vec: np.ndarray
+    ranks: np.ndarray
+    normalized_ranks: np.ndarray
+
+
+def compute_distance_ranks(distance_matrix: np.ndarray) -> DistanceRanks:
+    distance_vec = sym_matrix_to_vec(distance_matrix)
+    return DistanceRanks(distance_vec=distance_vec,
+                         ranks=rankdata(distance_vec),
+                         normalized_ranks=normalized_ranks(distance_vec))
+
+
+def save_distance_ranks(distance_matrix_file: str, output_file: str) -> None:
+    """
+    Precomputes distance ranks of distance matrix saved in .npy file (shipped
+    distance ranks file is created by this function).
+    """
+    np.savez_compressed(output_file, **compute_distance_ranks(np.load(distance_matrix_file))._asdict())
+
+
+@lru_cache(maxsize=4)
+def _load_distance_ranks(distance_matrix_file: str, modification_time: float) -> DistanceRanks:
+    if os.path.samefile(distance_matrix_file, get_distance_matrix_file_path()):
+        with np.load(get_distance_ranks_file_path()) as distance_ranks:
+            return DistanceRanks(**distance_ranks)
+    return compute_distance_ranks(np.load(distance_matrix_file))
+
+
+def load_distance_ranks(distance_matrix_file: str) -> DistanceRanks:
+    """
+    Loads distance ranks of distance matrix saved in .npy file. Ranks of
+    shipped distance matrix are read from precomputed file, ranks of other
+    matrices are computed. Results are cached, so each file is processed once
+    per process.
+    """
+    return _load_distance_ranks(distance_matrix_file, os.path.getmtime(distance_matrix_file))
+
+
+class ParcelIndex(t.NamedTuple):
+    """
+    Parcellation resampled to grid of image: labels image, flat (C order)
+    indices of voxels of all parcels sorted by label, label of each parcel
+    and position of its first voxel in voxels, so parcels means of image are
+    calculated with single np.add.reduceat pass over voxels of parcels.
+    Parcels are ordered by label value, as by NiftiLabelsMasker.
+    """
+    labels_img: np.ndarray
+    voxels: np.ndarray
+    labels: np.ndarray
+    starts: np.ndarray
+    counts: np.ndarray
+
+    def parcel_means(self, data: np.ndarray, dtype=np.float64) -> np.ndarray:
+        """
+        Averages 4D data (with spatial shape of labels_img) within parcels.
+        Sums are accumulated in double precision.
+
+        Returns:
+            Parcels time series (time points x parcels) in given precision.
+        """
+        if data.shape[:3] != self.labels_img.shape:
+            raise ValueError(f"Data of shape {data.shape} does not match parcellation of shape "
+                             f"{self.labels_img.shape}")
+        signals = data[np.unravel_index(self.voxels, self.labels_img.shape)]
+        sums = np.add.reduceat(signals, self.starts, axis=0, dtype=np.float64)
+        return (sums / self.counts[:, np.newaxis]).T.astype(dtype)
+
+
+@lru_cache(maxsize=8)
+def _parcel_index(parcellation_file: str, affine: bytes, shape: t.Tuple[int, int, int]) -> ParcelIndex:
+    labels_img = resample_img(parcellation_file, interpolation='nearest', target_shape=shape,
+                              target_affine=np.frombuffer(affine).reshape(4, 4))
+    labels_img = np.asarray(labels_img.dataobj).astype(int)
+    flat_labels = labels_img.ravel()
+    voxels = np.flatnonzero(flat_labels)
+    voxels = voxels[np.argsort(flat_labels[voxels], kind='stable')]
+    labels, starts, counts = np.unique(flat_labels[voxels], return_index=True, return_counts=True)
+    for array in (labels_img, voxels, labels, starts, counts):
+        array.flags.writeable = False
+    return ParcelIndex(labels_img, voxels, labels, starts, counts)
+
+
+def parcel_index(parcellation_file: str, img: nb.Nifti1Image) -> ParcelIndex:
+    """
+    Index of parcellation resampled to grid of image (in the same way as
+    NiftiLabelsMasker resamples labels to data). Indices are cached by
+    parcellation file, affine and shape of image, so parcellation is loaded
+    and resampled once per process for all images on the same grid.
+    """
+    return _parcel_index(parcellation_file, np.asarray(img.affine, dtype=np.float64).tobytes(), tuple(img.shape[:3]))
@@ -0,0 +1,107 @@
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import stats
+
+from fmridenoise.utils import numeric
+
+# number of bootstrap samples calculated together, bounds memory to few
+# (samples x edges) arrays
+BOOTSTRAP_BATCH_SIZE = 50
+
+BOOTSTRAP_CI_LEVEL = 95
+
+
+def _resampled_correlations(x: np.ndarray, y: np.ndarray, counts: np.ndarray,
+                            rows: t.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Pearson correlations between columns of x and y for each bootstrap sample
+    given by row of counts (number of times each observation is drawn).
+
+    Sums of resampled values, squares and products are matrix products of
+    counts with x (of rows selected by index rows, if given), so no resampled
+    copy of x is made. Columns are read and processed in chunks, undefined
+    correlations (constant resampled values) are zeros.
+    """
+    def scatter(sum_of_squares: np.ndarray, total: np.ndarray) -> np.ndarray:
+        # n times sum of squared deviations, rounding errors of constant values are zeros
+        scatter = n * sum_of_squares - total ** 2
+        scatter[scatter <= 1e-12 * n * sum_of_squares] = 0
+        return scatter
+
+    n = counts.sum(axis=1, keepdims=True)
+    y = y - y.mean()
+    sy = counts @ y[:, np.newaxis]
+    scatter_y = scatter(counts @ (y ** 2)[:, np.newaxis], sy)
+    r = np.empty((len(counts), x.shape[1]))
+    for start, chunk in numeric.column_chunks(x, rows):
+        chunk -= chunk.mean(axis=0)
+        sx, sxy = counts @ chunk, counts @ (chunk * y[:, np.newaxis])
+        denominator = np.sqrt(scatter(counts @ chunk ** 2, sx) * scatter_y)
+        r_chunk = r[:, start:start + chunk.shape[1]]
+        np.divide(n * sxy - sx * sy, denominator, out=r_chunk, where=denominator > 0)
+        r_chunk[denominator == 0] = 0
+    return np.clip(r, -1, 1, out=r)
+
+
+def bootstrap_fc_fd_measures(group_corr_vec: np.ndarray, fd: np.ndarray, distance_ranks: np.ndarray,
+                             n_samples: int, pval_tresh: float = 0.05, n_threads: int = 1,
+                             seed: int = 0, rows: t.Optional[np.ndarray] = None) -> t.Dict[str, np.ndarray]:
+    """
+    Bootstrap (over subjects) distributions of FC-FD quality measures: median
+    absolute FC-FD correlation, percent of significant (uncorrected) FC-FD
+    correlations and distance dependence of FC-FD correlations.
+
+    Subjects are resampled in batches of BOOTSTRAP_BATCH_SIZE samples, all
+    edges of batch are correlated with FD by few matrix products (see
+    _resampled_correlations). Batches are calculated by pool of n_threads
+    threads. Resampled subjects depend only on seed and number of subjects, so
+    they are the same for each pipeline.
+
+    Args:
+        group_corr_vec: edges weights (subjects x edges), can be memory mapped
+        fd: mean framewise displacement of each subject
+        distance_ranks: normalized ranks of distance between regions of each
+            edge (see fmridenoise.parcellation.DistanceRanks)
+        n_samples: number of bootstrap samples
+        pval_tresh: significance level of FC-FD correlations
+        n_threads: number of threads calculating batches
+        seed: seed of resampling
+        rows: index of subjects (rows of group_corr_vec) with given fd, all
+            subjects if None
+
+    Returns:
+        Dictionary with vector of n_samples values of each measure.
+    """
+    fd = np.asarray(fd, dtype=np.float64)
+    n_subjects = len(fd)
+    if n_subjects < 3:
+        raise ValueError('Bootstrap requires at least 3 subjects.')
+    # p-value of correlation is below pval_tresh if its absolute value exceeds critical value
+    ab = n_subjects / 2 - 1
+    r_critical = stats.beta(ab, ab, loc=-1, scale=2).isf(pval_tresh / 2)
+    batches = [min(BOOTSTRAP_BATCH_SIZE, n_samples - start) for start in range(0, n_samples, BOOTSTRAP_BATCH_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+    def measures(seed: np.random.SeedSequence, size: int) -> np.ndarray:
+        counts = np.random.default_rng(seed).multinomial(n_subjects, np.full(n_subjects, 1 / n_subjects), size)
+        r = _resampled_correlations(group_corr_vec, fd, counts.astype(np.float64), rows)
+        return np.stack([np.median(np.abs(r), axis=1),
+                         np.sum(np.abs(r) > r_critical, axis=1) / r.shape[1] * 100,
+                         numeric.normalized_ranks(r) @ distance_ranks])
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        samples = np.concatenate(list(pool.map(measures, seeds, batches)), axis=1)
+    return dict(zip(('median_pearson_fc_fd', 'perc_fc_fd_uncorr', 'distance_dependence'), samples))
+
+
+def confidence_interval(samples: np.ndarray, level: float = BOOTSTRAP_CI_LEVEL) -> t.Tuple[float, float]:
+    """Percentile bootstrap confidence interval (undefined samples are ignored)."""
+    low, high = np.nanpercentile(samples, [(100 - level) / 2, (100 + level) / 2])
+    return low, high
+
+
+def ci_columns(measure: str) -> t.Tuple[str, str]:
+    """Names of summary columns with confidence interval of quality measure."""
+    return f'{measure}_ci_low', f'{measure}_ci_high'
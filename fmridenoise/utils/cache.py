@@ -0,0 +1,146 @@
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import typing as t
+from os.path import join, exists, dirname, abspath
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+_HASH_BUFFER = 2 ** 20
+
+
+def content_hash(*items) -> str:
+    """Creates hash of given items. Arrays are hashed by their data type, shape
+    and content, all other items by their representation.
+    """
+    sha = hashlib.sha256()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(f'{item.dtype.str}{item.shape}'.encode())
+            sha.update(np.ascontiguousarray(item).tobytes())
+        else:
+            sha.update(repr(item).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """Creates hash of file content."""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_BUFFER), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cached_array(cache_dir: t.Optional[str], key: str, compute: t.Callable[[], np.ndarray]) -> np.ndarray:
+    """Loads array stored under key in cache_dir or computes it and stores it
+    in cache_dir as compressed .npz file. Files are written atomically, so
+    cache can be shared by concurrently running processes. If cache_dir is
+    None array is always computed.
+    """
+    if cache_dir is None:
+        return compute()
+    path = join(cache_dir, f'{key}.npz')
+    if exists(path):
+        logger.debug(f"Cache hit {path}")
+        with np.load(path) as data:
+            return data['array']
+    logger.debug(f"Cache miss {path}")
+    array = compute()
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix='.npz', delete=False) as f:
+        np.savez_compressed(f, array=array)
+    os.replace(f.name, path)
+    return array
+
+
+class FileCache:
+    """Size bounded directory of files stored under keys.
+
+    Each file is stored with its name in subdirectory named by its key, so
+    cached files keep names meaningful to their readers (e.g. BIDS entities).
+    When total size of cache exceeds max_bytes, least recently stored (or
+    hit) files are evicted. Files are written to temporary files and moved in
+    place atomically, so cache can be shared by concurrently running
+    processes. Hits and misses are counted for statistics.
+    """
+
+    def __init__(self, directory: str, max_bytes: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, name: str) -> t.Optional[str]:
+        """Path of file stored under key or None if it is not cached."""
+        path = join(self.directory, key, name)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            logger.debug(f"Cache miss {path}")
+            return None
+        self.hits += 1
+        logger.debug(f"Cache hit {path}")
+        return path
+
+    def put(self, key: str, name: str, write: t.Callable[[str], t.Any]) -> str:
+        """Stores file written by write(path) under key and evicts least
+        recently used files if cache exceeds its size.
+
+        Returns:
+            Path of stored file.
+        """
+        path = join(self.directory, key, name)
+        os.makedirs(dirname(path), exist_ok=True)
+        # hidden temporary file (with the same extension) is skipped by eviction
+        fd, temp_path = tempfile.mkstemp(dir=dirname(path), prefix='.', suffix=f'_{name}')
+        os.close(fd)
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if exists(temp_path):
+                os.remove(temp_path)
+        self.evict(keep=path)
+        return path
+
+    def _files(self) -> t.List[str]:
+        return [path for path in glob.glob(join(self.directory, '*', '*')) if os.path.isfile(path)]
+
+    def size(self) -> int:
+        """Total size (in bytes) of cached files."""
+        return sum(os.path.getsize(path) for path in self._files())
+
+    def evict(self, keep: str) -> None:
+        """Removes least recently used files until cache fits max_bytes. File
+        keep is never removed."""
+        files = sorted(self._files(), key=os.path.getmtime)
+        total = sum(map(os.path.getsize, files))
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+            shutil.rmtree(dirname(path), ignore_errors=True)
+            logger.info(f"Cache evicted {path}")
+
+    def stats(self) -> str:
+        return f"{self.hits} hits, {self.misses} misses, {self.size() / 2 ** 30:.2f} GB cached"
+
+
+_file_caches = {}
+
+
+def shared_file_cache(cache_class: t.Type[FileCache], directory: str, max_bytes: float) -> FileCache:
+    """File cache of given class for directory shared within process, so hit
+    and miss statistics accumulate over all its uses in the process."""
+    cache = _file_caches.setdefault((cache_class, abspath(directory)), cache_class(directory, max_bytes))
+    cache.max_bytes = max_bytes
+    return cache
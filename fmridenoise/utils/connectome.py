@@ -0,0 +1,67 @@
+import typing as t
+
+import numpy as np
+from nilearn.connectome import sym_matrix_to_vec, vec_to_sym_matrix
+
+# floating point precision of stored edge weights
+CONNECTOME_DTYPE = np.float32
+
+
+def n_rois_from_edges(n_edges: int) -> int:
+    """Number of regions of symmetric matrix with n_edges edges (diagonal
+    included)."""
+    n_rois = int(round((np.sqrt(8 * n_edges + 1) - 1) / 2))
+    if n_rois * (n_rois + 1) // 2 != n_edges:
+        raise ValueError(f"{n_edges} is not a number of edges of symmetric matrix")
+    return n_rois
+
+
+class Connectome(t.NamedTuple):
+    """
+    Connectivity matrix stored as vector of edges of its triangle with
+    diagonal, ordered as by nilearn sym_matrix_to_vec (upper triangle in
+    column-major order), with name of atlas, number of its regions and kind
+    of matrix (e.g. correlation, covariance).
+    """
+    edges: np.ndarray
+    atlas: str
+    n_rois: int
+    kind: str = 'correlation'
+
+    def matrix(self) -> np.ndarray:
+        return vec_to_sym_matrix(self.edges)
+
+
+def save_connectome(path: str, matrix: np.ndarray, atlas: str, kind: str = 'correlation') -> None:
+    """Saves symmetric connectivity matrix as uncompressed .npz file with
+    CONNECTOME_DTYPE edges vector, atlas, number of regions and kind of
+    matrix."""
+    np.savez(path, edges=sym_matrix_to_vec(matrix).astype(CONNECTOME_DTYPE),
+             atlas=np.array(atlas), n_rois=np.array(len(matrix)), kind=np.array(kind))
+
+
+def load_connectome(path: str) -> Connectome:
+    """
+    Loads connectome saved by save_connectome. Full connectivity matrices
+    saved as .npy files (by previous versions) are converted, their atlas is
+    unknown (empty). Connectomes saved without kind are correlation matrices.
+    """
+    if path.endswith('.npy'):
+        matrix = np.load(path)
+        return Connectome(sym_matrix_to_vec(matrix).astype(CONNECTOME_DTYPE), '', len(matrix))
+    with np.load(path) as data:
+        kind = str(data['kind']) if 'kind' in data else 'correlation'
+        return Connectome(data['edges'], str(data['atlas']), int(data['n_rois']), kind)
+
+
+def load_group_connectome(path: str, mmap_mode: t.Optional[str] = None) -> np.ndarray:
+    """
+    Loads group connectome (subjects x edges) saved by GroupConnectivity,
+    memory mapped with mmap_mode (see numpy.load). Stacked full connectivity
+    matrices (subjects x regions x regions) saved by previous versions are
+    converted to edges vectors (in memory).
+    """
+    group_edges = np.load(path, mmap_mode=mmap_mode)
+    if group_edges.ndim == 3:
+        return sym_matrix_to_vec(group_edges).astype(CONNECTOME_DTYPE)
+    return group_edges
@@ -0,0 +1,122 @@
+import io
+import typing as t
+from dataclasses import dataclass, fields
+
+import numpy as np
+import pandas as pd
+
+from fmridenoise.utils.numeric import pearsonr_pvalues
+
+
+@dataclass
+class RunningStatistics:
+    """
+    Number of subjects, means of edge weights and mean FD, sums of their
+    squared deviations and sum of products of their deviations. Statistics of
+    two groups of subjects are merged with pairwise (Welford-style) update, so
+    FC-FD correlations and mean edge weights of group are updated with new
+    subjects only.
+    """
+    n: int
+    mean_fd: float
+    m2_fd: float
+    mean_edges: np.ndarray
+    m2_edges: np.ndarray
+    comoment: np.ndarray
+
+    @classmethod
+    def from_subjects(cls, group_corr_vec: np.ndarray, fd: np.ndarray) -> 'RunningStatistics':
+        """
+        Args:
+            group_corr_vec: edges weights (subjects x edges)
+            fd: mean framewise displacement of each subject
+        """
+        n = len(fd)
+        if n == 0:
+            zeros = np.zeros(group_corr_vec.shape[1])
+            return cls(0, 0., 0., zeros, zeros.copy(), zeros.copy())
+        fd = np.asarray(fd, dtype=np.float64)
+        group_corr_vec = np.asarray(group_corr_vec, dtype=np.float64)
+        mean_fd, mean_edges = fd.mean(), group_corr_vec.mean(axis=0)
+        fd_deviations, edges_deviations = fd - mean_fd, group_corr_vec - mean_edges
+        return cls(n, mean_fd, fd_deviations @ fd_deviations, mean_edges, (edges_deviations ** 2).sum(axis=0),
+                   fd_deviations @ edges_deviations)
+
+    def merge(self, other: 'RunningStatistics') -> 'RunningStatistics':
+        if len(self.mean_edges) != len(other.mean_edges):
+            raise ValueError(f"Can't merge statistics of {len(self.mean_edges)} and {len(other.mean_edges)} edges")
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            return other
+        n = self.n + other.n
+        delta_fd, delta_edges = other.mean_fd - self.mean_fd, other.mean_edges - self.mean_edges
+        weight = self.n * other.n / n
+        return RunningStatistics(n=n,
+                                 mean_fd=self.mean_fd + delta_fd * other.n / n,
+                                 m2_fd=self.m2_fd + other.m2_fd + delta_fd ** 2 * weight,
+                                 mean_edges=self.mean_edges + delta_edges * other.n / n,
+                                 m2_edges=self.m2_edges + other.m2_edges + delta_edges ** 2 * weight,
+                                 comoment=self.comoment + other.comoment + delta_edges * delta_fd * weight)
+
+    def fc_fd_correlations(self) -> t.Tuple[np.ndarray, np.ndarray]:
+        """
+        Pearson correlations between edges weights and mean FD with p-values.
+        Undefined correlations (constant values) are zeros (as in
+        QualityMeasures.calculate_fc_fd_correlations).
+        """
+        denominator = np.sqrt(self.m2_edges * self.m2_fd)
+        r = np.divide(self.comoment, denominator, out=np.zeros_like(self.comoment), where=denominator > 0)
+        np.clip(r, -1, 1, out=r)
+        return r, pearsonr_pvalues(r, self.n)
+
+
+@dataclass
+class GroupStatistics:
+    """
+    Persistent state of group statistics of single pipeline (and task, session
+    and run): confounds summary of all subjects and running statistics of all
+    subjects and of subjects without high motion.
+    """
+    conf_summary: pd.DataFrame
+    all_subjects: RunningStatistics
+    clean_subjects: RunningStatistics
+
+    @classmethod
+    def from_subjects(cls, conf_summary: pd.DataFrame, group_corr_vec: np.ndarray) -> 'GroupStatistics':
+        """
+        Args:
+            conf_summary: group confounds summary (one row per subject)
+            group_corr_vec: edges weights of subjects in conf_summary order
+        """
+        include = conf_summary['include'].values.astype(bool)
+        fd = conf_summary['mean_fd'].values
+        return cls(conf_summary.reset_index(drop=True),
+                   RunningStatistics.from_subjects(group_corr_vec, fd),
+                   RunningStatistics.from_subjects(group_corr_vec[include], fd[include]))
+
+    @property
+    def subjects(self) -> t.List[str]:
+        return list(self.conf_summary['subject'])
+
+    def merge(self, other: 'GroupStatistics') -> 'GroupStatistics':
+        common = set(self.subjects) & set(other.subjects)
+        if common:
+            raise ValueError(f"Subjects {sorted(common)} are already included in group statistics")
+        return GroupStatistics(pd.concat([self.conf_summary, other.conf_summary], ignore_index=True),
+                               self.all_subjects.merge(other.all_subjects),
+                               self.clean_subjects.merge(other.clean_subjects))
+
+    def save(self, path: str) -> None:
+        arrays = {f'{subset}_{field.name}': getattr(getattr(self, subset), field.name)
+                  for subset in ('all_subjects', 'clean_subjects') for field in fields(RunningStatistics)}
+        np.savez(path, conf_summary=np.array(self.conf_summary.to_csv(sep='\t', index=False)), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'GroupStatistics':
+        with np.load(path) as arrays:
+            conf_summary = pd.read_csv(io.StringIO(str(arrays['conf_summary'])), sep='\t', dtype={'subject': str})
+            subsets = [RunningStatistics(**{field.name: arrays[f'{subset}_{field.name}'][()]
+                                            for field in fields(RunningStatistics)})
+                       for subset in ('all_subjects', 'clean_subjects')]
+        return cls(conf_summary, *subsets)
@@ -19,7 +19,8 @@ spike_schema = {
             'type': 'object',
             'properties': {
                 'fd_th': {'type': 'number', 'minimum': 0},
-                'dvars_th': {'type': 'number', 'minimum': 0}
+                'dvars_th': {'type': 'number', 'minimum': 0},
+                'mode': {'enum': ['regress', 'censor']}
             },
         'required': ['fd_th', 'dvars_th'],
         'additionalProperties': False
@@ -0,0 +1,69 @@
+import gzip
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, dirname
+
+import nibabel as nb
+
+COMPRESS_LEVEL_DEFAULT = 1
+# size of independently compressed gzip members
+_CHUNK_SIZE = 2 ** 24
+
+
+def nifti_path(path: str, compress_level: int) -> str:
+    """Path to NIfTI file with extension matching compression level: .nii
+    for compress_level 0, .nii.gz otherwise."""
+    path = path[:-len('.gz')] if path.endswith('.gz') else path
+    return path + '.gz' if compress_level > 0 else path
+
+
+def gzip_file(src: str, dst: str, compress_level: int = COMPRESS_LEVEL_DEFAULT, n_threads: int = 1) -> None:
+    """Compresses file src into gzip file dst.
+
+    File is split into chunks compressed independently by pool of n_threads
+    threads (zlib releases GIL) and written as concatenated gzip members (as
+    pigz does), which is valid gzip file readable by any gzip reader. Number
+    of chunks kept in memory is bounded by twice the number of threads.
+    """
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out, ThreadPoolExecutor(n_threads) as pool:
+        pending = deque()
+        for chunk in iter(lambda: f_in.read(_CHUNK_SIZE), b''):
+            pending.append(pool.submit(gzip.compress, chunk, compress_level, mtime=0))
+            if len(pending) > 2 * n_threads:
+                f_out.write(pending.popleft().result())
+        while pending:
+            f_out.write(pending.popleft().result())
+
+
+def copy_nifti(src: str, dst: str, compress_level: int = COMPRESS_LEVEL_DEFAULT, n_threads: int = 1) -> None:
+    """Copies NIfTI file, compressing or decompressing it if extension of dst
+    differs from extension of src."""
+    if src.endswith('.gz') == dst.endswith('.gz'):
+        shutil.copyfile(src, dst)
+    elif dst.endswith('.gz'):
+        gzip_file(src, dst, compress_level, n_threads)
+    else:
+        with gzip.open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, _CHUNK_SIZE)
+
+
+def save_img(img: nb.Nifti1Image, path: str, compress_level: int = COMPRESS_LEVEL_DEFAULT,
+             n_threads: int = 1) -> str:
+    """Saves image as uncompressed NIfTI (compress_level 0) or compresses it
+    with gzip_file at given level using n_threads threads.
+
+    Returns:
+        Path of saved image, extension of given path is adjusted to
+        compression level (see nifti_path).
+    """
+    path = nifti_path(path, compress_level)
+    if compress_level == 0:
+        nb.save(img, path)
+        return path
+    with tempfile.TemporaryDirectory(dir=dirname(path)) as directory:
+        uncompressed = join(directory, 'img.nii')
+        nb.save(img, uncompressed)
+        gzip_file(uncompressed, path, compress_level, n_threads)
+    return path
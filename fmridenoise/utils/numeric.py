@@ -1,6 +1,111 @@
+import typing as t
+import warnings
+
 import numpy as np
+from scipy import stats
+
+# number of columns correlated at once, bounds memory of centered copies
+_CORRELATION_CHUNK_SIZE = 4096
 
 
 def check_symmetry(matrix):
     """Checks if matrix is symmetrical."""
-    return np.allclose(matrix, matrix.T, rtol=1e-05, atol=1e-08)
\ No newline at end of file
+    return np.allclose(matrix, matrix.T, rtol=1e-05, atol=1e-08)
+
+
+def normalized_ranks(x: np.ndarray) -> np.ndarray:
+    """
+    Ranks of values in each row (last axis), centered and scaled to unit norm,
+    so Spearman correlations of rows are dot products of their normalized
+    ranks. Rows of equal values are NaN (Spearman correlation is undefined).
+    """
+    ranks = stats.rankdata(x, axis=-1)
+    ranks -= ranks.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(ranks, axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore'):
+        return ranks / norm
+
+
+def pearsonr_pvalues(r: np.ndarray, n: int) -> np.ndarray:
+    """
+    Two-sided p-values of Pearson correlation coefficients r of n observations
+    from beta distribution of r under null hypothesis (as in scipy.stats.pearsonr).
+    """
+    r = np.asarray(r, dtype=np.float64)
+    if n == 2:
+        return np.ones_like(r)
+    ab = n / 2 - 1
+    return 2 * stats.beta(ab, ab, loc=-1, scale=2).sf(np.abs(r))
+
+
+def column_chunks(x: np.ndarray, rows: t.Optional[np.ndarray] = None) -> t.Iterator[t.Tuple[int, np.ndarray]]:
+    """
+    Yields index of first column and float64 copy of consecutive chunks of
+    _CORRELATION_CHUNK_SIZE columns of x (of rows selected by index rows, if
+    given). Single chunk of x is read at once, so x can be memory mapped array
+    larger than memory.
+    """
+    chunk_size = _CORRELATION_CHUNK_SIZE
+    for start in range(0, x.shape[1], chunk_size):
+        chunk = x[:, start:start + chunk_size]
+        # fancy indexing of rows makes a copy
+        yield start, np.array(chunk, dtype=np.float64) if rows is None else np.asarray(chunk[rows], dtype=np.float64)
+
+
+def column_means(x: np.ndarray, rows: t.Optional[np.ndarray] = None) -> np.ndarray:
+    """Means of columns of x (of rows selected by index rows, if given)
+    calculated chunk by chunk in double precision."""
+    means = np.empty(x.shape[1])
+    for start, chunk in column_chunks(x, rows):
+        means[start:start + chunk.shape[1]] = chunk.mean(axis=0)
+    return means
+
+
+def pearsonr_columns(x: np.ndarray, y: np.ndarray,
+                     rows: t.Optional[np.ndarray] = None) -> t.Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculates Pearson correlation coefficients and two-sided p-values between
+    each column of x and vector y, equal to scipy.stats.pearsonr called for each
+    column separately.
+
+    Columns are read, centered and normalized in chunks (see column_chunks),
+    so correlations of chunk are given by single matrix-vector product.
+    P-values are calculated from beta distribution of correlation coefficient
+    under null hypothesis (as in scipy).
+
+    Args:
+        x: matrix (observations x variables), can be memory mapped
+        y: vector of observations
+        rows: index of rows of x corresponding to y values, all rows if None
+
+    Returns:
+        Correlation coefficients and p-values, NaN for constant columns.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if x.ndim != 2 or (x.shape[0] if rows is None else len(rows)) != n:
+        raise ValueError('x must be matrix with rows corresponding to y values.')
+    if n < 2:
+        raise ValueError('x and y must have length at least 2.')
+    r = np.empty(x.shape[1])
+    constant = np.empty(x.shape[1], dtype=bool)
+    y_normalized = y - y.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y_normalized /= np.linalg.norm(y_normalized)
+    for start, chunk in column_chunks(x, rows):
+        columns = slice(start, start + chunk.shape[1])
+        constant[columns] = (chunk == chunk[0]).all(axis=0)
+        if n == 2:
+            r[columns] = np.sign(chunk[1] - chunk[0]) * np.sign(y[1] - y[0])
+            continue
+        chunk -= chunk.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r[columns] = y_normalized @ chunk / np.linalg.norm(chunk, axis=0)
+    constant |= (y == y[0]).all()
+    if constant.any():
+        warnings.warn(stats.ConstantInputWarning("An input array is constant; "
+                                                 "the correlation coefficient is not defined."))
+    np.clip(r, -1, 1, out=r)
+    p = pearsonr_pvalues(r, n)
+    r[constant], p[constant] = np.nan, np.nan
+    return r, p
@@ -0,0 +1,101 @@
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from fmridenoise.utils import numeric
+
+# number of permutations correlated with edges in single matrix product
+PERMUTATIONS_BATCH_SIZE = 100
+
+# normalized matrix attached by worker processes
+_shared = {}
+
+
+def _normalize_columns(x: np.ndarray, out: np.ndarray, rows: t.Optional[np.ndarray] = None) -> np.ndarray:
+    """Centers columns of x (of selected rows) and scales them to unit norm
+    (constant columns are set to zeros), so correlations with normalized vector
+    are dot products."""
+    for start, chunk in numeric.column_chunks(x, rows):
+        chunk -= chunk.mean(axis=0)
+        norm = np.linalg.norm(chunk, axis=0)
+        norm[norm == 0] = np.inf
+        np.divide(chunk, norm, out=out[:, start:start + chunk.shape[1]])
+    return out
+
+
+def _max_abs_correlations(x: np.ndarray, y: np.ndarray, seed: np.random.SeedSequence,
+                          n_permutations: int) -> np.ndarray:
+    """Maximal absolute correlations with columns of normalized x for each of
+    n_permutations random permutations of normalized y."""
+    permuted = np.random.default_rng(seed).permuted(np.tile(y, (n_permutations, 1)), axis=1)
+    return np.abs(permuted @ x).max(axis=1)
+
+
+def _attach(name: str, shape: t.Tuple[int, int]) -> None:
+    memory = shared_memory.SharedMemory(name=name)
+    _shared['memory'] = memory
+    _shared['x'] = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+
+
+def _shared_max_abs_correlations(y: np.ndarray, seed: np.random.SeedSequence, n_permutations: int) -> np.ndarray:
+    return _max_abs_correlations(_shared['x'], y, seed, n_permutations)
+
+
+def max_abs_correlation_null(x: np.ndarray, y: np.ndarray, n_permutations: int, n_procs: int = 1,
+                             seed: int = 0, rows: t.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Calculates null distribution of maximal (over columns of x) absolute
+    Pearson correlation with y by randomly permuting y.
+
+    Columns of x are normalized once and each batch of permutations is
+    correlated with all columns in single (permutations x observations) @
+    (observations x columns) product. Batches are spread over pool of n_procs
+    processes attached to normalized x in shared memory. Permutations depend
+    only on seed, not on n_procs.
+
+    Args:
+        x: matrix (observations x variables), can be memory mapped
+        y: vector of observations
+        n_permutations: number of permutations
+        n_procs: number of processes, 1 calculates all batches in current process
+        seed: seed of random permutations
+        rows: index of rows of x corresponding to y values, all rows if None
+
+    Returns:
+        Vector of n_permutations maximal absolute correlations.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if x.ndim != 2 or (x.shape[0] if rows is None else len(rows)) != len(y):
+        raise ValueError('x must be matrix with rows corresponding to y values.')
+    shape = (len(y), x.shape[1])
+    y = y - y.mean()
+    y_norm = np.linalg.norm(y)
+    if y_norm == 0:
+        return np.zeros(n_permutations)
+    y /= y_norm
+    batches = [min(PERMUTATIONS_BATCH_SIZE, n_permutations - start)
+               for start in range(0, n_permutations, PERMUTATIONS_BATCH_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    if n_procs == 1 or len(batches) == 1:
+        x = _normalize_columns(x, np.empty(shape), rows)
+        return np.concatenate([_max_abs_correlations(x, y, s, n) for s, n in zip(seeds, batches)])
+    memory = shared_memory.SharedMemory(create=True, size=max(shape[0] * shape[1], 1) * np.dtype(np.float64).itemsize)
+    try:
+        _normalize_columns(x, np.ndarray(shape, dtype=np.float64, buffer=memory.buf), rows)
+        with ProcessPoolExecutor(n_procs, initializer=_attach, initargs=(memory.name, shape)) as pool:
+            return np.concatenate(list(pool.map(_shared_max_abs_correlations,
+                                                [y] * len(batches), seeds, batches)))
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def fwe_corrected_pvalues(r: np.ndarray, null: np.ndarray) -> np.ndarray:
+    """
+    Family-wise error corrected p-values of correlations r given null
+    distribution of maximal absolute correlation (max-statistic method).
+    """
+    count = len(null) - np.searchsorted(np.sort(null), np.abs(r), side='left')
+    return (1 + count) / (1 + len(null))
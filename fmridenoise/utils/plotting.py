@@ -144,7 +144,7 @@ def make_kdeplot(data, output_path, title=None):
     return output_path
 
 
-def make_catplot(x, y, data, output_path, xlabel=None, ylabel=None):
+def make_catplot(x, y, data, output_path, xlabel=None, ylabel=None, xerr=None):
     """
     Plot representing quality measure value for each pipeline.
 
@@ -163,12 +163,24 @@ def make_catplot(x, y, data, output_path, xlabel=None, ylabel=None):
             Custom x-axis label.
         ylabel (str, optional):
             Custom y-axis label.
+        xerr (tuple of str, optional):
+            Column names of lower and upper bounds of confidence intervals
+            of quality measure drawn as error bars. Ignored if data does
+            not contain these columns.
 
     Returns:
         Path for generated plot.
     """
     mpl.rcParams.update(rcDict)
-    fig = sns.catplot(x=x, y=y, kind='bar', data=data)
+    if xerr is not None and all(column in data for column in xerr):
+        order = list(pd.unique(data[y]))
+        fig = sns.catplot(x=x, y=y, kind='bar', data=data, order=order, ci=None)
+        # bootstrap intervals may not contain estimate, so they are drawn around their centers
+        low, high = data[xerr[0]].values, data[xerr[1]].values
+        fig.ax.errorbar(x=(low + high) / 2, y=[order.index(category) for category in data[y]],
+                        xerr=(high - low) / 2, fmt='none', ecolor='k', capsize=3)
+    else:
+        fig = sns.catplot(x=x, y=y, kind='bar', data=data)
     if xlabel:
         fig.ax.set_xlabel(xlabel)
     if ylabel:
@@ -219,9 +231,11 @@ def make_violinplot(data, output_path, xlabel=None):
         facecolor[-1] = 0.25
         poly.set_facecolor(facecolor)
 
+    # quartile lines are dashed, zero width lines would have zero length dashes
     for l in ax.lines:
-        l.set_linewidth(0)
+        l.set_visible(False)
     for idx, l in enumerate(ax.lines[1::3]):
+        l.set_visible(True)
         l.set_linestyle('-')
         l.set_linewidth(edgewidth)
         l.set_color(ax.collections[idx].get_edgecolor()[0])
@@ -0,0 +1,390 @@
+import gzip
+import shutil
+import tempfile
+import tracemalloc
+import typing as t
+from os.path import join, dirname
+
+import numpy as np
+import nibabel as nb
+from nilearn.signal import clean
+from scipy import sparse
+
+from fmridenoise.utils.nifti import COMPRESS_LEVEL_DEFAULT, gzip_file
+
+# number of values per voxel and volume kept at once while denoising single
+# block: masked block, denoised block and temporary copy of standardization
+# (and unmasked copy of denoised block if it is written)
+_BLOCK_COPIES = 3
+# bytes per voxel of block for mask and per voxel statistics (ranges, means
+# and standard deviations) of masked and denoised blocks
+_VOXEL_BYTES = 64
+# bytes per voxel of block used for adding denoised voxels to parcels sums of
+# single atlas: labels, indices of labelled voxels and their parcels (int64)
+# and sparse membership matrix
+_PARCELS_INDEX_BYTES = 40
+_COPY_BUFFER = 2 ** 24
+
+
+def confounds_projector(n_volumes: int, confounds: t.Optional[np.ndarray],
+                        sample_mask: t.Optional[np.ndarray] = None, **filtering_kwargs) -> np.ndarray:
+    """Creates linear operator applying censoring, detrending, temporal
+    filtering and confounds regression (in nilearn.signal.clean fashion) to
+    signals.
+
+    All denoising steps except standardization are linear, so cleaning
+    identity matrix gives projector P such that
+        clean(signals, confounds, sample_mask, standardize=False) == P @ signals
+    for any signals with n_volumes time points.
+
+    Returns:
+        np.ndarray of shape (n_retained, n_volumes), where n_retained is
+        length of sample_mask (indices of retained volumes) or n_volumes if
+        no volumes are censored.
+    """
+    return clean(
+        np.eye(n_volumes),
+        confounds=confounds,
+        sample_mask=sample_mask,
+        detrend=True,
+        standardize=False,
+        **filtering_kwargs)
+
+
+def apply_projector(signals: np.ndarray, projector: np.ndarray) -> np.ndarray:
+    """Denoises signals (time points x signals) with confounds projector and
+    standardizes them to zero mean and unit variance. Constant signals are
+    set to zero, as nilearn.signal.clean detrends them to exact zeros (while
+    projector leaves rounding errors, which would be standardized to unit
+    variance). Computations are done in precision of signals and projector
+    (both should have the same dtype).
+    """
+    constant = np.ptp(signals, axis=0) == 0
+    # transposed product keeps time points of each signal contiguous, so denoised
+    # blocks are added to parcels sums (sparse product with denoised.T) without copy
+    denoised = standardize((signals.T @ projector.T).T)
+    denoised[:, constant] = 0
+    return denoised
+
+
+def standardize(signals: np.ndarray) -> np.ndarray:
+    """Standardizes signals (time points x signals) in place to zero mean and
+    unit variance (as nilearn zscore standardization). Signals with zero
+    variance are only centered."""
+    signals -= signals.mean(axis=0)
+    std = signals.std(axis=0)
+    std[std < np.finfo(signals.dtype).eps] = 1
+    signals /= std
+    return signals
+
+
+def _fixed_memory(shape: t.Tuple[int, ...], n_outputs: int, n_parcels: t.Sequence[int], itemsize: int) -> int:
+    """Bytes of projectors and parcels sums kept during whole denoising."""
+    n_volumes = shape[-1]
+    return n_outputs * n_volumes * (n_volumes + sum(n_parcels)) * itemsize
+
+
+def _slice_memory(shape: t.Tuple[int, ...], n_parcels: t.Sequence[int], write: bool, itemsize: int) -> int:
+    """Bytes of working arrays per slice of denoised block."""
+    slice_voxels = int(np.prod(shape[:-2]))
+    return slice_voxels * (shape[-1] * (_BLOCK_COPIES + write) * itemsize
+                           + len(n_parcels) * _PARCELS_INDEX_BYTES + _VOXEL_BYTES)
+
+
+def block_size(shape: t.Tuple[int, ...], n_outputs: int, mem_mb: float, dtype=np.float64,
+               n_parcels: t.Sequence[int] = (), write: bool = False) -> int:
+    """Number of slices (along last spatial axis) of 4D image with given shape
+    that can be denoised at once in given precision using at most mem_mb
+    megabytes for projectors, parcels sums (of atlases with given numbers of
+    parcels), working arrays and denoised blocks written to disk (if write is
+    set). At least one slice is always processed.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    available = mem_mb * 2 ** 20 - _fixed_memory(shape, n_outputs, n_parcels, itemsize)
+    return int(np.clip(available // _slice_memory(shape, n_parcels, write, itemsize), 1, shape[-2]))
+
+
+def estimated_memory(shape: t.Tuple[int, ...], n_outputs: int, n_slices: int, dtype=np.float64,
+                     n_parcels: t.Sequence[int] = (), write: bool = False) -> int:
+    """Estimated peak memory (in bytes) of arrays used by denoising in blocks
+    of n_slices (inverse of block_size)."""
+    itemsize = np.dtype(dtype).itemsize
+    return (_fixed_memory(shape, n_outputs, n_parcels, itemsize)
+            + n_slices * _slice_memory(shape, n_parcels, write, itemsize))
+
+
+class _PeakMemory:
+    """Measures peak memory (in bytes) of Python and numpy allocations made
+    within context with tracemalloc (started for the context unless already
+    tracing)."""
+
+    def __enter__(self) -> '_PeakMemory':
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            # before Python 3.9 peak of already running tracing can't be reset
+            tracemalloc.reset_peak()
+        self._base = tracemalloc.get_traced_memory()[0]
+        self.peak = 0
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.peak = max(tracemalloc.get_traced_memory()[1] - self._base, 0)
+        if self._started:
+            tracemalloc.stop()
+
+
+def _staged(fmri_file: str, directory: str, mem_mb: float) -> nb.Nifti1Image:
+    """Loads image from uncompressed file. Compressed images are first
+    decompressed into directory (in constant memory, with copy buffer within
+    memory budget)."""
+    if fmri_file.endswith('.gz'):
+        staged_file = join(directory, 'staged.nii')
+        with gzip.open(fmri_file, 'rb') as src, open(staged_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst, int(np.clip(mem_mb * 2 ** 20 // 4, 2 ** 16, _COPY_BUFFER)))
+        fmri_file = staged_file
+    return nb.load(fmri_file)
+
+
+class _BlockWriter:
+    """Writes 4D image block by block into uncompressed NIfTI file with given
+    data type. Blocks are written through short lived memory maps so written
+    data does not stay in process memory."""
+
+    def __init__(self, path: str, img: nb.Nifti1Image, n_volumes: int, dtype=np.float64):
+        self.path = path
+        self.shape = img.shape[:-1] + (n_volumes,)
+        header = img.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_data_shape(self.shape)
+        header.set_slope_inter(1, 0)
+        self.offset = 352 + int(header.extensions.get_sizeondisk())
+        header.set_data_offset(self.offset)
+        self.dtype = header.get_data_dtype()
+        with open(path, 'wb') as f:
+            header.write_to(f)
+            f.truncate(self.offset + int(np.prod(self.shape)) * self.dtype.itemsize)
+
+    def write(self, start: int, block: np.ndarray) -> None:
+        data = np.memmap(self.path, dtype=self.dtype, mode='r+', offset=self.offset, shape=self.shape, order='F')
+        data[..., start:start + block.shape[-2], :] = block
+        data.flush()
+        del data
+
+    def save(self, out_file: str, compress_level: int = COMPRESS_LEVEL_DEFAULT, n_threads: int = 1) -> None:
+        if out_file.endswith('.gz'):
+            gzip_file(self.path, out_file, compress_level, n_threads)
+        else:
+            shutil.move(self.path, out_file)
+
+
+class _ParcelsAverager:
+    """Averages denoised blocks within parcels of labels image (aligned with
+    denoised image) in the same way as NiftiLabelsMasker: all voxels with
+    given label are averaged and parcels are ordered by label value."""
+
+    def __init__(self, labels: np.ndarray, n_volumes: t.List[int], dtype=np.float64):
+        self.labels = labels
+        self.values, counts = np.unique(labels[labels != 0], return_counts=True)
+        self.counts = counts.astype(dtype)
+        self.sums = [np.zeros((n, len(self.values)), dtype=dtype) for n in n_volumes]
+
+    def add(self, index: int, start: int, mask: np.ndarray, denoised: np.ndarray) -> None:
+        """Adds denoised signals (time points x masked voxels) of block
+        starting at given slice to parcels sums of output index."""
+        block_labels = self.labels[..., start:start + mask.shape[-1]][mask]
+        voxels = np.flatnonzero(block_labels)
+        parcels = np.searchsorted(self.values, block_labels[voxels])
+        membership = sparse.csr_matrix((np.ones(len(voxels), dtype=denoised.dtype), (parcels, voxels)),
+                                       shape=(len(self.values), denoised.shape[1]))
+        self.sums[index] += (membership @ denoised.T).T
+
+    def means(self) -> t.List[np.ndarray]:
+        """Parcels time series for each output."""
+        return [sums / self.counts for sums in self.sums]
+
+    def time_series(self) -> t.List[np.ndarray]:
+        """Standardized parcels time series for each output."""
+        return [standardize(means) for means in self.means()]
+
+
+def _read_block(img: nb.Nifti1Image, start: int, n_slices: int, dtype) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Reads block of n_slices (along last spatial axis) of 4D image starting
+    at given slice. Returns mask of block voxels with any nonzero value and
+    their signals (time points x masked voxels) in given precision."""
+    block = np.asarray(img.dataobj[..., start:start + n_slices, :], dtype=dtype)
+    mask = np.any(block, axis=-1)
+    return mask, block[mask].T
+
+
+def _denoise_blockwise(fmri_file: str, projectors: t.List[np.ndarray], out_files: t.Optional[t.List[str]],
+                       labels_list: t.List[np.ndarray], mem_mb: float, dtype, compress_level: int,
+                       n_threads: int) -> t.Tuple[t.List[t.List[np.ndarray]], int]:
+    with tempfile.TemporaryDirectory(dir=dirname(out_files[0]) if out_files else None) as directory, \
+            _PeakMemory() as peak_memory:
+        img = _staged(fmri_file, directory, mem_mb)
+        shape = img.shape
+        projectors = [projector.astype(dtype) for projector in projectors]
+        writers = [_BlockWriter(join(directory, f'denoised_{i}.nii'), img, projector.shape[0], dtype)
+                   for i, projector in enumerate(projectors)] if out_files else []
+        averagers = [_ParcelsAverager(labels, [projector.shape[0] for projector in projectors], dtype)
+                     for labels in labels_list]
+        n_slices = block_size(shape, len(projectors), mem_mb, dtype,
+                              [len(averager.values) for averager in averagers], bool(writers))
+        for start in range(0, shape[-2], n_slices):
+            mask, signals = _read_block(img, start, n_slices, dtype)
+            for i, projector in enumerate(projectors):
+                denoised = apply_projector(signals, projector)
+                for averager in averagers:
+                    averager.add(i, start, mask, denoised)
+                if writers:
+                    denoised_block = np.zeros(mask.shape + (projector.shape[0],), dtype=dtype)
+                    denoised_block[mask] = denoised.T
+                    writers[i].write(start, denoised_block)
+                    del denoised_block
+                del denoised
+            del signals
+        for writer, out_file in zip(writers, out_files or []):
+            writer.save(out_file, compress_level, n_threads)
+        time_series = [averager.time_series() for averager in averagers]
+    return time_series, peak_memory.peak
+
+
+def denoise_img_blockwise(fmri_file: str, projectors: t.List[np.ndarray], out_files: t.List[str],
+                          mem_mb: float, dtype=np.float64, compress_level: int = COMPRESS_LEVEL_DEFAULT,
+                          n_threads: int = 1) -> int:
+    """Denoises 4D image with each of confounds projectors and saves results.
+
+    Image is processed in blocks of slices (along last spatial axis) so that
+    whole image is never loaded to memory. Each block is read once for all
+    projectors and denoised blocks are written incrementally. Denoised images
+    have as many volumes as rows of their projectors (censored volumes are
+    removed). Computations are done in given precision and results are saved
+    with the same data type and header of input image.
+
+    Args:
+        fmri_file: path to 4D image
+        projectors: projectors created with confounds_projector
+        out_files: output path for each projector (.nii.gz paths are
+            compressed with gzip_file)
+        mem_mb: memory budget (in megabytes) for projectors, parcels sums and
+            working arrays
+        dtype: floating point precision of computations and outputs
+        compress_level: gzip compression level of compressed outputs
+        n_threads: number of threads compressing outputs
+
+    Returns:
+        Measured peak memory (in bytes) allocated while denoising.
+    """
+    if len(projectors) != len(out_files):
+        raise ValueError(f"Number of projectors ({len(projectors)}) differs from "
+                         f"number of output files ({len(out_files)})")
+    return _denoise_blockwise(fmri_file, projectors, out_files, [], mem_mb, dtype, compress_level, n_threads)[1]
+
+
+def denoise_img_parcels(fmri_file: str, projectors: t.List[np.ndarray], labels: np.ndarray, mem_mb: float,
+                        dtype=np.float64, out_files: t.Optional[t.List[str]] = None,
+                        compress_level: int = COMPRESS_LEVEL_DEFAULT, n_threads: int = 1
+                        ) -> t.Tuple[t.List[np.ndarray], int]:
+    """Denoises 4D image with each of confounds projectors and averages
+    denoised voxels within parcels, without creating denoised images.
+
+    Image is denoised block by block as in denoise_img_blockwise and each
+    denoised block is immediately added to parcels averages, so parcels time
+    series are equal to NiftiLabelsMasker (with standardization) applied to
+    denoised image, but denoised image is neither kept in memory nor written
+    to disk. Denoised images are additionally saved only if out_files are
+    given.
+
+    Args:
+        fmri_file: path to 4D image
+        projectors: projectors created with confounds_projector
+        labels: integer labels array with the same spatial shape as image
+            (0 is background)
+        mem_mb: memory budget (in megabytes) for projectors, parcels sums and
+            working arrays
+        dtype: floating point precision of computations and outputs
+        out_files: optional output path of denoised image for each projector
+        compress_level: gzip compression level of compressed outputs
+        n_threads: number of threads compressing outputs
+
+    Returns:
+        Standardized parcels time series (time points x parcels) for each
+        projector and measured peak memory (in bytes) allocated while
+        denoising.
+    """
+    (time_series, ), mem_peak = denoise_img_atlases(fmri_file, projectors, [labels], mem_mb, dtype, out_files,
+                                                    compress_level, n_threads)
+    return time_series, mem_peak
+
+
+def denoise_img_atlases(fmri_file: str, projectors: t.List[np.ndarray], labels_list: t.List[np.ndarray],
+                        mem_mb: float, dtype=np.float64, out_files: t.Optional[t.List[str]] = None,
+                        compress_level: int = COMPRESS_LEVEL_DEFAULT, n_threads: int = 1
+                        ) -> t.Tuple[t.List[t.List[np.ndarray]], int]:
+    """Denoises 4D image with each of confounds projectors and averages
+    denoised voxels within parcels of several parcellations.
+
+    Works as denoise_img_parcels, but each denoised block is added to parcels
+    averages of every labels array, so time series of all parcellations are
+    created from single read and denoising of image.
+
+    Args:
+        fmri_file: path to 4D image
+        projectors: projectors created with confounds_projector
+        labels_list: integer labels arrays with the same spatial shape as
+            image (0 is background)
+        mem_mb: memory budget (in megabytes) for projectors, parcels sums and
+            working arrays
+        dtype: floating point precision of computations and outputs
+        out_files: optional output path of denoised image for each projector
+        compress_level: gzip compression level of compressed outputs
+        n_threads: number of threads compressing outputs
+
+    Returns:
+        Standardized parcels time series (time points x parcels) for each
+        labels array (outer list) and projector (inner list) and measured
+        peak memory (in bytes) allocated while denoising.
+    """
+    if out_files is not None and len(projectors) != len(out_files):
+        raise ValueError(f"Number of projectors ({len(projectors)}) differs from "
+                         f"number of output files ({len(out_files)})")
+    return _denoise_blockwise(fmri_file, projectors, out_files, labels_list, mem_mb, dtype, compress_level,
+                              n_threads)
+
+
+def parcel_means_blockwise(fmri_file: str, labels_list: t.List[np.ndarray], mem_mb: float,
+                           dtype=np.float64) -> t.Tuple[t.List[np.ndarray], int]:
+    """Averages raw signals of 4D image within parcels of several
+    parcellations.
+
+    Image is read in blocks of slices as in denoise_img_blockwise and each
+    block is added to parcels sums of every labels array, so whole image is
+    never loaded to memory. Parcels are ordered by label value, as by
+    NiftiLabelsMasker.
+
+    Args:
+        fmri_file: path to 4D image
+        labels_list: integer labels arrays with the same spatial shape as
+            image (0 is background)
+        mem_mb: memory budget (in megabytes) for parcels sums and working
+            arrays
+        dtype: floating point precision of computations and outputs
+
+    Returns:
+        Parcels time series (time points x parcels) for each labels array and
+        measured peak memory (in bytes) allocated while averaging.
+    """
+    with tempfile.TemporaryDirectory() as directory, _PeakMemory() as peak_memory:
+        img = _staged(fmri_file, directory, mem_mb)
+        averagers = [_ParcelsAverager(labels, [img.shape[-1]], dtype) for labels in labels_list]
+        # raw signals are summed as single output without projector
+        n_slices = block_size(img.shape, 1, mem_mb, dtype, [len(averager.values) for averager in averagers])
+        for start in range(0, img.shape[-2], n_slices):
+            mask, signals = _read_block(img, start, n_slices, dtype)
+            for averager in averagers:
+                averager.add(0, start, mask, signals)
+            del signals
+        means = [averager.means()[0] for averager in averagers]
+    return means, peak_memory.peak
@@ -0,0 +1,49 @@
+import gzip
+import logging
+import os
+import shutil
+from os.path import basename, abspath
+
+from fmridenoise.utils.cache import FileCache, content_hash, shared_file_cache
+
+logger = logging.getLogger(__name__)
+STAGING_CACHE_GB_DEFAULT = 50
+_COPY_BUFFER = 2 ** 24
+
+
+def _decompress(src: str, dst: str) -> None:
+    with gzip.open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, _COPY_BUFFER)
+
+
+class StagingCache(FileCache):
+    """Scratch directory with uncompressed copies of compressed NIfTI files.
+
+    Uncompressed images can be memory mapped, so readers load only data they
+    need instead of decompressing whole file every time it is loaded. Each
+    file is decompressed once and keeps its original name (without .gz
+    extension), keyed by path, size and modification time of source file.
+    Least recently used files are evicted above max_bytes (see FileCache).
+    """
+
+    def stage(self, path: str) -> str:
+        """Returns path to uncompressed copy of compressed NIfTI file.
+        Uncompressed files are returned unchanged."""
+        if not path.endswith('.gz'):
+            return path
+        stat = os.stat(path)
+        key = content_hash(abspath(path), stat.st_size, stat.st_mtime_ns)[:16]
+        name = basename(path)[:-len('.gz')]
+        staged = self.get(key, name)
+        if staged is not None:
+            logger.info(f"Staging cache hit {path} ({self.stats()})")
+            return staged
+        staged = self.put(key, name, lambda dst: _decompress(path, dst))
+        logger.info(f"Staging cache miss {path} ({self.stats()})")
+        return staged
+
+
+def get_staging_cache(directory: str, max_bytes: float) -> StagingCache:
+    """Staging cache for directory shared within process, so hit and miss
+    statistics accumulate over all files staged by the process."""
+    return shared_file_cache(StagingCache, directory, max_bytes)
@@ -5,18 +5,21 @@ import typing as t
 from functools import reduce
 
 from nipype import Node, IdentityInterface, Workflow, JoinNode
-from fmridenoise.interfaces.smoothing import Smooth
-from fmridenoise.interfaces.bids import BIDSGrab, BIDSDataSink, BIDSValidate
+from fmridenoise.interfaces.smoothing import Smooth, SMOOTHING_CACHE_GB_DEFAULT
+from fmridenoise.interfaces.bids import BIDSGrab, BIDSDataSink, BIDSValidate, BIDSStage
 from fmridenoise.interfaces.confounds import Confounds, GroupConfounds
-from fmridenoise.interfaces.denoising import Denoise
-from fmridenoise.interfaces.connectivity import Connectivity, GroupConnectivity
-from fmridenoise.interfaces.pipeline_selector import PipelineSelector
+from fmridenoise.interfaces.denoising import Denoise, PipelinesDenoise, DENOISE_MEM_MB_DEFAULT
+from fmridenoise.interfaces.connectivity import Connectivity, GroupConnectivity, AtlasSelector
+from fmridenoise.interfaces.pipeline_selector import PipelineSelector, SelectPipelineFile
 from fmridenoise.interfaces.quality_measures import QualityMeasures, PipelinesQualityMeasures
 from fmridenoise.interfaces.report_creator import ReportCreator
 import fmridenoise.utils.temps as temps
+from fmridenoise.utils.nifti import COMPRESS_LEVEL_DEFAULT
+from fmridenoise.utils.staging import STAGING_CACHE_GB_DEFAULT
 from fmridenoise.utils.dataclasses.runtime_info import RuntimeInfo
 from fmridenoise.utils.utils import create_flatten_identity_join_node
-from fmridenoise.parcellation import get_distance_matrix_file_path
+from fmridenoise.parcellation import DEFAULT_ATLAS, get_atlas_label
+from fmridenoise.pipelines import load_pipeline_from_json, is_IcaAROMA
 
 
 from fmridenoise._version import get_versions
@@ -38,7 +41,35 @@ class WorkflowBuilder:
                  tr_dic: dict,
                  pipelines_paths: t.List[str],
                  high_pass: float,
-                 low_pass: float):
+                 low_pass: float,
+                 denoise_space: str = 'voxels',
+                 denoise_mem_mb: float = DENOISE_MEM_MB_DEFAULT,
+                 precision: str = 'float64',
+                 save_denoised_bold: bool = False,
+                 compress_level: int = COMPRESS_LEVEL_DEFAULT,
+                 intermediate_compress_level: int = COMPRESS_LEVEL_DEFAULT,
+                 compress_threads: int = 1,
+                 staging_cache: t.Optional[str] = None,
+                 staging_cache_gb: float = STAGING_CACHE_GB_DEFAULT,
+                 smoothing_cache: t.Optional[str] = None,
+                 smoothing_cache_gb: float = SMOOTHING_CACHE_GB_DEFAULT,
+                 smoothing_threads: int = 1,
+                 projector_cache: t.Optional[str] = None,
+                 qcfc_permutations: int = 0,
+                 qcfc_procs: int = 1,
+                 bootstrap_samples: int = 0,
+                 atlases: t.Sequence[str] = (DEFAULT_ATLAS, ),
+                 connectivity_kind: str = 'correlation',
+                 skip_excluded: bool = False):
+        labels = [get_atlas_label(atlas) for atlas in atlases]
+        if len(set(labels)) != len(labels):
+            raise ValueError(f"Atlases {list(atlases)} have duplicated atlas entities {labels}")
+        self.precision = precision
+        self.smoothing_threads = smoothing_threads
+        self.smoothing_cache = smoothing_cache
+        self.smoothing_cache_gb = smoothing_cache_gb
+        self.intermediate_compress_level = intermediate_compress_level
+        self.compress_threads = compress_threads
         self.fmri_prep_aroma_files = []
         self.fmri_prep_files = []
         # 1) --- Itersources for all further processing
@@ -65,6 +96,16 @@ class WorkflowBuilder:
         self.taskselector.iterables = ('task', tasks)
         # Outputs: task
 
+        # Inputs: fulfilled
+        # time series of all atlases are created by single denoising, so atlas
+        # iterable is connected only to nodes following denoising
+        self.atlasselector = Node(
+            AtlasSelector(
+                output_dir=temps.mkdtemp('atlases')),
+            name="AtlasSelector")
+        self.atlasselector.iterables = ('atlas', list(atlases))
+        # Outputs: atlas, atlas_label, distance_matrix
+
         # 2) --- Loading BIDS files
 
         # Inputs: subject, session, task
@@ -75,6 +116,18 @@ class WorkflowBuilder:
             name="BidsGrabber")
         # Outputs: fmri_prep, fmri_prep_aroma, conf_raw, conf_json
 
+        # Inputs: fmri_prep, fmri_prep_aroma
+        if staging_cache is not None:
+            os.makedirs(staging_cache, exist_ok=True)
+            self.bidsstage = Node(
+                BIDSStage(
+                    cache_dir=staging_cache,
+                    cache_gb=staging_cache_gb),
+                name="BidsStage")
+        else:
+            self.bidsstage = None
+        # Outputs: fmri_prep, fmri_prep_aroma (uncompressed)
+
         # 3) --- Confounds preprocessing
 
         # Inputs: pipeline, conf_raw, conf_json
@@ -86,25 +139,90 @@ class WorkflowBuilder:
 
         # 4) --- Denoising
         # Inputs: fmri_prep, fmri_prep_aroma, conf_prep, pipeline, entity, tr_dict
-        self.denoise = Node(
-            Denoise(
-                high_pass=high_pass,
-                low_pass=low_pass,
-                tr_dict=tr_dic,
-                output_dir=temps.mkdtemp('denoise')),
-            name="Denoiser",
-            mem_gb=12)
-        # Outputs: fmri_denoised
+        pipelines = [load_pipeline_from_json(path) for path in pipelines_paths]
+        n_aroma = sum(map(is_IcaAROMA, pipelines))
+        # connectivity is always estimated from parcels time series created during denoising
+        save_denoised_bold = save_denoised_bold and denoise_space == 'voxels'
+        # denoising (or parcels averaging) budget and interpreter with loaded libraries
+        denoise_mem_gb = denoise_mem_mb / 1024 + 0.5
+        if denoise_space == 'parcels' or max(n_aroma, len(pipelines) - n_aroma) > 1:
+            # several pipelines share input file - join them and load each image once
+            self.denoise = JoinNode(
+                PipelinesDenoise(
+                    high_pass=high_pass,
+                    low_pass=low_pass,
+                    tr_dict=tr_dic,
+                    denoise_space=denoise_space,
+                    mem_mb=denoise_mem_mb,
+                    precision=precision,
+                    atlases=list(atlases),
+                    save_denoised_bold=save_denoised_bold,
+                    compress_level=intermediate_compress_level,
+                    compress_threads=compress_threads,
+                    output_dir=temps.mkdtemp('denoise')),
+                joinsource=self.pipelineselector,
+                joinfield=['conf_prep', 'sample_mask', 'pipeline'] + (['include'] if skip_excluded else []),
+                name="Denoiser",
+                mem_gb=denoise_mem_gb)
+            # Outputs: time_series, fmri_denoised (lists over pipelines)
+            self.denoise_selector = Node(
+                SelectPipelineFile(),
+                name="DenoisedSelector")
+            denoise_connections = []
+            if save_denoised_bold:
+                denoise_connections += [
+                    (self.denoise, self.denoise_selector, [('fmri_denoised', 'in_files')]),
+                    (self.pipelineselector, self.denoise_selector, [('pipeline', 'pipeline')])]
+            self.fmri_denoised = (self.denoise_selector, 'out_file')
+        else:
+            self.denoise = Node(
+                Denoise(
+                    high_pass=high_pass,
+                    low_pass=low_pass,
+                    tr_dict=tr_dic,
+                    mem_mb=denoise_mem_mb,
+                    precision=precision,
+                    atlases=list(atlases),
+                    save_denoised_bold=save_denoised_bold,
+                    compress_level=intermediate_compress_level,
+                    compress_threads=compress_threads,
+                    output_dir=temps.mkdtemp('denoise')),
+                name="Denoiser",
+                mem_gb=denoise_mem_gb)
+            denoise_connections = []
+            self.fmri_denoised = (self.denoise, 'fmri_denoised')
+        if projector_cache is not None:
+            os.makedirs(projector_cache, exist_ok=True)
+            self.denoise.inputs.projector_cache = projector_cache
+        # Outputs: time_series (list over atlases), fmri_denoised (only if saved)
+        self.time_series_selector = Node(
+            SelectPipelineFile(),
+            name="TimeSeriesSelector")
+        if skip_excluded:
+            # excluded subjects are not denoised, so there are no files to select
+            self.time_series_selector.inputs.allow_missing = True
+            if isinstance(self.denoise, JoinNode):
+                self.denoise_selector.inputs.allow_missing = True
+            denoise_connections += [(self.prep_conf, self.denoise, [('include', 'include')])]
+        denoise_connections += [
+            (self.denoise, self.time_series_selector, [('time_series', 'in_files')]),
+            (self.pipelineselector, self.time_series_selector, [('pipeline', 'pipeline')]),
+            (self.atlasselector, self.time_series_selector, [('atlas_label', 'atlas')])]
+        self.time_series = (self.time_series_selector, 'out_file')
 
         # 5) --- Connectivity estimation
 
-        # Inputs: fmri_denoised
+        # Inputs: time_series
         self.connectivity = Node(
             Connectivity(
-                output_dir=temps.mkdtemp('connectivity')
+                output_dir=temps.mkdtemp('connectivity'),
+                precision=precision,
+                kind=connectivity_kind
             ),
             name='ConnCalc')
-        # Outputs: conn_mat, carpet_plot
+        if skip_excluded:
+            denoise_connections += [(self.prep_conf, self.connectivity, [('include', 'include')])]
+        # Outputs: conn_mat, carpet_plot, matrix_plot, parcels_time_series
 
         # 6) --- Group confounds
 
@@ -127,6 +245,7 @@ class WorkflowBuilder:
         self.group_connectivity = JoinNode(
             GroupConnectivity(
                 output_dir=temps.mkdtemp('group_connectivity'),
+                kind=connectivity_kind
             ),
             joinfield=["corr_mat"],
             joinsource=self.subjectselector,
@@ -141,9 +260,14 @@ class WorkflowBuilder:
         self.quality_measures = Node(
             QualityMeasures(
                 output_dir=temps.mkdtemp('quality_measures'),
-                distance_matrix=get_distance_matrix_file_path()
+                n_permutations=qcfc_permutations,
+                n_bootstrap=bootstrap_samples,
+                n_procs=qcfc_procs,
+                # connectomes of excluded subjects are not created
+                all_subjects=not skip_excluded
             ),
-            name="QualityMeasures")
+            name="QualityMeasures",
+            n_procs=qcfc_procs)
         # Outputs: fc_fd_summary, edges_weight, edges_weight_clean
         self.quality_measures_join = create_flatten_identity_join_node(
             name='JoinQualityMeasuresOverPipeline',
@@ -196,6 +320,13 @@ class WorkflowBuilder:
                 'corr_matrix_no_high_motion_plot'
             ]
         )
+        fields = self.pipeline_quality_measures_join_tasks.interface._fields
+        self.pipeline_quality_measures_join_atlases = create_flatten_identity_join_node(
+            name="JoinPipelinesQualityMeasuresOverAtlases",
+            fields=fields,
+            joinsource=self.atlasselector,
+            flatten_fields=fields
+        )
         # Outputs: pipelines_fc_fd_summary, pipelines_edges_weight
         # 11) --- Report from data
         report_dir = os.path.join(bids_dir, 'derivatives', 'fmridenoise', 'report')
@@ -214,10 +345,22 @@ class WorkflowBuilder:
         base_entities = {'bids_dir': bids_dir, 'derivative': 'fmridenoise'}
         self.ds_confounds = Node(BIDSDataSink(base_entities=base_entities),
                                  name="ds_confounds")
-        self.ds_denoise = Node(BIDSDataSink(base_entities=base_entities),
+        self.ds_conf_summary = Node(BIDSDataSink(base_entities=base_entities),
+                                    name="ds_conf_summary")
+        self.ds_denoise = Node(BIDSDataSink(base_entities=base_entities,
+                                            compress_level=compress_level,
+                                            compress_threads=compress_threads),
                                name="ds_denoise")
+        if save_denoised_bold:
+            ds_denoise_connections = [
+                (self.fmri_denoised[0], self.ds_denoise, [(self.fmri_denoised[1], "in_file")])]
+        else:
+            # denoised images are created only on demand
+            ds_denoise_connections = []
         self.ds_connectivity_corr_mat = Node(BIDSDataSink(base_entities=base_entities),
                                              name="ds_connectivity")
+        self.ds_connectivity_time_series = Node(BIDSDataSink(base_entities=base_entities),
+                                                name="ds_time_series")
         self.ds_connectivity_carpet_plot = Node(BIDSDataSink(base_entities=base_entities),
                                                 name="ds_carpet_plot")
         self.ds_connectivity_matrix_plot = Node(BIDSDataSink(base_entities=base_entities),
@@ -264,18 +407,23 @@ class WorkflowBuilder:
             (self.bidsgrabber, self.prep_conf, [('conf_raw', 'conf_raw'),
                                                 ('conf_json', 'conf_json')]),
             # denoise
-            (self.prep_conf, self.denoise, [('conf_prep', 'conf_prep')]),
+            (self.prep_conf, self.denoise, [('conf_prep', 'conf_prep'),
+                                            ('sample_mask', 'sample_mask')]),
             (self.pipelineselector, self.denoise, [('pipeline', 'pipeline')]),
             # group conf summary
             (self.prep_conf, self.group_conf_summary, [('conf_summary', 'conf_summary_json_files')]),
+            *denoise_connections,
+            *ds_denoise_connections,
             # connectivity
-            (self.denoise, self.connectivity, [('fmri_denoised', 'fmri_denoised')]),
+            (self.time_series[0], self.connectivity, [(self.time_series[1], 'time_series')]),
+            (self.atlasselector, self.connectivity, [('atlas', 'atlas')]),
             # group connectivity
             (self.connectivity, self.group_connectivity, [("corr_mat", "corr_mat")]),
             # quality measures
             (self.pipelineselector, self.quality_measures, [('pipeline', 'pipeline')]),
             (self.group_connectivity, self.quality_measures, [('group_corr_mat', 'group_corr_mat')]),
             (self.group_conf_summary, self.quality_measures, [('group_conf_summary', 'group_conf_summary')]),
+            (self.atlasselector, self.quality_measures, [('distance_matrix', 'distance_matrix')]),
             # quality measure join over pipelines
             (self.quality_measures, self.quality_measures_join, [
                 ('excluded_subjects', 'excluded_subjects'),
@@ -290,6 +438,7 @@ class WorkflowBuilder:
                 ('fc_fd_corr_values', 'fc_fd_corr_values'),
                 ('fc_fd_corr_values_clean', 'fc_fd_corr_values_clean')]),
             (self.taskselector, self.pipelines_quality_measures, [('task', 'task')]),
+            (self.atlasselector, self.pipelines_quality_measures, [('atlas_label', 'atlas')]),
             # pipelines_join
             (self.pipelineselector, self.pipelines_join, [('pipeline', 'pipelines')]),
             # pipeline_quality_measures_join
@@ -310,17 +459,20 @@ class WorkflowBuilder:
                 ('warnings', 'warnings'),
                 ('corr_matrix_plot', 'corr_matrix_plot'),
                 ('corr_matrix_no_high_motion_plot', 'corr_matrix_no_high_motion_plot')]),
+            # pipeline_quality_measures_join_atlases
+            (self.pipeline_quality_measures_join_tasks, self.pipeline_quality_measures_join_atlases,
+             list(zip(fields, fields))),
             # report creator
             (self.pipelines_join, self.report_creator, [('pipelines', 'pipelines')]),
             # all datasinks
-            # # ds_denoise
-            (self.denoise, self.ds_denoise, [("fmri_denoised", "in_file")]),
             # # ds_connectivity
             (self.connectivity, self.ds_connectivity_corr_mat, [("corr_mat", "in_file")]),
             (self.connectivity, self.ds_connectivity_matrix_plot, [("matrix_plot", "in_file")]),
             (self.connectivity, self.ds_connectivity_carpet_plot, [("carpet_plot", "in_file")]),
+            (self.connectivity, self.ds_connectivity_time_series, [("parcels_time_series", "in_file")]),
             # # ds_confounds
             (self.prep_conf, self.ds_confounds, [("conf_prep", "in_file")]),
+            (self.prep_conf, self.ds_conf_summary, [("conf_summary", "in_file")]),
             # # ds_group_conf
             (self.group_conf_summary, self.ds_group_conf_summary, [('group_conf_summary', 'in_file')]),
             # # ds_group_connectivity
@@ -350,22 +502,38 @@ class WorkflowBuilder:
              [('plot_pipelines_distance_dependence_no_high_motion', 'in_file')]),
             (self.pipelines_quality_measures, self.ds_pqm_plot_tdof_loss, [('plot_pipelines_tdof_loss', 'in_file')])
         ]
-        self.last_join = self.pipeline_quality_measures_join_tasks
+        self.last_join = self.pipeline_quality_measures_join_atlases
+
+    def _fmri_connections(self, field: str, node: Node, node_field: str) -> list:
+        """Connections of fMRI file selected by bidsgrabber (staged first if
+        staging cache is used) to input of node."""
+        if self.bidsstage is None:
+            return [(self.bidsgrabber, node, [(field, node_field)])]
+        return [(self.bidsgrabber, self.bidsstage, [(field, field)]),
+                (self.bidsstage, node, [(field, node_field)])]
 
     def use_fmri_prep_aroma(self, fmri_aroma_files: t.List[str]):
         self.bidsgrabber.inputs.fmri_prep_aroma_files = fmri_aroma_files
-        self.connections += [
-            (self.bidsgrabber, self.denoise, [('fmri_prep_aroma', 'fmri_prep_aroma')])]
+        self.connections += self._fmri_connections('fmri_prep_aroma', self.denoise, 'fmri_prep_aroma')
 
     def use_fmri_prep(self, fmri_prep_files: t.List[str]):
         self.smooth_signal = Node(
             Smooth(
                 output_directory=temps.mkdtemp('smoothing'),
-                is_file_mandatory=False),
+                is_file_mandatory=False,
+                precision=self.precision,
+                compress_level=self.intermediate_compress_level,
+                compress_threads=self.compress_threads,
+                cache_gb=self.smoothing_cache_gb,
+                n_threads=self.smoothing_threads),
             name="Smoother",
-            mem_gb=12)
+            mem_gb=12,
+            n_procs=self.smoothing_threads)
+        if self.smoothing_cache is not None:
+            os.makedirs(self.smoothing_cache, exist_ok=True)
+            self.smooth_signal.inputs.cache_dir = self.smoothing_cache
         self.connections += [
-            (self.bidsgrabber, self.smooth_signal, [('fmri_prep', 'fmri_prep')]),
+            *self._fmri_connections('fmri_prep', self.smooth_signal, 'fmri_prep'),
             (self.smooth_signal, self.denoise, [('fmri_smoothed', 'fmri_prep')])]
         self.bidsgrabber.inputs.fmri_prep_files = fmri_prep_files
 
@@ -441,6 +609,24 @@ def init_fmridenoise_wf(bids_dir,
                         pipelines_paths: t.Set[str],
                         high_pass=0.008,
                         low_pass=0.08,
+                        denoise_space='voxels',
+                        denoise_mem_mb=DENOISE_MEM_MB_DEFAULT,
+                        precision='float64',
+                        save_denoised_bold=False,
+                        compress_level=COMPRESS_LEVEL_DEFAULT,
+                        intermediate_compress_level=COMPRESS_LEVEL_DEFAULT,
+                        compress_threads=1,
+                        staging_cache=None,
+                        staging_cache_gb=STAGING_CACHE_GB_DEFAULT,
+                        smoothing_cache=None,
+                        smoothing_cache_gb=SMOOTHING_CACHE_GB_DEFAULT,
+                        smoothing_threads=1,
+                        qcfc_permutations=0,
+                        qcfc_procs=1,
+                        bootstrap_samples=0,
+                        atlases=(DEFAULT_ATLAS, ),
+                        connectivity_kind='correlation',
+                        skip_excluded=False,
                         base_dir='/tmp/fmridenoise',
                         name='fmridenoise_wf'):
     pipelines_paths = list(pipelines_paths)
@@ -461,7 +647,27 @@ def init_fmridenoise_wf(bids_dir,
                               tr_dic=result.outputs.tr_dict,
                               pipelines_paths=pipelines_paths,
                               high_pass=high_pass,
-                              low_pass=low_pass)
+                              low_pass=low_pass,
+                              denoise_space=denoise_space,
+                              denoise_mem_mb=denoise_mem_mb,
+                              precision=precision,
+                              save_denoised_bold=save_denoised_bold,
+                              compress_level=compress_level,
+                              intermediate_compress_level=intermediate_compress_level,
+                              compress_threads=compress_threads,
+                              staging_cache=staging_cache,
+                              staging_cache_gb=staging_cache_gb,
+                              smoothing_cache=smoothing_cache,
+                              smoothing_cache_gb=smoothing_cache_gb,
+                              smoothing_threads=smoothing_threads,
+                              # projectors are reused by reruns with the same working directory
+                              projector_cache=os.path.join(base_dir, 'projector_cache'),
+                              qcfc_permutations=qcfc_permutations,
+                              qcfc_procs=qcfc_procs,
+                              bootstrap_samples=bootstrap_samples,
+                              atlases=atlases,
+                              connectivity_kind=connectivity_kind,
+                              skip_excluded=skip_excluded)
     if result.outputs.fmri_prep:
         builder.use_fmri_prep(result.outputs.fmri_prep)
     if result.outputs.fmri_prep_aroma:
@@ -0,0 +1,297 @@
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import typing as t
+from os.path import join, dirname, basename, exists
+
+import pandas as pd
+from nipype.interfaces.base import isdefined
+
+from fmridenoise._version import get_versions
+from fmridenoise.interfaces.bids import BIDSDataSink
+from fmridenoise.interfaces.confounds import GroupConfounds, motion_inclusion
+from fmridenoise.interfaces.connectivity import Connectivity, GroupConnectivity, AtlasSelector
+from fmridenoise.interfaces.quality_measures import QualityMeasures, PipelinesQualityMeasures
+from fmridenoise.interfaces.report_creator import ReportCreator
+from fmridenoise.parcellation import DEFAULT_ATLAS, get_atlas_label
+from fmridenoise.utils.connectome import load_connectome
+from fmridenoise.utils.dataclasses.runtime_info import RuntimeInfo
+from fmridenoise.utils.entities import parse_file_entities_with_pipelines, build_path
+from fmridenoise.workflows.update import subject_connectome_file
+
+logger = logging.getLogger(__name__)
+
+
+def _save_derivative(in_file: str, base_entities: t.Dict[str, str]) -> str:
+    """Saves file with BIDSDataSink, replacing derivative saved before."""
+    path = build_path({**parse_file_entities_with_pipelines(in_file), **base_entities},
+                      BIDSDataSink.output_path_pattern)
+    if exists(path):
+        os.remove(path)
+    return BIDSDataSink(base_entities=base_entities, in_file=in_file).run().outputs.out_file
+
+
+def _group_subjects_files(conf_summary_file: str, subject_file: t.Callable[[str], str],
+                          hint: str = '') -> t.Tuple[t.List[str], bool]:
+    """
+    Files of subjects of group confounds summary. Files of subjects excluded
+    by motion criteria can be missing (fmridenoise compare with
+    --skip-excluded), then only files of included subjects are returned.
+
+    Returns:
+        Files of subjects and whether they are files of all subjects.
+    """
+    conf_summary = pd.read_csv(conf_summary_file, sep='\t', dtype={'subject': str})
+    files = [subject_file(subject) for subject in conf_summary['subject']]
+    missing = [not exists(path) for path in files]
+    if not any(missing):
+        return files, True
+    included = conf_summary['include'].astype(bool) if 'include' in conf_summary else [True] * len(files)
+    for path, is_missing, is_included in zip(files, missing, included):
+        if is_missing and is_included:
+            raise ValueError(f"{path} of subject included in {conf_summary_file} not found{hint}")
+    return [path for path, is_included in zip(files, included) if is_included], False
+
+
+def rebuild_connectivity(fmridenoise_dir: str, atlases: t.Sequence[str] = (DEFAULT_ATLAS, ),
+                         kind: str = 'correlation') -> t.List[str]:
+    """
+    Recalculates subjects connectomes (with their plots) and group connectomes
+    from parcels time series saved by fmridenoise compare, without any
+    denoising. Subjects of each pipeline (and task, session and run) are
+    taken from its group confounds summary, so rows of group connectomes
+    follow it as in fmridenoise compare (only included subjects if time
+    series of excluded subjects were not saved, see --skip-excluded).
+    Derivatives are replaced in place, quality measures are not recalculated.
+
+    Args:
+        fmridenoise_dir: fmridenoise derivatives directory (output of
+            fmridenoise compare)
+        atlases: atlases (default atlas or parcellation files) of saved time
+            series, the same as given to fmridenoise compare
+        kind: connectivity kind (see
+            fmridenoise.interfaces.connectivity.CONNECTIVITY_KINDS)
+
+    Returns:
+        Paths of saved derivatives.
+    """
+    fmridenoise_dir = os.path.abspath(fmridenoise_dir)
+    conf_summary_files = sorted(glob.glob(join(fmridenoise_dir, '**', '*_groupConfSummary.tsv'), recursive=True))
+    if not conf_summary_files:
+        raise ValueError(f"No group confounds summaries found in {fmridenoise_dir}")
+    base_entities = {'bids_dir': dirname(dirname(fmridenoise_dir)), 'derivative': basename(fmridenoise_dir)}
+    saved = []
+    for conf_summary_file in conf_summary_files:
+        group_entities = {key: value for key, value in parse_file_entities_with_pipelines(conf_summary_file).items()
+                          if key in ('session', 'task', 'run', 'pipeline')}
+        for atlas in atlases:
+            entities = {**group_entities, **base_entities, 'atlas': get_atlas_label(atlas),
+                        'suffix': 'timeseries', 'extension': 'npy'}
+            time_series_files, _ = _group_subjects_files(
+                conf_summary_file,
+                lambda subject: build_path({**entities, 'subject': subject}, BIDSDataSink.output_path_pattern),
+                ", outputs of fmridenoise versions not saving time series have to be recreated with "
+                "fmridenoise compare")
+            logger.info(f"Rebuilding connectivity of {len(time_series_files)} subjects of {conf_summary_file}"
+                        f" (atlas {atlas})")
+            with tempfile.TemporaryDirectory() as temp_dir:
+                corr_mats = []
+                for time_series_file in time_series_files:
+                    outputs = Connectivity(time_series=time_series_file, atlas=atlas, kind=kind,
+                                           output_dir=temp_dir).run().outputs
+                    corr_mats.append(outputs.corr_mat)
+                    saved += [_save_derivative(path, base_entities)
+                              for path in (outputs.corr_mat, outputs.carpet_plot, outputs.matrix_plot)]
+                group_corr_mat = GroupConnectivity(corr_mat=corr_mats, kind=kind,
+                                                   output_dir=temp_dir).run().outputs.group_corr_mat
+                saved.append(_save_derivative(group_corr_mat, base_entities))
+    return saved
+
+
+# outputs of group stages saved by fmridenoise compare
+_QUALITY_MEASURES_OUTPUTS = ('motion_plot', 'corr_matrix_plot', 'corr_matrix_no_high_motion_plot')
+_PIPELINES_QUALITY_MEASURES_OUTPUTS = (
+    'pipelines_fc_fd_summary', 'pipelines_edges_weight', 'pipelines_edges_weight_clean',
+    'plot_pipelines_edges_density', 'plot_pipelines_edges_density_no_high_motion', 'plot_pipelines_fc_fd_pearson',
+    'plot_pipelines_fc_fd_pearson_no_high_motion', 'plot_pipelines_fc_fd_uncorr',
+    'plot_pipelines_distance_dependence', 'plot_pipelines_distance_dependence_no_high_motion',
+    'plot_pipelines_tdof_loss')
+# report inputs of PipelinesQualityMeasures and QualityMeasures outputs
+_REPORT_INPUTS = {
+    'plot_pipelines_edges_density': 'plots_all_pipelines_edges_density',
+    'plot_pipelines_edges_density_no_high_motion': 'plots_all_pipelines_edges_density_no_high_motion',
+    'plot_pipelines_fc_fd_pearson': 'plots_all_pipelines_fc_fd_pearson_info',
+    'plot_pipelines_fc_fd_pearson_no_high_motion': 'plots_all_pipelines_fc_fd_pearson_info_no_high_motion',
+    'plot_pipelines_distance_dependence': 'plots_all_pipelines_distance_dependence',
+    'plot_pipelines_distance_dependence_no_high_motion': 'plots_all_pipelines_distance_dependence_no_high_motion',
+    'plot_pipelines_tdof_loss': 'plots_all_pipelines_tdof_loss',
+    'corr_matrix_plot': 'plots_pipeline_fc_fd_pearson_matrix',
+    'corr_matrix_no_high_motion_plot': 'plots_pipeline_fc_fd_pearson_matrix_no_high_motion'}
+
+
+def _pipeline_of(path: str, pipelines: t.Dict[str, dict]) -> dict:
+    pipeline_name = parse_file_entities_with_pipelines(path)['pipeline']
+    if pipeline_name not in pipelines:
+        raise ValueError(f"Unknown pipeline {pipeline_name} of {path}, known pipelines: {list(pipelines)}")
+    return pipelines[pipeline_name]
+
+
+def _summary_inclusion(summary: t.Dict[str, t.Any], pipeline: dict) -> bool:
+    """
+    Inclusion of subject by motion criteria of pipeline, decided from its
+    saved confounds summary. Outlier scans are not recounted, number of
+    outlier scans found with thresholds of fmridenoise compare is used.
+    """
+    n_spikes = summary.get('n_spikes')
+    if n_spikes is None or pd.isna(n_spikes) or n_spikes == 0:
+        spikes_fraction = 0
+    else:
+        # number of volumes is not saved, it is recovered from percent of outlier scans
+        spikes_fraction = n_spikes / round(n_spikes * 100 / summary['perc_spikes'])
+    return motion_inclusion(pipeline, summary['mean_fd'], summary['max_fd'], spikes_fraction)
+
+
+def _group_conf_summaries(fmridenoise_dir: str, pipelines: t.Dict[str, dict], base_entities: t.Dict[str, str],
+                          temp_dir: str) -> t.List[str]:
+    """
+    Group confounds summaries of subjects confounds summaries (saved with
+    them), or of group confounds summaries saved by versions not saving
+    subjects confounds summaries. Inclusion of subjects is decided again by
+    motion criteria of given pipelines and saved summaries are updated.
+    """
+    summary_files = sorted(glob.glob(join(fmridenoise_dir, '**', 'sub-*_summary.json'), recursive=True))
+    if not summary_files:
+        conf_summary_files = sorted(glob.glob(join(fmridenoise_dir, '**', '*_groupConfSummary.tsv'), recursive=True))
+        if not conf_summary_files:
+            raise ValueError(f"No confounds summaries found in {fmridenoise_dir}")
+        logger.info("No subjects confounds summaries found, saved group confounds summaries are used")
+        paths = []
+        for path in conf_summary_files:
+            pipeline = _pipeline_of(path, pipelines)
+            conf_summary = pd.read_csv(path, sep='\t', dtype={'subject': str})
+            conf_summary['include'] = [_summary_inclusion(summary, pipeline)
+                                       for summary in conf_summary.to_dict('records')]
+            conf_summary.to_csv(join(temp_dir, basename(path)), sep='\t', index=False)
+            paths.append(_save_derivative(join(temp_dir, basename(path)), base_entities))
+        return paths
+    groups = {}
+    for path in summary_files:
+        pipeline = _pipeline_of(path, pipelines)
+        with open(path, 'r') as f:
+            summary = json.load(f)
+        summary['include'] = _summary_inclusion(summary, pipeline)
+        with open(join(temp_dir, basename(path)), 'w') as f:
+            json.dump(summary, f)
+        entities = parse_file_entities_with_pipelines(path)
+        groups.setdefault(tuple(entities.get(key) for key in ('session', 'task', 'run', 'pipeline')), []).append(
+            _save_derivative(join(temp_dir, basename(path)), base_entities))
+    return [_save_derivative(GroupConfounds(conf_summary_json_files=paths,
+                                            output_dir=temp_dir).run().outputs.group_conf_summary, base_entities)
+            for paths in groups.values()]
+
+
+def rerun_quality_measures(fmridenoise_dir: str, pipelines: t.List[dict],
+                           atlases: t.Sequence[str] = (DEFAULT_ATLAS, ), n_permutations: int = 0,
+                           n_bootstrap: int = 0, n_procs: int = 1) -> t.List[str]:
+    """
+    Reruns group stages of fmridenoise compare (group confounds summaries,
+    group connectomes, quality measures of pipelines and report) from
+    subjects confounds summaries and connectivity matrices saved by
+    fmridenoise compare, without denoising. Subjects of group connectomes
+    follow group confounds summaries, derivatives are replaced in place.
+    Subjects are included or excluded by motion criteria of given pipelines
+    (so thresholds can be changed without denoising), from mean and max
+    framewise displacement and number of outlier scans saved in confounds
+    summaries; outlier scans are not recounted with new thresholds. If
+    connectivity matrices of excluded subjects were not saved (see
+    --skip-excluded), quality measures are calculated only for subjects
+    without high motion.
+
+    Args:
+        fmridenoise_dir: fmridenoise derivatives directory (output of
+            fmridenoise compare)
+        pipelines: pipelines of derivatives (matched by name), their motion
+            criteria decide inclusion of subjects
+        atlases: atlases (default atlas or parcellation files) of saved
+            connectivity matrices, the same as given to fmridenoise compare
+        n_permutations: see QualityMeasures
+        n_bootstrap: see QualityMeasures
+        n_procs: see QualityMeasures
+
+    Returns:
+        Paths of saved derivatives.
+    """
+    fmridenoise_dir = os.path.abspath(fmridenoise_dir)
+    base_entities = {'bids_dir': dirname(dirname(fmridenoise_dir)), 'derivative': basename(fmridenoise_dir)}
+    pipelines = {pipeline['name']: pipeline for pipeline in pipelines}
+    saved = []
+    report_inputs = {'excluded_subjects': [], 'warnings': [], **{name: [] for name in _REPORT_INPUTS.values()}}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        groups = {}
+        for conf_summary_file in _group_conf_summaries(fmridenoise_dir, pipelines, base_entities, temp_dir):
+            entities = parse_file_entities_with_pipelines(conf_summary_file)
+            groups.setdefault(tuple(entities.get(key) for key in ('session', 'task', 'run')), []).append(
+                (pipelines[entities['pipeline']], conf_summary_file))
+        for (session, task, run), group in groups.items():
+            for atlas in atlases:
+                atlas_outputs = AtlasSelector(atlas=atlas, output_dir=temp_dir).run().outputs
+                quality_measures = []
+                for pipeline, conf_summary_file in group:
+                    entities = {key: value for key, value in parse_file_entities_with_pipelines(
+                        conf_summary_file).items() if key in ('session', 'task', 'run', 'pipeline')}
+                    entities.update(base_entities, atlas=get_atlas_label(atlas))
+
+                    corr_mats, all_subjects = _group_subjects_files(
+                        conf_summary_file, lambda subject: subject_connectome_file(entities, subject))
+                    kind = load_connectome(corr_mats[0]).kind
+                    group_corr_mat = _save_derivative(GroupConnectivity(
+                        corr_mat=corr_mats, kind='tangent' if kind == 'covariance' else kind,
+                        output_dir=temp_dir).run().outputs.group_corr_mat, base_entities)
+                    outputs = QualityMeasures(group_corr_mat=group_corr_mat, group_conf_summary=conf_summary_file,
+                                              distance_matrix=atlas_outputs.distance_matrix, pipeline=pipeline,
+                                              n_permutations=n_permutations, n_bootstrap=n_bootstrap,
+                                              n_procs=n_procs, all_subjects=all_subjects,
+                                              output_dir=temp_dir).run().outputs
+                    for name in _QUALITY_MEASURES_OUTPUTS:
+                        if isdefined(getattr(outputs, name)):
+                            setattr(outputs, name, _save_derivative(getattr(outputs, name), base_entities))
+                    saved += [group_corr_mat, *(getattr(outputs, name) for name in _QUALITY_MEASURES_OUTPUTS)]
+                    quality_measures.append(outputs)
+                    report_inputs['excluded_subjects'].append(outputs.excluded_subjects)
+                    if isdefined(outputs.warnings):
+                        report_inputs['warnings'] += outputs.warnings
+                    for name in ('corr_matrix_plot', 'corr_matrix_no_high_motion_plot'):
+                        report_inputs[_REPORT_INPUTS[name]].append(getattr(outputs, name))
+                pipelines_quality_measures = PipelinesQualityMeasures(
+                    **{name: [getattr(outputs, name) for outputs in quality_measures]
+                       for name in ('fc_fd_summary', 'edges_weight', 'edges_weight_clean',
+                                    'fc_fd_corr_values', 'fc_fd_corr_values_clean')},
+                    task=task, output_dir=temp_dir)
+                for name, value in (('session', session), ('run', run), ('atlas', atlas_outputs.atlas_label)):
+                    if value is not None and isdefined(value):
+                        setattr(pipelines_quality_measures.inputs, name, value)
+                outputs = pipelines_quality_measures.run().outputs
+                for name in _PIPELINES_QUALITY_MEASURES_OUTPUTS:
+                    if isdefined(getattr(outputs, name)):
+                        saved.append(_save_derivative(getattr(outputs, name), base_entities))
+                        if name in _REPORT_INPUTS:
+                            report_inputs[_REPORT_INPUTS[name]].append(saved[-1])
+        report_dir = join(fmridenoise_dir, 'report')
+        os.makedirs(report_dir, exist_ok=True)
+        report_creator = ReportCreator(
+            runtime_info=RuntimeInfo(input_args=' '.join(sys.argv), version=get_versions().get('version')),
+            pipelines=list({pipeline['name']: pipeline for group in groups.values() for pipeline, _ in group}.values()),
+            tasks=sorted({task for _, task, _ in groups}),
+            output_dir=report_dir,
+            **report_inputs)
+        sessions = sorted({session for session, _, _ in groups if session is not None})
+        runs = sorted({run for _, _, run in groups if run is not None})
+        if sessions:
+            report_creator.inputs.sessions = sessions
+        if runs:
+            report_creator.inputs.runs = runs
+        report_creator.run()
+    return [path for path in saved if isdefined(path)]
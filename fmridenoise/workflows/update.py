@@ -0,0 +1,180 @@
+import glob
+import logging
+import os
+import typing as t
+from os.path import join, dirname, basename
+
+import numpy as np
+import pandas as pd
+
+from fmridenoise.interfaces.bids import BIDSDataSink
+from fmridenoise.interfaces.quality_measures import QualityMeasures, PipelinesQualityMeasures
+from fmridenoise.parcellation import DEFAULT_ATLAS, get_atlas_label, get_atlas_distance_matrix_file, \
+    load_distance_ranks
+from fmridenoise.utils.connectome import load_connectome
+from fmridenoise.utils.entities import parse_file_entities_with_pipelines, build_path
+from fmridenoise.utils.group_statistics import GroupStatistics
+
+logger = logging.getLogger(__name__)
+
+
+group_statistics_pattern = "[ses-{session}_]task-{task}_[run-{run}_][atlas-{atlas}_]pipeline-{pipeline}_groupStats.npz"
+
+
+def _group_entities(path: str) -> t.Dict[str, str]:
+    entities = parse_file_entities_with_pipelines(path)
+    return {key: entities[key] for key in ('session', 'task', 'run', 'atlas', 'pipeline') if key in entities}
+
+
+def subject_connectome_file(entities: t.Dict[str, str], subject: str) -> str:
+    """
+    Connectivity matrix file of subject saved by fmridenoise compare (or
+    fmridenoise connectivity) in derivatives given by entities (bids_dir,
+    derivative, and session, task, run, atlas and pipeline of matrix). Full
+    connectivity matrix (.npy) saved by previous versions is returned if
+    there is no connectome (.npz) of subject.
+    """
+    entities = {**entities, 'subject': subject, 'suffix': 'connMat'}
+    path = build_path({**entities, 'extension': 'npz'}, BIDSDataSink.output_path_pattern)
+    if not os.path.exists(path):
+        return build_path({**entities, 'extension': 'npy'}, BIDSDataSink.output_path_pattern)
+    return path
+
+
+def group_statistics_summary(state: GroupStatistics, distance_ranks: np.ndarray) -> t.List[dict]:
+    """
+    Quality measures of all subjects and of subjects without high motion (if
+    there are at least 2 of them) of group statistics state in the same format
+    as fc_fd_summary of QualityMeasures.
+
+    Args:
+        distance_ranks: normalized ranks of distance between regions of
+            each edge (see fmridenoise.parcellation.DistanceRanks)
+    """
+    summaries = []
+    for all_subjects, statistics in ((True, state.all_subjects), (False, state.clean_subjects)):
+        if not all_subjects and statistics.n < 2:
+            continue
+        conf_summary = state.conf_summary if all_subjects else \
+            state.conf_summary[state.conf_summary['include'] == True]
+        fc_fd_corr, fc_fd_pval = statistics.fc_fd_correlations()
+        summaries.append({'perc_fc_fd_uncorr': QualityMeasures._perc_fc_fd_uncorr(fc_fd_pval),
+                          'median_pearson_fc_fd': np.median(np.abs(fc_fd_corr)),
+                          'distance_dependence': QualityMeasures._distance_dependence(fc_fd_corr, distance_ranks),
+                          'tdof_loss': QualityMeasures._tdof_loss(conf_summary),
+                          'n_subjects': len(state.conf_summary),
+                          'n_excluded': len(state.conf_summary) - len(conf_summary),
+                          'all': all_subjects})
+    return summaries
+
+
+def _read_subjects(fmridenoise_dir: str, conf_summary_file: str, atlas: str,
+                   skip_subjects: t.Collection[str]) -> t.Optional[GroupStatistics]:
+    """
+    Reads confounds summary and connectivity matrices (of given atlas) of
+    subjects (other than skip_subjects) from fmridenoise derivatives directory.
+    """
+    conf_summary = pd.read_csv(conf_summary_file, sep='\t', dtype={'subject': str})
+    conf_summary = conf_summary[~conf_summary['subject'].isin(skip_subjects)]
+    if conf_summary.empty:
+        return None
+    entities = {**_group_entities(conf_summary_file),
+                'bids_dir': dirname(dirname(fmridenoise_dir)),
+                'derivative': basename(fmridenoise_dir),
+                'atlas': get_atlas_label(atlas)}
+
+    connectome_files = [subject_connectome_file(entities, subject) for subject in conf_summary['subject']]
+    missing = [path for path in connectome_files if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f"Connectivity matrix {missing[0]} not found, group statistics require connectivity of all "
+                         f"subjects (connectivity of excluded subjects is not estimated by fmridenoise compare "
+                         f"with --skip-excluded)")
+    connectomes = [load_connectome(path) for path in connectome_files]
+    if any(connectome.kind == 'covariance' for connectome in connectomes):
+        raise ValueError("Tangent space connectivity requires group reference and can't be updated with new "
+                         "subjects, run fmridenoise compare on whole group")
+    group_corr_vec = np.stack([connectome.edges for connectome in connectomes])
+    return GroupStatistics.from_subjects(conf_summary, group_corr_vec)
+
+
+def _save_pipelines_summaries(state_dir: str, states: t.Dict[str, GroupStatistics],
+                              distance_matrix_file: str) -> t.List[str]:
+    """
+    Saves quality measures and mean edge weights of all pipelines of each task
+    (and session and run) calculated from group statistics states.
+    """
+    distance_ranks = load_distance_ranks(distance_matrix_file).normalized_ranks
+    groups = {}
+    for state_file, state in sorted(states.items()):
+        entities = _group_entities(state_file)
+        pipeline = entities.pop('pipeline')
+        groups.setdefault(tuple(sorted(entities.items())), []).append((pipeline, state))
+    paths = []
+    for group_entities, pipelines in groups.items():
+        entities = {**dict(group_entities), 'desc': 'cohort'}
+        summary = PipelinesQualityMeasures.pipeline_summaries_to_dataframe(
+            [[{**summary, 'pipeline': pipeline} for summary in group_statistics_summary(state, distance_ranks)]
+             for pipeline, state in pipelines])
+        edges_weight = pd.DataFrame({pipeline: state.all_subjects.mean_edges for pipeline, state in pipelines})
+        edges_weight_clean = pd.DataFrame({pipeline: state.clean_subjects.mean_edges
+                                           for pipeline, state in pipelines if state.clean_subjects.n >= 2})
+        for suffix, data in (('pipelinesFcFdSummary', summary),
+                             ('pipelinesEdgesWeight', edges_weight),
+                             ('pipelinesEdgesWeightClean', edges_weight_clean)):
+            path = join(state_dir, build_path({**entities, 'suffix': suffix, 'extension': 'tsv'},
+                                              PipelinesQualityMeasures.data_files_pattern))
+            data.to_csv(path, sep='\t', index=False)
+            paths.append(path)
+    return paths
+
+
+def update_group_statistics(state_dir: str, fmridenoise_dirs: t.List[str], atlas: str = DEFAULT_ATLAS,
+                            distance_matrix_file: t.Optional[str] = None) -> t.List[str]:
+    """
+    Merges subjects from fmridenoise derivatives directories (outputs of
+    fmridenoise compare) into persistent group statistics states (one file per
+    pipeline, task, session, run and atlas) in state_dir. Only connectivity matrices
+    of subjects not yet included in states are read. Subjects already
+    included are skipped, so directories can be merged repeatedly. Then
+    quality measures and mean edge weights of all subjects in states are saved
+    to state_dir (with desc-cohort). States of other atlases in state_dir are
+    left untouched.
+
+    Args:
+        state_dir: directory with group statistics states (created if missing)
+        fmridenoise_dirs: fmridenoise derivatives directories with group
+            confounds summaries and subjects connectivity matrices
+        atlas: atlas of connectivity matrices (DEFAULT_ATLAS or parcellation
+            file path), the same as given to fmridenoise compare
+        distance_matrix_file: distance matrix of atlas parcels (.npy), if None
+            distance matrix of atlas (computed and saved in state_dir for
+            atlases other than default)
+
+    Returns:
+        Paths of saved summaries.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    atlas_label = get_atlas_label(atlas)
+    states = {path: GroupStatistics.load(path)
+              for path in glob.glob(join(state_dir, '*_groupStats.npz'))
+              if _group_entities(path).get('atlas') == atlas_label}
+    for fmridenoise_dir in fmridenoise_dirs:
+        fmridenoise_dir = os.path.abspath(fmridenoise_dir)
+        conf_summary_files = sorted(glob.glob(join(fmridenoise_dir, '**', '*_groupConfSummary.tsv'),
+                                              recursive=True))
+        if not conf_summary_files:
+            raise ValueError(f"No group confounds summaries found in {fmridenoise_dir}")
+        for conf_summary_file in conf_summary_files:
+            state_file = join(state_dir, build_path({**_group_entities(conf_summary_file), 'atlas': atlas_label},
+                                                    group_statistics_pattern))
+            state = states.get(state_file)
+            new_subjects = _read_subjects(fmridenoise_dir, conf_summary_file, atlas, state.subjects if state else [])
+            if new_subjects is None:
+                logger.info(f"No new subjects in {conf_summary_file}")
+                continue
+            logger.info(f"Merging {len(new_subjects.subjects)} new subjects from {conf_summary_file}")
+            states[state_file] = new_subjects if state is None else state.merge(new_subjects)
+            states[state_file].save(state_file)
+    if distance_matrix_file is None:
+        distance_matrix_file = get_atlas_distance_matrix_file(atlas, state_dir)
+    return _save_pipelines_summaries(state_dir, states, distance_matrix_file)
@@ -203,6 +203,33 @@ class TestConfoundsStandardCase(unittest.TestCase):
                     self.assertEqual(set(outlier_scans), set(outlier_detected))
 
 
+    def test_spike_censoring(self):
+        '''Check if outlier scans are censored in sample mask instead of
+        creating spike regressors when spikes mode is censor.'''
+        pipeline = copy.deepcopy(pipeline_null)
+
+        test_thrs = [(0.1, 0.1), (0.5, 1.5), (9.9, 9.9)]
+
+        for fd_th, dvars_th in test_thrs:
+            with self.subTest(f'Testing fd_th = {fd_th} and dvars_th = {dvars_th}'):
+                self.tearDown()
+                self.setUp()
+                pipeline['spikes'] = {'fd_th': fd_th, 'dvars_th': dvars_th, 'mode': 'censor'}
+
+                node = self._recreate_confounds_node(pipeline)
+                node.run()
+
+                outlier_scans = self.cg.get_outlier_scans(fd_th, dvars_th)
+                self.assertEmptyConfounds(node._results['conf_prep'])
+                sample_mask = pd.read_csv(node._results['sample_mask'], sep='\t')['sample_mask']
+                self.assertEqual(self.n_volumes, len(sample_mask))
+                self.assertEqual(set(outlier_scans), set(sample_mask[sample_mask == 0].index))
+                with open(node._results['conf_summary']) as f:
+                    summary_dict = json.load(f)
+                self.assertEqual(summary_dict['n_censored'], len(outlier_scans))
+                self.assertEqual(summary_dict['n_spikes'], len(outlier_scans))
+
+
     def test_conf_prep_name(self):
         '''Test whether preprocessed confounds table is saved as a file having 
         correct BIDS compliant name.'''
@@ -0,0 +1,79 @@
+import unittest
+import warnings
+
+import numpy as np
+from nilearn.connectome import ConnectivityMeasure
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from sklearn.covariance import LedoitWolf
+
+from fmridenoise.interfaces.connectivity import (correlation_matrices, ledoit_wolf_covariances,
+                                                 partial_correlation_matrices)
+
+
+class TestCorrelationMatrices(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        mixing = np.eye(30) + 0.3 * rng.randn(30, 30)
+        self.time_series = 10 + rng.randn(4, 120, 30) @ mixing
+        # constant parcel
+        self.time_series[1, :, 3] = 5
+
+    def test_same_as_nilearn(self):
+        """Expect correlation matrices of all time series equal to nilearn
+        ConnectivityMeasure (with Ledoit-Wolf shrinkage) applied to each of
+        them and time series not modified."""
+        time_series = self.time_series.copy()
+        expected = ConnectivityMeasure(kind='correlation').fit_transform(list(self.time_series))
+        assert_array_almost_equal(expected, correlation_matrices(time_series), decimal=12)
+        assert_array_equal(self.time_series, time_series)
+
+    def test_precision(self):
+        """Expect results in precision of time series."""
+        expected = ConnectivityMeasure(kind='correlation').fit_transform(list(self.time_series))
+        corr_mats = correlation_matrices(self.time_series.astype(np.float32))
+        self.assertEqual(np.float32, corr_mats.dtype)
+        assert_array_almost_equal(expected, corr_mats, decimal=5)
+
+    def test_constant_parcel_precision(self):
+        """Expect parcel constant up to rounding error of time series
+        precision (float32) treated as constant (not correlated with other
+        parcels), as in float64."""
+        time_series = self.time_series.astype(np.float32)
+        one = np.float32(1)
+        time_series[1, :, 3] = np.where(np.arange(120) % 2, one, np.nextafter(one, np.float32(2)))
+        corr_mats = correlation_matrices(time_series)
+        expected = correlation_matrices(self.time_series)
+        assert_array_almost_equal(0, np.delete(corr_mats[1, 3], 3), decimal=6)
+        assert_array_almost_equal(expected[1, 3], corr_mats[1, 3], decimal=6)
+
+    def test_fisher_z(self):
+        """Expect arctanh of correlations with zero diagonal."""
+        corr_mats = correlation_matrices(self.time_series)
+        z_mats = correlation_matrices(self.time_series, fisher_z=True)
+        off_diagonal = ~np.eye(30, dtype=bool)
+        assert_array_almost_equal(np.arctanh(corr_mats[:, off_diagonal]), z_mats[:, off_diagonal])
+        assert_array_equal(0, np.diagonal(z_mats, axis1=1, axis2=2))
+
+    def test_single_parcel(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            assert_array_equal([[[1.]]], correlation_matrices(self.time_series[:1, :, :1]))
+
+
+class TestOtherKinds(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        mixing = np.eye(30) + 0.3 * rng.randn(30, 30)
+        self.time_series = 10 + rng.randn(4, 120, 30) @ mixing
+
+    def test_ledoit_wolf(self):
+        """Expect covariances equal to sklearn LedoitWolf fitted to each time series."""
+        expected = [LedoitWolf().fit(time_series).covariance_ for time_series in self.time_series]
+        assert_array_almost_equal(expected, ledoit_wolf_covariances(self.time_series), decimal=12)
+
+    def test_partial_correlation_same_as_nilearn(self):
+        expected = ConnectivityMeasure(kind='partial correlation').fit_transform(list(self.time_series))
+        assert_array_almost_equal(expected, partial_correlation_matrices(self.time_series), decimal=10)
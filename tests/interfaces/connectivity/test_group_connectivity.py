@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from nilearn.connectome import ConnectivityMeasure, sym_matrix_to_vec, vec_to_sym_matrix
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from traits.trait_base import Undefined
+
+from fmridenoise.interfaces.connectivity import GroupConnectivity, ledoit_wolf_covariances
+from fmridenoise.utils.connectome import CONNECTOME_DTYPE, save_connectome, load_group_connectome
+
+
+class TestGroupConnectivity(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        matrices = rng.rand(3, 7, 7)
+        self.matrices = (matrices + matrices.transpose(0, 2, 1)) / 2
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def save_connectomes(self, atlases, kind='correlation') -> list:
+        paths = []
+        for i, (matrix, atlas) in enumerate(zip(self.matrices, atlases)):
+            path = os.path.join(self.temp_dir.name, f'sub-0{i}_task-rest_pipeline-Null_connMat.npz')
+            save_connectome(path, matrix, atlas, kind)
+            paths.append(path)
+        return paths
+
+    def test_group_connectome(self):
+        """Expect edges of all subjects stacked with number of regions of connectomes."""
+        result = GroupConnectivity(corr_mat=self.save_connectomes(['atlas-test'] * 3),
+                                   output_dir=self.temp_dir.name).run()
+        self.assertEqual('task-rest_pipeline-Null_groupCorrMat.npy',
+                         os.path.basename(result.outputs.group_corr_mat))
+        group_corr_vec = load_group_connectome(result.outputs.group_corr_mat, mmap_mode='r')
+        self.assertIsInstance(group_corr_vec, np.memmap)
+        assert_array_equal(sym_matrix_to_vec(self.matrices).astype(CONNECTOME_DTYPE), group_corr_vec)
+
+    def test_undefined_connectomes(self):
+        """Expect undefined connectomes (of subjects not denoised) left out."""
+        paths = self.save_connectomes(['atlas-test'] * 3)
+        result = GroupConnectivity(corr_mat=[paths[0], Undefined, paths[2]],
+                                   output_dir=self.temp_dir.name).run()
+        assert_array_equal(sym_matrix_to_vec(self.matrices[[0, 2]]).astype(CONNECTOME_DTYPE),
+                           load_group_connectome(result.outputs.group_corr_mat))
+        with self.assertWarns(UserWarning):
+            result = GroupConnectivity(corr_mat=[Undefined] * 3, output_dir=self.temp_dir.name).run()
+        self.assertIs(Undefined, result.outputs.group_corr_mat)
+
+    def test_different_atlases(self):
+        """Expect error and no group connectome for connectomes of different atlases."""
+        with self.assertRaises(ValueError):
+            GroupConnectivity(corr_mat=self.save_connectomes(['atlas-test', 'atlas-test', 'atlas-other']),
+                              output_dir=self.temp_dir.name).run()
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, 'task-rest_pipeline-Null_groupCorrMat.npy')))
+
+    def test_different_kind(self):
+        """Expect error for correlation matrices of tangent connectivity."""
+        with self.assertRaises(ValueError):
+            GroupConnectivity(corr_mat=self.save_connectomes(['atlas-test'] * 3), kind='tangent',
+                              output_dir=self.temp_dir.name).run()
+
+    def test_tangent(self):
+        """Expect covariances projected to tangent space at their geometric
+        mean as by nilearn, when subjects are processed in multiple chunks."""
+        rng = np.random.RandomState(0)
+        time_series = rng.randn(5, 100, 7) @ (np.eye(7) + 0.3 * rng.randn(7, 7))
+        self.matrices = ledoit_wolf_covariances(time_series)
+        with mock.patch('fmridenoise.interfaces.connectivity._TANGENT_CHUNK_SIZE', 2):
+            result = GroupConnectivity(corr_mat=self.save_connectomes(['atlas-test'] * 5, kind='covariance'),
+                                       output_dir=self.temp_dir.name, kind='tangent').run()
+        expected = ConnectivityMeasure(kind='tangent').fit_transform(list(time_series))
+        group_corr_vec = load_group_connectome(result.outputs.group_corr_mat)
+        assert_array_almost_equal(expected, vec_to_sym_matrix(group_corr_vec), decimal=5)
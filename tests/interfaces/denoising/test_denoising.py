@@ -5,10 +5,17 @@ import os
 
 import pandas as pd
 import numpy as np
+import nibabel as nb
+from nilearn.image import clean_img, resample_to_img
+from nilearn.signal import clean
+from nilearn.input_data import NiftiLabelsMasker
 from nipype import Node
+from numpy.testing import assert_array_almost_equal
 from traits.trait_base import Undefined
 
-from fmridenoise.interfaces.denoising import Denoise
+from fmridenoise.interfaces.denoising import Denoise, PipelinesDenoise, load_confounds
+from fmridenoise.interfaces.connectivity import correlation_matrices
+from fmridenoise.parcellation import get_parcellation_file_path, DEFAULT_ATLAS
 from tests.utils import fmri_prep_filename, confound_filename, pipeline_null
 
 
@@ -253,3 +260,292 @@ class MinorWorkflowIntegrationTestCase(unittest.TestCase):
         self.fmri_prep_aroma = Undefined
         node = self.build_node()
         node.run()
+
+
+class TestPipelinesDenoise(unittest.TestCase):
+    sub = '01'
+    ses = '1'
+    task = 'test'
+    n_volumes = 40
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.out_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        data = 100 + rng.randn(6, 5, 4, self.n_volumes)
+        data[0] = 0  # background voxels
+        self.fmri_prep = os.path.join(
+            self.temp_dir.name,
+            fmri_prep_filename(self.sub, self.ses, self.task, False))
+        self.fmri_prep_aroma = os.path.join(
+            self.temp_dir.name,
+            fmri_prep_filename(self.sub, self.ses, self.task, True))
+        nb.save(nb.Nifti1Image(data, np.eye(4)), self.fmri_prep)
+        nb.save(nb.Nifti1Image(data[::-1], np.eye(4)), self.fmri_prep_aroma)
+
+        self.pipelines, self.conf_preps = [], []
+        for name, aroma, n_conf in (('A', False, 0), ('B', False, 3), ('C', True, 2)):
+            pipeline = copy.deepcopy(pipeline_null)
+            pipeline['name'] = name
+            pipeline['aroma'] = aroma
+            conf_prep = os.path.join(self.temp_dir.name, f'pipeline-{name}_confounds.tsv')
+            pd.DataFrame(rng.randn(self.n_volumes, n_conf)).to_csv(conf_prep, sep='\t', index=False)
+            self.pipelines.append(pipeline)
+            self.conf_preps.append(conf_prep)
+        self.tr_dict = {self.task: 2}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        self.out_dir.cleanup()
+
+    def test_same_as_clean_img(self):
+        """Expect that each output is identical to single pipeline denoising
+        with clean_img and returned in order of input pipelines."""
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            fmri_prep_aroma=self.fmri_prep_aroma,
+            conf_prep=self.conf_preps,
+            pipeline=self.pipelines,
+            output_dir=self.out_dir.name,
+            tr_dict=self.tr_dict,
+            high_pass=1/128,
+            low_pass=1/5)
+        result = denoise.run()
+        self.assertEqual(3, len(result.outputs.fmri_denoised))
+        for fmri_denoised, pipeline, conf_prep in zip(result.outputs.fmri_denoised, self.pipelines, self.conf_preps):
+            self.assertIn(f"pipeline-{pipeline['name']}_", fmri_denoised)
+            fmri_file = self.fmri_prep_aroma if pipeline['aroma'] else self.fmri_prep
+            confounds = load_confounds(conf_prep)
+            expected = clean_img(nb.load(fmri_file), confounds=confounds,
+                                 high_pass=1/128, low_pass=1/5, t_r=2)
+            assert_array_almost_equal(expected.get_fdata(), nb.load(fmri_denoised).get_fdata())
+
+    def test_missing_aroma_file(self):
+        """Expect FileNotFoundError if any of pipelines requires missing file."""
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            conf_prep=self.conf_preps,
+            pipeline=self.pipelines,
+            output_dir=self.out_dir.name)
+        with self.assertRaises(FileNotFoundError):
+            denoise.run()
+
+    def test_excluded_pipelines(self):
+        """Expect pipelines excluding subject skipped (and their image not
+        required)."""
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            conf_prep=self.conf_preps,
+            pipeline=self.pipelines,
+            include=[False, True, False],
+            output_dir=self.out_dir.name,
+            tr_dict=self.tr_dict)
+        result = denoise.run()
+        self.assertEqual(1, len(result.outputs.fmri_denoised))
+        self.assertIn("pipeline-B_", result.outputs.fmri_denoised[0])
+        self.assertTrue(all("pipeline-B_" in path for path in result.outputs.time_series))
+
+    def test_inconsistent_inputs(self):
+        """Expect ValueError if number of confounds files differs from number
+        of pipelines."""
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            fmri_prep_aroma=self.fmri_prep_aroma,
+            conf_prep=self.conf_preps[:2],
+            pipeline=self.pipelines,
+            output_dir=self.out_dir.name)
+        with self.assertRaises(ValueError):
+            denoise.run()
+
+    def test_parcels_same_as_voxels_without_standardization(self):
+        """Expect parcels time series equal to parcels averages of voxelwise
+        denoised image when voxels are not standardized (all denoising steps
+        apart from standardization are linear) and image read in blocks
+        within memory budget."""
+        rng = np.random.RandomState(1)
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        img = nb.Nifti1Image(100 + rng.randn(24, 28, 24, self.n_volumes), affine)
+        nb.save(img, self.fmri_prep)
+        pipelines = [pipeline for pipeline in self.pipelines if not pipeline['aroma']]
+        conf_preps = [conf for conf, pipeline in zip(self.conf_preps, self.pipelines) if not pipeline['aroma']]
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            conf_prep=conf_preps,
+            pipeline=pipelines,
+            output_dir=self.out_dir.name,
+            tr_dict=self.tr_dict,
+            high_pass=1/128,
+            low_pass=1/5,
+            denoise_space='parcels',
+            mem_mb=1)
+        result = denoise.run()
+        self.assertEqual(Undefined, result.outputs.fmri_denoised)
+        self.assertLess(result.outputs.mem_peak_mb, 1)
+        masker = NiftiLabelsMasker(labels_img=get_parcellation_file_path('MNI152NLin2009cAsym'), standardize=True)
+        for time_series, pipeline, conf_prep in zip(result.outputs.time_series, pipelines, conf_preps):
+            self.assertIn(f"pipeline-{pipeline['name']}_", time_series)
+            denoised_img = clean_img(img, confounds=load_confounds(conf_prep), standardize=False,
+                                     high_pass=1/128, low_pass=1/5, t_r=2)
+            assert_array_almost_equal(masker.fit_transform(denoised_img), np.load(time_series))
+
+    def test_parcels_same_connectivity_as_voxels_for_scaled_voxels(self):
+        """Expect the same connectomes as voxelwise denoising (with
+        standardization of voxels) when voxels of each parcel differ only
+        in offset and scale, so standardization weights all voxels of parcel
+        equally."""
+        rng = np.random.RandomState(1)
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        parcellation = nb.load(get_parcellation_file_path('MNI152NLin2009cAsym'))
+        labels = np.round(resample_to_img(parcellation, nb.Nifti1Image(np.zeros((24, 28, 24)), affine),
+                                          interpolation='nearest').get_fdata()).astype(int)
+        signals = rng.randn(labels.max() + 1, self.n_volumes)
+        data = 100 + rng.rand(*labels.shape, 1) + rng.uniform(0.5, 2, (*labels.shape, 1)) * signals[labels]
+        nb.save(nb.Nifti1Image(data, affine), self.fmri_prep)
+        pipelines = [pipeline for pipeline in self.pipelines if not pipeline['aroma']]
+        conf_preps = [conf for conf, pipeline in zip(self.conf_preps, self.pipelines) if not pipeline['aroma']]
+        connectomes = {}
+        for denoise_space in ('voxels', 'parcels'):
+            output_dir = os.path.join(self.out_dir.name, denoise_space)
+            os.makedirs(output_dir)
+            result = PipelinesDenoise(
+                fmri_prep=self.fmri_prep,
+                conf_prep=conf_preps,
+                pipeline=pipelines,
+                output_dir=output_dir,
+                tr_dict=self.tr_dict,
+                high_pass=1/128,
+                low_pass=1/5,
+                save_denoised_bold=False,
+                denoise_space=denoise_space).run()
+            connectomes[denoise_space] = correlation_matrices(
+                np.stack([np.load(path) for path in result.outputs.time_series]).astype(np.float64))
+        assert_array_almost_equal(connectomes['voxels'], connectomes['parcels'], decimal=6)
+
+    def test_projector_cache(self):
+        """Expect single cached projector for each pipeline reused by next
+        denoising with the same results."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = []
+            for _ in range(2):
+                output_dir = tempfile.mkdtemp(dir=self.out_dir.name)
+                denoise = PipelinesDenoise(
+                    fmri_prep=self.fmri_prep,
+                    fmri_prep_aroma=self.fmri_prep_aroma,
+                    conf_prep=self.conf_preps,
+                    pipeline=self.pipelines,
+                    output_dir=output_dir,
+                    tr_dict=self.tr_dict,
+                    high_pass=1/128,
+                    low_pass=1/5,
+                    projector_cache=cache_dir)
+                results.append(denoise.run().outputs.fmri_denoised)
+                self.assertEqual(3, len(os.listdir(cache_dir)))
+            for first, second in zip(*results):
+                assert_array_almost_equal(nb.load(first).get_fdata(), nb.load(second).get_fdata())
+
+    def test_censoring(self):
+        """Expect censored volumes removed from denoised images with results
+        identical to nilearn.signal.clean with the same sample mask."""
+        retained = np.ones(self.n_volumes, dtype=bool)
+        retained[[0, 7, 8, 30]] = False
+        sample_mask = os.path.join(self.temp_dir.name, 'sample_mask.tsv')
+        pd.DataFrame({'sample_mask': retained.astype(int)}).to_csv(sample_mask, sep='\t', index=False)
+        denoise = PipelinesDenoise(
+            fmri_prep=self.fmri_prep,
+            fmri_prep_aroma=self.fmri_prep_aroma,
+            conf_prep=self.conf_preps,
+            sample_mask=[sample_mask] * len(self.pipelines),
+            pipeline=self.pipelines,
+            output_dir=self.out_dir.name,
+            tr_dict=self.tr_dict,
+            high_pass=1/128,
+            low_pass=1/5)
+        result = denoise.run()
+        for fmri_denoised, pipeline, conf_prep in zip(result.outputs.fmri_denoised, self.pipelines, self.conf_preps):
+            fmri_file = self.fmri_prep_aroma if pipeline['aroma'] else self.fmri_prep
+            data = nb.load(fmri_file).get_fdata()
+            mask = np.any(data, axis=-1)
+            expected = np.zeros(data.shape[:-1] + (retained.sum(),))
+            expected[mask] = clean(data[mask].T, confounds=load_confounds(conf_prep),
+                                   sample_mask=np.flatnonzero(retained), high_pass=1/128, low_pass=1/5, t_r=2).T
+            denoised = nb.load(fmri_denoised)
+            self.assertEqual(retained.sum(), denoised.shape[-1])
+            assert_array_almost_equal(expected, denoised.get_fdata())
+
+    def test_time_series_same_as_masker(self):
+        """Expect parcels time series equal to NiftiLabelsMasker applied to
+        denoised images and no denoised images without save_denoised_bold."""
+        rng = np.random.RandomState(1)
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        img = nb.Nifti1Image(100 + rng.randn(24, 28, 24, self.n_volumes), affine)
+        nb.save(img, self.fmri_prep)
+        nb.save(img, self.fmri_prep_aroma)
+        results = {}
+        for save_denoised_bold in (True, False):
+            output_dir = tempfile.mkdtemp(dir=self.out_dir.name)
+            denoise = PipelinesDenoise(
+                fmri_prep=self.fmri_prep,
+                fmri_prep_aroma=self.fmri_prep_aroma,
+                conf_prep=self.conf_preps,
+                pipeline=self.pipelines,
+                output_dir=output_dir,
+                tr_dict=self.tr_dict,
+                high_pass=1/128,
+                low_pass=1/5,
+                mem_mb=1,
+                save_denoised_bold=save_denoised_bold)
+            results[save_denoised_bold] = denoise.run().outputs
+            self.assertEqual(save_denoised_bold, any(path.endswith('.nii.gz') for path in os.listdir(output_dir)))
+        self.assertEqual(Undefined, results[False].fmri_denoised)
+        masker = NiftiLabelsMasker(labels_img=get_parcellation_file_path('MNI152NLin2009cAsym'), standardize=True)
+        for fmri_denoised, time_series, fused_time_series in zip(results[True].fmri_denoised,
+                                                                 results[True].time_series,
+                                                                 results[False].time_series):
+            expected = masker.fit_transform(fmri_denoised)
+            assert_array_almost_equal(expected, np.load(time_series))
+            assert_array_almost_equal(expected, np.load(fused_time_series))
+
+    def test_multiple_atlases(self):
+        """Expect time series of each pipeline for every atlas (with atlas
+        entity for atlases other than default one) equal to NiftiLabelsMasker
+        of the atlas applied to denoised images, in both denoise spaces."""
+        rng = np.random.RandomState(1)
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        img = nb.Nifti1Image(100 + rng.randn(24, 28, 24, self.n_volumes), affine)
+        nb.save(img, self.fmri_prep)
+        labels = np.zeros(img.shape[:3], dtype=np.int16)
+        labels[4:20, 4:24, 4:20] = 1 + np.arange(16)[:, None, None] // 8 + 2 * (np.arange(16)[None, None, :] // 8)
+        atlas = os.path.join(self.temp_dir.name, 'tpl-MNI152NLin2009cAsym_atlas-Test_desc-4Parcels_dseg.nii.gz')
+        nb.save(nb.Nifti1Image(labels, affine), atlas)
+        pipelines = [pipeline for pipeline in self.pipelines if not pipeline['aroma']]
+        conf_preps = [conf for conf, pipeline in zip(self.conf_preps, self.pipelines) if not pipeline['aroma']]
+        maskers = [NiftiLabelsMasker(labels_img=get_parcellation_file_path('MNI152NLin2009cAsym'), standardize=True),
+                   NiftiLabelsMasker(labels_img=atlas, standardize=True)]
+        for denoise_space in ('voxels', 'parcels'):
+            denoise = PipelinesDenoise(
+                fmri_prep=self.fmri_prep,
+                conf_prep=conf_preps,
+                pipeline=pipelines,
+                output_dir=tempfile.mkdtemp(dir=self.out_dir.name),
+                tr_dict=self.tr_dict,
+                high_pass=1/128,
+                low_pass=1/5,
+                denoise_space=denoise_space,
+                atlases=[DEFAULT_ATLAS, atlas],
+                save_denoised_bold=False)
+            time_series = denoise.run().outputs.time_series
+            self.assertEqual(2 * len(pipelines), len(time_series))
+            for i, (pipeline, conf_prep) in enumerate(zip(pipelines, conf_preps)):
+                default_time_series, atlas_time_series = time_series[2 * i:2 * i + 2]
+                self.assertIn(f"_pipeline-{pipeline['name']}_", default_time_series)
+                self.assertNotIn("atlas-", os.path.basename(default_time_series))
+                self.assertIn(f"_atlas-Testdesc4Parcels_pipeline-{pipeline['name']}_", atlas_time_series)
+                denoised_img = clean_img(img, confounds=load_confounds(conf_prep),
+                                         standardize=denoise_space == 'voxels',
+                                         high_pass=1/128, low_pass=1/5, t_r=2)
+                for masker, path in zip(maskers, (default_time_series, atlas_time_series)):
+                    assert_array_almost_equal(masker.fit_transform(denoised_img), np.load(path))
@@ -0,0 +1,76 @@
+import copy
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+
+from fmridenoise.interfaces.smoothing import Smooth
+from fmridenoise.interfaces.denoising import PipelinesDenoise
+from fmridenoise.interfaces.connectivity import Connectivity
+from fmridenoise.interfaces.quality_measures import QualityMeasures
+from fmridenoise.utils.connectome import load_connectome
+from tests.utils import fmri_prep_filename, pipeline_null
+
+
+class TestFloat32Precision(unittest.TestCase):
+    """Smoothing, denoising and connectivity in float32 should deviate from
+    float64 only within single precision accuracy."""
+    task = 'test'
+    n_subjects = 4
+    n_volumes = 60
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        cls.fmri_files, cls.conf_files = [], []
+        cls.mean_fd = rng.uniform(0.1, 0.5, cls.n_subjects)
+        for i in range(cls.n_subjects):
+            network = rng.randn(cls.n_volumes)
+            motion = rng.randn(cls.n_volumes)
+            data = 100 + rng.randn(24, 28, 24, cls.n_volumes) + network + cls.mean_fd[i] * 10 * motion
+            fmri_file = os.path.join(cls.temp_dir.name, fmri_prep_filename(f'0{i}', None, cls.task, False))
+            nb.save(nb.Nifti1Image(data.astype(np.float32), affine), fmri_file)
+            conf_file = os.path.join(cls.temp_dir.name, f'sub-0{i}_confounds.tsv')
+            pd.DataFrame(np.c_[motion, rng.randn(cls.n_volumes, 2)]).to_csv(conf_file, sep='\t', index=False)
+            cls.fmri_files.append(fmri_file)
+            cls.conf_files.append(conf_file)
+        cls.conn_mats = {precision: cls.connectivity(precision) for precision in ('float64', 'float32')}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    @classmethod
+    def connectivity(cls, precision: str) -> np.ndarray:
+        output_dir = tempfile.mkdtemp(dir=cls.temp_dir.name)
+        pipeline = copy.deepcopy(pipeline_null)
+        conn_mats = []
+        for fmri_file, conf_file in zip(cls.fmri_files, cls.conf_files):
+            smoothed = Smooth(fmri_prep=fmri_file, output_directory=output_dir, precision=precision).run()
+            denoised = PipelinesDenoise(fmri_prep=smoothed.outputs.fmri_smoothed, conf_prep=[conf_file],
+                                        pipeline=[pipeline], output_dir=output_dir, tr_dict={cls.task: 2},
+                                        high_pass=0.01, low_pass=0.1, precision=precision).run()
+            fmri_denoised = denoised.outputs.fmri_denoised[0]
+            assert nb.load(fmri_denoised).get_data_dtype() == np.dtype(precision)
+            connectivity = Connectivity(fmri_denoised=fmri_denoised, output_dir=output_dir,
+                                        precision=precision).run()
+            conn_mats.append(load_connectome(connectivity.outputs.corr_mat).edges)
+        return np.array(conn_mats)
+
+    def test_connectomes_deviation(self):
+        max_deviation = np.abs(self.conn_mats['float64'] - self.conn_mats['float32']).max()
+        self.assertLess(max_deviation, 1e-4)
+
+    def test_qc_fc_deviation(self):
+        group_conf_summary = pd.DataFrame({'mean_fd': self.mean_fd})
+        fc_fd_corr = {precision: QualityMeasures.calculate_fc_fd_correlations(
+                          group_conf_summary, conn_mats)[0]
+                      for precision, conn_mats in self.conn_mats.items()}
+        max_deviation = np.abs(fc_fd_corr['float64'] - fc_fd_corr['float32']).max()
+        self.assertLess(max_deviation, 1e-3)
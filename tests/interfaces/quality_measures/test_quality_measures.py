@@ -6,6 +6,7 @@ from fmridenoise.interfaces.quality_measures import QualityMeasures
 import pandas as pd
 import numpy as np
 from nipype import Node
+from nilearn.connectome import sym_matrix_to_vec
 import tempfile
 import shutil
 from os.path import join
@@ -17,6 +18,9 @@ class QualityMeasuresAsNodeTestBase:
     group_conf_summary: pd.DataFrame = ...
     distance_matrix: np.ndarray = ...
     group_corr_mat: np.ndarray = ...
+    n_permutations: int = 0
+    n_bootstrap: int = 0
+    all_subjects: bool = True
     pipeline = load_pipeline_from_json(get_pipeline_path('pipeline-Null'))
 
     @classmethod
@@ -31,13 +35,16 @@ class QualityMeasuresAsNodeTestBase:
         distance_matrix_file = join(cls.tempdir, "task-test_pipeline-Null_distance_matrix.npy")
         np.save(distance_matrix_file, cls.distance_matrix)
         group_corr_mat_file = join(cls.tempdir, "task-test_pipeline-Null_group_corr_mat.npy")
-        np.save(group_corr_mat_file, cls.group_corr_mat)
+        np.save(group_corr_mat_file, sym_matrix_to_vec(cls.group_corr_mat).astype(np.float32))
         cls.quality_measures_node = Node(QualityMeasures(), name="QualityMeasures")
         cls.quality_measures_node.inputs.group_conf_summary = group_conf_summary_file
         cls.quality_measures_node.inputs.distance_matrix = distance_matrix_file
         cls.quality_measures_node.inputs.group_corr_mat = group_corr_mat_file
         cls.quality_measures_node.inputs.pipeline = cls.pipeline
         cls.quality_measures_node.inputs.output_dir = cls.tempdir
+        cls.quality_measures_node.inputs.n_permutations = cls.n_permutations
+        cls.quality_measures_node.inputs.n_bootstrap = cls.n_bootstrap
+        cls.quality_measures_node.inputs.all_subjects = cls.all_subjects
         cls.result = cls.quality_measures_node.run()
 
 
@@ -224,3 +231,85 @@ class QualityMeasuresSingleLowMotionTestCase(QualityMeasuresAsNodeTestBase, ut.T
         self.assertEqual(Undefined, self.result.outputs.corr_matrix_no_high_motion_plot)
         self.assertEqual(Undefined, self.result.outputs.edges_weight_clean)
         self.assertEqual(Undefined, self.result.outputs.fc_fd_corr_values_clean)
+
+
+class QualityMeasuresCensoringTestCase(QualityMeasuresAsNodeTestBase, ut.TestCase):
+    group_conf_summary = pd.DataFrame(np.array([['m03', 'task', 0.1034750870617284, 1.1646298000000002, 32,
+                                                 True, 18, 2.4657534246575343, 18],
+                                                ['m04', 'task', 0.09806451376598077, 0.794708, 32, False, 1,
+                                                 0.136986301369863, 1],
+                                                ['m05', 'task', 0.06123372759303155, 0.14662384, 32, True, 0,
+                                                 0.0, 0]], dtype=object),
+                                      columns=['subject', 'task', 'mean_fd', 'max_fd', 'n_conf', 'include',
+                                               'n_spikes', 'perc_spikes', 'n_censored'])
+    distance_matrix = QualityMeasuresAsNodeTestCase.distance_matrix
+    group_corr_mat = QualityMeasuresAsNodeTestCase.group_corr_mat
+
+    def test_tdof_loss(self):
+        """Censored volumes should count as lost temporal degrees of freedom
+        (the same way as spike regressors)."""
+        first, second = self.result.outputs.fc_fd_summary
+        self.assertEqual((50 + 33 + 32) / 3, first['tdof_loss'])
+        self.assertEqual((50 + 32) / 2, second['tdof_loss'])
+
+
+class QualityMeasuresPermutationsTestCase(QualityMeasuresAsNodeTestBase, ut.TestCase):
+    group_conf_summary = QualityMeasuresAsNodeTestCase.group_conf_summary
+    distance_matrix = QualityMeasuresAsNodeTestCase.distance_matrix
+    group_corr_mat = QualityMeasuresAsNodeTestCase.group_corr_mat
+    n_permutations = 20
+
+    def test_perc_fc_fd_fwe(self):
+        """Family-wise error corrected percent should be added to summaries
+        when permutations are enabled."""
+        for summary in self.result.outputs.fc_fd_summary:
+            self.assertIn('perc_fc_fd_fwe', summary)
+            self.assertTrue(0 <= summary['perc_fc_fd_fwe'] <= 100)
+
+
+class QualityMeasuresBootstrapTestCase(QualityMeasuresAsNodeTestBase, ut.TestCase):
+    group_conf_summary = QualityMeasuresAsNodeTestCase.group_conf_summary
+    distance_matrix = QualityMeasuresAsNodeTestCase.distance_matrix
+    group_corr_mat = QualityMeasuresAsNodeTestCase.group_corr_mat
+    n_bootstrap = 20
+
+    def test_confidence_intervals(self):
+        """Confidence intervals should be added to summary of all subjects
+        (and not to summary of too few low motion subjects)."""
+        first, second = self.result.outputs.fc_fd_summary
+        for measure in ('median_pearson_fc_fd', 'perc_fc_fd_uncorr', 'distance_dependence'):
+            self.assertLessEqual(first[f'{measure}_ci_low'], first[f'{measure}_ci_high'])
+            self.assertNotIn(f'{measure}_ci_low', second)
+
+
+class QualityMeasuresIncludedOnlyTestCase(QualityMeasuresAsNodeTestBase, ut.TestCase):
+    group_conf_summary = QualityMeasuresAsNodeTestCase.group_conf_summary
+    distance_matrix = QualityMeasuresAsNodeTestCase.distance_matrix
+    # connectomes of excluded subject are not created
+    group_corr_mat = QualityMeasuresAsNodeTestCase.group_corr_mat[[0, 2]]
+    all_subjects = False
+
+    def test_summary_output(self):
+        """Only summary of subjects without high motion should be calculated."""
+        summary, = self.result.outputs.fc_fd_summary
+        self.assertFalse(summary['all'])
+        self.assertEqual(3, summary['n_subjects'])
+        self.assertEqual(1, summary['n_excluded'])
+        self.assertEqual((50 + 32) / 2, summary['tdof_loss'])
+
+    def test_excluded_output(self):
+        self.assertEqual({'m04'}, self.result.outputs.excluded_subjects.excluded)
+
+    def test_all_subjects_outputs(self):
+        self.assertIs(Undefined, self.result.outputs.edges_weight)
+        self.assertIs(Undefined, self.result.outputs.fc_fd_corr_values)
+        self.assertIs(Undefined, self.result.outputs.corr_matrix_plot)
+
+    def test_fc_fd_vec_clean(self):
+        """Expect the same values as calculated from connectomes of all subjects."""
+        vec = sym_matrix_to_vec(self.group_corr_mat)
+        corr, _ = QualityMeasures.calculate_fc_fd_correlations(
+            self.group_conf_summary[self.group_conf_summary['include'] == True], vec)
+        assert_array_almost_equal(self.result.outputs.fc_fd_corr_values_clean[self.pipeline['name']], corr)
+        assert_array_almost_equal(sym_matrix_to_vec(self.group_corr_mat).mean(axis=0),
+                                  self.result.outputs.edges_weight_clean[self.pipeline['name']])
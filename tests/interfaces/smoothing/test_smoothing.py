@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_array_equal
+
+from fmridenoise.interfaces.smoothing import Smooth
+from fmridenoise.utils.smoothing import SMOOTHING_VERSION, smooth_img
+from tests.utils import fmri_prep_filename
+
+
+class TestSmoothingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.mkdtemp(dir=self.temp_dir.name)
+        rng = np.random.RandomState(0)
+        self.fmri_prep = os.path.join(self.temp_dir.name, fmri_prep_filename('01', None, 'test', False))
+        nb.save(nb.Nifti1Image(rng.randn(8, 9, 10, 12), np.diag([3., 3., 3., 1.])), self.fmri_prep)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def smooth(self, **inputs) -> str:
+        output_directory = tempfile.mkdtemp(dir=self.temp_dir.name)
+        smooth = Smooth(fmri_prep=self.fmri_prep, output_directory=output_directory, cache_dir=self.cache_dir,
+                        **inputs)
+        return smooth.run().outputs.fmri_smoothed
+
+    def test_smoothed_once(self):
+        """Expect image smoothed only on first run and reused afterwards with
+        output in each run output directory."""
+        with mock.patch('fmridenoise.interfaces.smoothing.smooth_img', wraps=smooth_img) as smooth_mock:
+            first, second = self.smooth(), self.smooth()
+        self.assertEqual(1, smooth_mock.call_count)
+        self.assertNotEqual(first, second)
+        self.assertEqual(os.path.basename(first), os.path.basename(second))
+        assert_array_equal(nb.load(first).get_fdata(), nb.load(second).get_fdata())
+        assert_array_equal(smooth_img(nb.load(self.fmri_prep), Smooth.fwhm).get_fdata(), nb.load(first).get_fdata())
+
+    def test_keyed_by_content_and_precision(self):
+        """Expect image smoothed again when input content or precision
+        changes."""
+        with mock.patch('fmridenoise.interfaces.smoothing.smooth_img', wraps=smooth_img) as smooth_mock:
+            self.smooth()
+            self.smooth(precision='float32')
+            nb.save(nb.Nifti1Image(np.ones((8, 9, 10, 12)), np.diag([3., 3., 3., 1.])), self.fmri_prep)
+            self.smooth()
+        self.assertEqual(3, smooth_mock.call_count)
+        self.assertEqual(3, len(os.listdir(self.cache_dir)))
+
+    def test_keyed_by_smoothing_version(self):
+        """Expect image smoothed again when smoothing version changes."""
+        with mock.patch('fmridenoise.interfaces.smoothing.smooth_img', wraps=smooth_img) as smooth_mock:
+            self.smooth()
+            with mock.patch('fmridenoise.interfaces.smoothing.SMOOTHING_VERSION', SMOOTHING_VERSION + 1):
+                self.smooth()
+        self.assertEqual(2, smooth_mock.call_count)
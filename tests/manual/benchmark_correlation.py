@@ -0,0 +1,41 @@
+import argparse
+import time
+
+import numpy as np
+from nilearn.connectome import ConnectivityMeasure
+
+from fmridenoise.interfaces.connectivity import correlation_matrices
+
+
+def timed(estimate) -> (float, np.ndarray):
+    start = time.perf_counter()
+    corr_mats = estimate()
+    return time.perf_counter() - start, corr_mats
+
+
+def run(n_pipelines: int, n_volumes: int, n_parcels: list, repeats: int):
+    rng = np.random.RandomState(0)
+    for n in n_parcels:
+        time_series = rng.randn(n_pipelines, n_volumes, n) @ (np.eye(n) + 0.1 * rng.randn(n, n))
+        print(f"{n_pipelines} pipelines x {n_volumes} volumes x {n} parcels, {repeats} repeats")
+        nilearn_time, expected = timed(lambda: [
+            np.array([ConnectivityMeasure(kind='correlation').fit_transform([x])[0] for x in time_series])
+            for _ in range(repeats)])
+        print(f"  ConnectivityMeasure per pipeline  {nilearn_time:6.2f} s")
+        for dtype in (np.float64, np.float32):
+            data = time_series.astype(dtype)
+            elapsed, corr_mats = timed(lambda: [correlation_matrices(data) for _ in range(repeats)])
+            print(f"  batched {np.dtype(dtype).name:7}                   {elapsed:6.2f} s  "
+                  f"speedup {nilearn_time / elapsed:5.1f}x  max abs diff {np.abs(expected[0] - corr_mats[0]).max():.1e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare correlation matrices estimated with nilearn "
+                                                 "ConnectivityMeasure for each pipeline and with batched "
+                                                 "correlation kernel for all pipelines at once.")
+    parser.add_argument("-p", "--n_pipelines", type=int, default=7)
+    parser.add_argument("-t", "--n_volumes", type=int, default=300)
+    parser.add_argument("-n", "--n_parcels", type=int, nargs='+', default=[100, 200, 400, 1000])
+    parser.add_argument("-r", "--repeats", type=int, default=5)
+    args = parser.parse_args()
+    run(args.n_pipelines, args.n_volumes, args.n_parcels, args.repeats)
@@ -0,0 +1,80 @@
+import argparse
+import copy
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import nibabel as nb
+
+from fmridenoise.interfaces.denoising import PipelinesDenoise
+from fmridenoise.interfaces.connectivity import Connectivity
+from fmridenoise.utils.connectome import load_connectome
+from tests.utils import fmri_prep_filename, pipeline_null
+
+
+def make_inputs(directory: str, voxel_size: float, n_volumes: int, n_pipelines: int, n_confounds: int):
+    rng = np.random.RandomState(0)
+    shape = tuple(int(np.ceil(extent / voxel_size)) for extent in (193, 229, 193))
+    affine = np.diag([voxel_size] * 3 + [1.])
+    affine[:3, 3] = [-96., -132., -78.]
+    fmri_prep = os.path.join(directory, fmri_prep_filename('01', '1', 'bench', False))
+    nb.save(nb.Nifti1Image((100 + rng.randn(*shape, n_volumes)).astype(np.float32), affine), fmri_prep)
+    pipelines, conf_preps = [], []
+    for i in range(n_pipelines):
+        pipeline = copy.deepcopy(pipeline_null)
+        pipeline['name'] = f'Bench{i}'
+        conf_prep = os.path.join(directory, f'pipeline-Bench{i}_confounds.tsv')
+        pd.DataFrame(rng.randn(n_volumes, n_confounds)).to_csv(conf_prep, sep='\t', index=False)
+        pipelines.append(pipeline)
+        conf_preps.append(conf_prep)
+    return fmri_prep, pipelines, conf_preps
+
+
+def run_space(denoise_space: str, fmri_prep: str, pipelines: list, conf_preps: list) -> (float, list):
+    output_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    result = PipelinesDenoise(
+        fmri_prep=fmri_prep,
+        conf_prep=conf_preps,
+        pipeline=pipelines,
+        output_dir=output_dir,
+        tr_dict={'bench': 2},
+        high_pass=0.008,
+        low_pass=0.08,
+        denoise_space=denoise_space).run()
+    conn_mats = []
+    if denoise_space == 'parcels':
+        for path in result.outputs.time_series:
+            connectivity = Connectivity(time_series=path, output_dir=output_dir)
+            conn_mats.append(load_connectome(connectivity.run().outputs.corr_mat).edges)
+    else:
+        for path in result.outputs.fmri_denoised:
+            connectivity = Connectivity(fmri_denoised=path, output_dir=output_dir)
+            conn_mats.append(load_connectome(connectivity.run().outputs.corr_mat).edges)
+    return time.perf_counter() - start, conn_mats
+
+
+def run(voxel_size: float, n_volumes: int, n_pipelines: int, n_confounds: int):
+    with tempfile.TemporaryDirectory() as directory:
+        fmri_prep, pipelines, conf_preps = make_inputs(directory, voxel_size, n_volumes, n_pipelines, n_confounds)
+        voxels_time, voxels_conn = run_space('voxels', fmri_prep, pipelines, conf_preps)
+        parcels_time, parcels_conn = run_space('parcels', fmri_prep, pipelines, conf_preps)
+    max_diff = max(np.nanmax(np.abs(v - p)) for v, p in zip(voxels_conn, parcels_conn))
+    mean_diff = np.mean([np.nanmean(np.abs(v - p)) for v, p in zip(voxels_conn, parcels_conn)])
+    print(f"voxels:  {voxels_time:.2f} s (denoising + connectivity, {n_pipelines} pipelines)")
+    print(f"parcels: {parcels_time:.2f} s (denoising + connectivity, {n_pipelines} pipelines)")
+    print(f"speedup: {voxels_time / parcels_time:.1f}x")
+    print(f"abs difference of connectivity matrices: mean {mean_diff:.4f}, max {max_diff:.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare voxelwise and parcel-first denoising "
+                                                 "on synthetic image in MNI space.")
+    parser.add_argument("-s", "--voxel_size", type=float, default=4.)
+    parser.add_argument("-t", "--n_volumes", type=int, default=200)
+    parser.add_argument("-p", "--n_pipelines", type=int, default=4)
+    parser.add_argument("-c", "--n_confounds", type=int, default=24)
+    args = parser.parse_args()
+    run(args.voxel_size, args.n_volumes, args.n_pipelines, args.n_confounds)
@@ -0,0 +1,55 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import nibabel as nb
+
+from fmridenoise.utils.nifti import save_img
+
+
+def make_img(voxel_size: float, n_volumes: int) -> nb.Nifti1Image:
+    rng = np.random.RandomState(0)
+    shape = tuple(int(np.ceil(extent / voxel_size)) for extent in (193, 229, 193))
+    data = np.zeros(shape + (n_volumes,), dtype=np.float32)
+    # brain-like content: noisy signal inside ellipsoid, zeros outside
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'))
+    inside = (grid ** 2).sum(axis=0) < 0.8
+    data[inside] = 100 + rng.randn(inside.sum(), n_volumes)
+    return nb.Nifti1Image(data, np.diag([voxel_size] * 3 + [1.]))
+
+
+def timed(save, directory: str) -> (float, int):
+    start = time.perf_counter()
+    path = save(os.path.join(directory, f'img{time.perf_counter_ns()}.nii.gz'))
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(path)
+    os.remove(path)
+    return elapsed, size
+
+
+def run(voxel_size: float, n_volumes: int, levels: list, threads: list):
+    img = make_img(voxel_size, n_volumes)
+    data_mb = img.get_fdata(dtype=np.float32).nbytes / 2 ** 20
+    print(f"image {img.shape}, {data_mb:.0f} MB of data")
+    settings = [('nibabel.save', lambda path: nb.save(img, path) or path)]
+    for level in levels:
+        for n_threads in ([1] if level == 0 else threads):
+            settings.append((f'level {level}, {n_threads} threads',
+                             lambda path, level=level, n_threads=n_threads: save_img(img, path, level, n_threads)))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, save in settings:
+            elapsed, size = timed(save, directory)
+            print(f"{name:<24} {elapsed:6.2f} s  {data_mb / elapsed:7.1f} MB/s  file {size / 2 ** 20:7.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare write throughput of 4D images saved with nibabel "
+                                                 "and with fmridenoise writer at different compression settings.")
+    parser.add_argument("-s", "--voxel_size", type=float, default=2.)
+    parser.add_argument("-t", "--n_volumes", type=int, default=100)
+    parser.add_argument("-l", "--levels", type=int, nargs='+', default=[0, 1, 6])
+    parser.add_argument("-j", "--threads", type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    args = parser.parse_args()
+    run(args.voxel_size, args.n_volumes, args.levels, sorted(set(args.threads)))
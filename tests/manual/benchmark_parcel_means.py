@@ -0,0 +1,42 @@
+import argparse
+import time
+import warnings
+
+import numpy as np
+from nilearn.maskers import NiftiLabelsMasker
+
+from fmridenoise.parcellation import get_parcellation_file_path, parcel_index
+from tests.manual.benchmark_smoothing import make_img
+
+
+def timed(extract) -> (float, np.ndarray):
+    start = time.perf_counter()
+    time_series = extract()
+    return time.perf_counter() - start, time_series
+
+
+def run(voxel_sizes: list, n_volumes: int, n_images: int):
+    parcellation_file = get_parcellation_file_path('MNI152NLin2009cAsym')
+    for voxel_size in voxel_sizes:
+        img = make_img(voxel_size, n_volumes)
+        data = img.get_fdata(dtype=np.float32)
+        print(f"image {img.shape} ({voxel_size} mm), {n_images} images on the same grid")
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            nilearn_time, expected = timed(lambda: [NiftiLabelsMasker(labels_img=parcellation_file).fit_transform(img)
+                                                    for _ in range(n_images)])
+        print(f"  NiftiLabelsMasker per image  {nilearn_time:6.2f} s")
+        elapsed, time_series = timed(lambda: [parcel_index(parcellation_file, img).parcel_means(data)
+                                              for _ in range(n_images)])
+        print(f"  cached parcel index          {elapsed:6.2f} s  speedup {nilearn_time / elapsed:4.1f}x  "
+              f"max abs diff {np.abs(expected[0] - time_series[0]).max():.1e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare parcels time series extraction with NiftiLabelsMasker "
+                                                 "created for each image and with cached parcel index.")
+    parser.add_argument("-s", "--voxel_sizes", type=float, nargs='+', default=[4., 3., 2.])
+    parser.add_argument("-t", "--n_volumes", type=int, default=200)
+    parser.add_argument("-n", "--n_images", type=int, default=5)
+    args = parser.parse_args()
+    run(args.voxel_sizes, args.n_volumes, args.n_images)
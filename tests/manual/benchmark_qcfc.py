@@ -0,0 +1,45 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr
+
+from fmridenoise.interfaces.quality_measures import QualityMeasures
+
+
+def calculate_fc_fd_correlations_loop(group_conf_summary: pd.DataFrame, group_corr_vec: np.ndarray):
+    fd = group_conf_summary['mean_fd'].values
+    result = np.array([tuple(pearsonr(x=fc, y=fd)) for fc in group_corr_vec.T])
+    return result[:, 0], result[:, 1]
+
+
+def timed(function, *args) -> (float, tuple):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def run(edges: list, subjects: list):
+    rng = np.random.RandomState(0)
+    for n_edges in edges:
+        for n_subjects in subjects:
+            group_conf_summary = pd.DataFrame({'mean_fd': rng.gamma(2, 0.1, n_subjects)})
+            group_corr_vec = np.tanh(rng.randn(n_subjects, n_edges) * 0.3
+                                     + group_conf_summary['mean_fd'].values[:, np.newaxis])
+            loop_time, expected = timed(calculate_fc_fd_correlations_loop, group_conf_summary, group_corr_vec)
+            vectorised_time, result = timed(QualityMeasures.calculate_fc_fd_correlations,
+                                            group_conf_summary, group_corr_vec)
+            print(f"{n_edges:6d} edges {n_subjects:5d} subjects: loop {loop_time:7.3f} s  "
+                  f"vectorised {vectorised_time:7.3f} s  speedup {loop_time / vectorised_time:6.1f}x  "
+                  f"max abs diff corr {np.abs(expected[0] - result[0]).max():.1e} "
+                  f"pval {np.abs(expected[1] - result[1]).max():.1e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare edge-wise loop of scipy pearsonr with vectorised "
+                                                 "QC-FC correlations.")
+    parser.add_argument("-e", "--edges", type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument("-s", "--subjects", type=int, nargs='+', default=[50, 500, 5000])
+    args = parser.parse_args()
+    run(args.edges, args.subjects)
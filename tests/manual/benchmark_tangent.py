@@ -0,0 +1,55 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from nilearn.connectome import ConnectivityMeasure, sym_matrix_to_vec
+
+from fmridenoise.interfaces.connectivity import ledoit_wolf_covariances, project_to_tangent_space
+from fmridenoise.utils.connectome import CONNECTOME_DTYPE
+
+
+def run(n_subjects: list, n_volumes: int, n_parcels: int, nilearn_max: int):
+    rng = np.random.RandomState(0)
+    mixing = np.eye(n_parcels) + 0.1 * rng.randn(n_parcels, n_parcels)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for n in n_subjects:
+            time_series = [rng.randn(n_volumes, n_parcels) @ mixing for _ in range(n)]
+            print(f"{n} subjects x {n_volumes} volumes x {n_parcels} parcels")
+            path = os.path.join(temp_dir, f'group_{n}.npy')
+            group_edges = np.lib.format.open_memmap(path, mode='w+', dtype=CONNECTOME_DTYPE,
+                                                    shape=(n, n_parcels * (n_parcels + 1) // 2))
+            for i, x in enumerate(time_series):
+                group_edges[i] = sym_matrix_to_vec(ledoit_wolf_covariances(x))
+            tracemalloc.start()
+            start = time.perf_counter()
+            project_to_tangent_space(group_edges)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+            print(f"  chunked projection    {elapsed:7.2f} s  peak {peak:8.1f} MiB")
+            if n <= nilearn_max:
+                tracemalloc.start()
+                start = time.perf_counter()
+                expected = ConnectivityMeasure(kind='tangent').fit_transform(time_series)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+                tracemalloc.stop()
+                print(f"  ConnectivityMeasure   {elapsed:7.2f} s  peak {peak:8.1f} MiB  "
+                      f"max abs diff {np.abs(sym_matrix_to_vec(expected) - group_edges).max():.1e}")
+            del group_edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare tangent space projection of group of subjects "
+                                                 "covariances stored in memory mapped group connectome with "
+                                                 "nilearn ConnectivityMeasure fitted to all subjects.")
+    parser.add_argument("-s", "--n_subjects", type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument("-t", "--n_volumes", type=int, default=200)
+    parser.add_argument("-n", "--n_parcels", type=int, default=200)
+    parser.add_argument("--nilearn_max", type=int, default=200,
+                        help="Largest group for which nilearn ConnectivityMeasure is run")
+    args = parser.parse_args()
+    run(args.n_subjects, args.n_volumes, args.n_parcels, args.nilearn_max)
@@ -148,6 +148,17 @@ if __name__ == '__main__':
         xlabel="x data",
         output_path=PLOTS_PATH.joinpath("catplot.png"),
     )
+    fc_fd_summary_all = fc_fd_summary[fc_fd_summary['all'] == True].copy()
+    fc_fd_summary_all['median_pearson_fc_fd_ci_low'] = fc_fd_summary_all['median_pearson_fc_fd'] - 0.02
+    fc_fd_summary_all['median_pearson_fc_fd_ci_high'] = fc_fd_summary_all['median_pearson_fc_fd'] + 0.03
+    make_catplot(
+        x="median_pearson_fc_fd",
+        y='pipeline',
+        data=fc_fd_summary_all,
+        xlabel="x data",
+        output_path=PLOTS_PATH.joinpath("catplot_ci.png"),
+        xerr=("median_pearson_fc_fd_ci_low", "median_pearson_fc_fd_ci_high"),
+    )
     make_violinplot(
         data=fc_fd_corr_df,
         xlabel="x data",
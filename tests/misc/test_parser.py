@@ -1,5 +1,7 @@
+import io
 import unittest as ut
-from fmridenoise.__main__ import parse_pipelines
+from contextlib import redirect_stderr
+from fmridenoise.__main__ import parse_pipelines, get_parser
 import fmridenoise.pipelines as pipe
 from os.path import dirname, join
 from glob import glob
@@ -38,3 +40,31 @@ class TestPipelinesParser(ut.TestCase):
         selected_path = {(join(self.pipelines_dir, selected) + ".json")}
         paths = parse_pipelines([selected]) # __main__ always return list of paths/selected pipelines names
         self.assertSetEqual(paths, selected_path)
+
+
+class TestCountsParser(ut.TestCase):
+    """
+    Test for validation of threads and processes counts of __main__ parser
+    """
+
+    def assertRejected(self, *args):
+        with self.assertRaises(SystemExit), redirect_stderr(io.StringIO()):
+            get_parser().parse_args(list(args))
+
+    def test_compress_threads(self):
+        """Checks if parser accepts only positive number of compressing threads"""
+        self.assertEqual(4, get_parser().parse_args(['compare', 'bids', '--compress-threads', '4']).compress_threads)
+        self.assertRejected('compare', 'bids', '--compress-threads', '0')
+        self.assertRejected('compare', 'bids', '--compress-threads', '-2')
+
+    def test_smoothing_threads(self):
+        """Checks if parser accepts only positive number of smoothing threads"""
+        self.assertEqual(2, get_parser().parse_args(['compare', 'bids', '--smoothing-threads', '2']).smoothing_threads)
+        self.assertRejected('compare', 'bids', '--smoothing-threads', '0')
+
+    def test_qcfc_procs(self):
+        """Checks if compare and qc accept only positive number of QC-FC processes"""
+        self.assertEqual(3, get_parser().parse_args(['compare', 'bids', '--qcfc-procs', '3']).qcfc_procs)
+        self.assertEqual(3, get_parser().parse_args(['qc', 'fmridenoise', '--qcfc-procs', '3']).qcfc_procs)
+        self.assertRejected('compare', 'bids', '--qcfc-procs', '0')
+        self.assertRejected('qc', 'fmridenoise', '--qcfc-procs', '0')
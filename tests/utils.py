@@ -2,7 +2,13 @@ import os
 import math
 import json
 import shutil
+import unittest
 import nipype as ni
+import numpy as np
+import pandas as pd
+from nilearn.connectome import sym_matrix_to_vec
+
+from fmridenoise.parcellation import compute_distance_ranks
 
 
 pipeline_null = {
@@ -56,3 +62,27 @@ def fmri_prep_filename(sub, ses, task, aroma):
     desc_substr =  'desc-smoothAROMAnonaggr_' if aroma else 'desc-preproc_'
     return f'{sub_substr}{ses_substr}{task_substr}' + \
            f'space-MNI152NLin2009cAsym_{desc_substr}bold.nii.gz'
+
+
+class GroupStatisticsTestBase(unittest.TestCase):
+    """
+    Confounds summary, connectivity and distance matrix of subjects shared by
+    group statistics tests.
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n_subjects, self.n_rois = 12, 6
+        self.conf_summary = pd.DataFrame({'subject': [f'{i:02d}' for i in range(1, n_subjects + 1)],
+                                          'task': 'rest',
+                                          'mean_fd': rng.gamma(2, 0.1, n_subjects),
+                                          'max_fd': rng.rand(n_subjects),
+                                          'n_conf': rng.randint(0, 30, n_subjects),
+                                          'include': [True, False, True] * 4})
+        corr_mat = np.tanh(rng.randn(n_subjects, self.n_rois, self.n_rois))
+        corr_mat = (corr_mat + corr_mat.transpose(0, 2, 1)) / 2
+        corr_mat[:, range(self.n_rois), range(self.n_rois)] = 0
+        self.group_corr_vec = sym_matrix_to_vec(corr_mat)
+        distance_matrix = rng.rand(self.n_rois, self.n_rois)
+        self.distance_matrix = distance_matrix + distance_matrix.T
+        self.distance_ranks = compute_distance_ranks(self.distance_matrix)
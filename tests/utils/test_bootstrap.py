@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from scipy.stats import spearmanr
+
+from fmridenoise.utils import bootstrap
+from fmridenoise.utils.bootstrap import bootstrap_fc_fd_measures, confidence_interval
+from fmridenoise.utils.numeric import pearsonr_columns, normalized_ranks
+
+
+class TestBootstrapFcFdMeasures(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.fd = rng.gamma(2, 0.1, 30)
+        self.group_corr_vec = np.tanh(rng.randn(30, 45) * 0.3 + np.linspace(0, 2, 45) * self.fd[:, np.newaxis])
+        self.group_corr_vec[:, 2] = 0.5
+        self.distance_vec = rng.rand(45)
+        self.distance_ranks = normalized_ranks(self.distance_vec)
+
+    def test_resampled_correlations(self):
+        """Expect correlations of subjects drawn with counts equal to
+        correlations of explicitly resampled subjects."""
+        counts = np.random.default_rng(0).multinomial(30, np.full(30, 1 / 30), 4)
+        r = bootstrap._resampled_correlations(self.group_corr_vec, self.fd, counts.astype(float))
+        for sample_counts, sample_r in zip(counts, r):
+            subjects = np.repeat(np.arange(30), sample_counts)
+            expected = np.nan_to_num(pearsonr_columns(self.group_corr_vec[subjects], self.fd[subjects])[0])
+            assert_array_almost_equal(expected, sample_r)
+
+    def test_independent_of_threads(self):
+        batch_size = bootstrap.BOOTSTRAP_BATCH_SIZE
+        bootstrap.BOOTSTRAP_BATCH_SIZE = 7
+        try:
+            single = bootstrap_fc_fd_measures(self.group_corr_vec, self.fd, self.distance_ranks, 30)
+            multiple = bootstrap_fc_fd_measures(self.group_corr_vec, self.fd, self.distance_ranks, 30, n_threads=3)
+        finally:
+            bootstrap.BOOTSTRAP_BATCH_SIZE = batch_size
+        self.assertEqual({'median_pearson_fc_fd', 'perc_fc_fd_uncorr', 'distance_dependence'}, set(single))
+        for measure, samples in single.items():
+            self.assertEqual((30,), samples.shape)
+            assert_array_equal(samples, multiple[measure])
+
+    def test_confidence_interval_around_estimate(self):
+        samples = bootstrap_fc_fd_measures(self.group_corr_vec, self.fd, self.distance_ranks, 200)
+        r = np.nan_to_num(pearsonr_columns(self.group_corr_vec, self.fd)[0])
+        low, high = confidence_interval(samples['median_pearson_fc_fd'])
+        self.assertTrue(low < np.median(np.abs(r)) < high)
+        low, high = confidence_interval(samples['distance_dependence'])
+        self.assertTrue(low < spearmanr(r, self.distance_vec)[0] < high)
+
+    def test_too_few_subjects(self):
+        with self.assertRaises(ValueError):
+            bootstrap_fc_fd_measures(self.group_corr_vec[:2], self.fd[:2], self.distance_ranks, 10)
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from fmridenoise.utils.cache import cached_array, content_hash, file_hash
+
+
+class TestCachedArray(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.n_computed = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def compute(self) -> np.ndarray:
+        self.n_computed += 1
+        return np.arange(12.).reshape(3, 4)
+
+    def test_computed_once(self):
+        """Expect array computed on first call and loaded afterwards."""
+        first = cached_array(self.temp_dir.name, 'key', self.compute)
+        second = cached_array(self.temp_dir.name, 'key', self.compute)
+        self.assertEqual(1, self.n_computed)
+        assert_array_equal(first, second)
+        self.assertEqual(['key.npz'], os.listdir(self.temp_dir.name))
+
+    def test_without_cache_dir(self):
+        """Expect array computed on every call if cache directory is None."""
+        cached_array(None, 'key', self.compute)
+        cached_array(None, 'key', self.compute)
+        self.assertEqual(2, self.n_computed)
+
+    def test_content_hash(self):
+        """Expect hash depending on arrays content, shape and other items."""
+        array = np.arange(6.)
+        self.assertEqual(content_hash(array, 2), content_hash(array.copy(), 2))
+        self.assertNotEqual(content_hash(array, 2), content_hash(array, 3))
+        self.assertNotEqual(content_hash(array), content_hash(array.reshape(2, 3)))
+        self.assertNotEqual(content_hash(array), content_hash(array + 1))
+
+    def test_file_hash(self):
+        """Expect hash depending only on file content."""
+        paths = [os.path.join(self.temp_dir.name, name) for name in 'abc']
+        for path, content in zip(paths, (b'x' * 10, b'x' * 10, b'y' * 10)):
+            with open(path, 'wb') as f:
+                f.write(content)
+        self.assertEqual(file_hash(paths[0]), file_hash(paths[1]))
+        self.assertNotEqual(file_hash(paths[0]), file_hash(paths[2]))
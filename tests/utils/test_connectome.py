@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from nilearn.connectome import sym_matrix_to_vec
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from fmridenoise.utils.connectome import (CONNECTOME_DTYPE, n_rois_from_edges, save_connectome, load_connectome,
+                                          load_group_connectome)
+
+
+class TestConnectome(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        matrix = np.random.RandomState(0).rand(7, 7)
+        self.matrix = (matrix + matrix.T) / 2
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_n_rois_from_edges(self):
+        self.assertEqual(200, n_rois_from_edges(20100))
+        self.assertEqual(1, n_rois_from_edges(1))
+        with self.assertRaises(ValueError):
+            n_rois_from_edges(20)
+
+    def test_save_load(self):
+        """Expect edges of matrix saved with single precision and metadata."""
+        path = os.path.join(self.temp_dir.name, 'connMat.npz')
+        save_connectome(path, self.matrix, 'atlas-test')
+        connectome = load_connectome(path)
+        self.assertEqual('atlas-test', connectome.atlas)
+        self.assertEqual(7, connectome.n_rois)
+        self.assertEqual(CONNECTOME_DTYPE, connectome.edges.dtype)
+        self.assertEqual(n_rois_from_edges(len(connectome.edges)), connectome.n_rois)
+        assert_array_almost_equal(self.matrix, connectome.matrix())
+
+    def test_load_full_matrices(self):
+        """Expect full matrices saved by previous versions converted to edges."""
+        path = os.path.join(self.temp_dir.name, 'connMat.npy')
+        np.save(path, self.matrix)
+        connectome = load_connectome(path)
+        self.assertEqual('', connectome.atlas)
+        assert_array_equal(sym_matrix_to_vec(self.matrix).astype(CONNECTOME_DTYPE), connectome.edges)
+        group_path = os.path.join(self.temp_dir.name, 'groupCorrMat.npy')
+        np.save(group_path, np.stack([self.matrix, self.matrix * 2]))
+        assert_array_equal(sym_matrix_to_vec(np.stack([self.matrix, self.matrix * 2])).astype(CONNECTOME_DTYPE),
+                           load_group_connectome(group_path))
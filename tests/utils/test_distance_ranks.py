@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from nilearn.connectome import sym_matrix_to_vec
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from scipy.stats import spearmanr, rankdata
+
+from fmridenoise.parcellation import (get_distance_matrix_file_path, compute_distance_ranks, load_distance_ranks,
+                                      DistanceRanks)
+from fmridenoise.utils.numeric import normalized_ranks
+
+
+class TestDistanceRanks(unittest.TestCase):
+
+    def test_shipped_ranks_up_to_date(self):
+        """Expect precomputed ranks equal to ranks computed from shipped
+        distance matrix."""
+        distance_matrix_file = get_distance_matrix_file_path()
+        loaded = load_distance_ranks(distance_matrix_file)
+        computed = compute_distance_ranks(np.load(distance_matrix_file))
+        self.assertIsInstance(loaded, DistanceRanks)
+        for loaded_array, computed_array in zip(loaded, computed):
+            assert_array_equal(computed_array, loaded_array)
+
+    def test_spearman_as_dot_product(self):
+        """Expect Spearman correlation with distance equal to dot product of
+        normalized ranks."""
+        rng = np.random.RandomState(0)
+        distance_matrix = rng.rand(10, 10).round(1)
+        distance_matrix += distance_matrix.T
+        distance_ranks = compute_distance_ranks(distance_matrix)
+        assert_array_equal(sym_matrix_to_vec(distance_matrix), distance_ranks.distance_vec)
+        assert_array_equal(rankdata(distance_ranks.distance_vec), distance_ranks.ranks)
+        fc_fd_corr = rng.randn(2, len(distance_ranks.distance_vec))
+        assert_array_almost_equal([spearmanr(corr, distance_ranks.distance_vec)[0] for corr in fc_fd_corr],
+                                  normalized_ranks(fc_fd_corr) @ distance_ranks.normalized_ranks)
+
+    def test_other_distance_matrix(self):
+        """Expect ranks of distance matrix other than shipped one computed
+        from the file."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            distance_matrix = np.arange(16.).reshape(4, 4)
+            distance_matrix += distance_matrix.T
+            path = os.path.join(temp_dir, 'distance_matrix.npy')
+            np.save(path, distance_matrix)
+            assert_array_equal(sym_matrix_to_vec(distance_matrix), load_distance_ranks(path).distance_vec)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+from dataclasses import fields
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_array_almost_equal
+
+from fmridenoise.utils.group_statistics import RunningStatistics, GroupStatistics
+from fmridenoise.utils.numeric import pearsonr_columns
+from tests.utils import GroupStatisticsTestBase
+
+
+class TestRunningStatistics(GroupStatisticsTestBase):
+
+    def test_merge(self):
+        """Expect statistics merged from batches equal to statistics of all
+        subjects."""
+        fd = self.conf_summary['mean_fd'].values
+        expected = RunningStatistics.from_subjects(self.group_corr_vec, fd)
+        merged = RunningStatistics.from_subjects(self.group_corr_vec[:0], fd[:0])
+        for batch in (slice(0, 5), slice(5, 6), slice(6, 12)):
+            merged = merged.merge(RunningStatistics.from_subjects(self.group_corr_vec[batch], fd[batch]))
+        for field in fields(RunningStatistics):
+            assert_array_almost_equal(getattr(expected, field.name), getattr(merged, field.name))
+
+    def test_fc_fd_correlations(self):
+        fd = self.conf_summary['mean_fd'].values
+        r, p = RunningStatistics.from_subjects(self.group_corr_vec[:7], fd[:7]).merge(
+            RunningStatistics.from_subjects(self.group_corr_vec[7:], fd[7:])).fc_fd_correlations()
+        expected_r, expected_p = pearsonr_columns(self.group_corr_vec, fd)
+        # constant diagonal edges
+        assert_array_almost_equal(np.nan_to_num(expected_r), r)
+        assert_array_almost_equal(expected_p[~np.isnan(expected_p)], p[~np.isnan(expected_p)])
+
+
+class TestGroupStatistics(GroupStatisticsTestBase):
+
+    def test_save_load(self):
+        statistics = GroupStatistics.from_subjects(self.conf_summary, self.group_corr_vec)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'task-rest_pipeline-Null_groupStats.npz')
+            statistics.save(path)
+            loaded = GroupStatistics.load(path)
+        pd.testing.assert_frame_equal(statistics.conf_summary, loaded.conf_summary)
+        for subset in ('all_subjects', 'clean_subjects'):
+            for field in fields(RunningStatistics):
+                assert_array_almost_equal(getattr(getattr(statistics, subset), field.name),
+                                          getattr(getattr(loaded, subset), field.name))
+
+    def test_merge_same_subjects(self):
+        statistics = GroupStatistics.from_subjects(self.conf_summary, self.group_corr_vec)
+        with self.assertRaises(ValueError):
+            statistics.merge(GroupStatistics.from_subjects(self.conf_summary[:1], self.group_corr_vec[:1]))
@@ -129,6 +129,12 @@ class TestPipelineValidation(unittest.TestCase):
         for key in ['fd_th', 'dvars_th']:
             self.pipeline['spikes'] = {key: 1.321}
             self.assertFalse(is_valid(self.pipeline, silent=True))
+
+    def test_spikes_mode(self):
+        '''Spikes mode is optional and can be either regress or censor'''
+        for mode, valid in [('regress', True), ('censor', True), ('interpolate', False), (True, False)]:
+            self.pipeline['spikes'] = {'fd_th': 0.5, 'dvars_th': 1.5, 'mode': mode}
+            self.assertEqual(valid, is_valid(self.pipeline, silent=True))
     
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+import gzip
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_array_equal
+
+from fmridenoise.utils import nifti
+from fmridenoise.utils.nifti import nifti_path, gzip_file, copy_nifti, save_img
+
+
+class TestNiftiWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.img = nb.Nifti1Image(rng.randn(10, 11, 12, 20).astype(np.float32), np.diag([2., 2., 2., 1.]))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.temp_dir.name, name)
+
+    def test_nifti_path(self):
+        self.assertEqual('img.nii', nifti_path('img.nii.gz', 0))
+        self.assertEqual('img.nii.gz', nifti_path('img.nii', 6))
+        self.assertEqual('img.nii.gz', nifti_path('img.nii.gz', 1))
+
+    def test_parallel_gzip_members(self):
+        """Expect file compressed as several concatenated gzip members
+        identical to original after decompression."""
+        nb.save(self.img, self.path('img.nii'))
+        with mock.patch.object(nifti, '_CHUNK_SIZE', 2 ** 12):
+            gzip_file(self.path('img.nii'), self.path('img.nii.gz'), compress_level=6, n_threads=3)
+        with open(self.path('img.nii'), 'rb') as f:
+            original = f.read()
+        with open(self.path('img.nii.gz'), 'rb') as f:
+            compressed = f.read()
+        self.assertGreater(compressed.count(b'\x1f\x8b\x08'), 1)
+        self.assertEqual(original, gzip.decompress(compressed))
+        assert_array_equal(self.img.get_fdata(), nb.load(self.path('img.nii.gz')).get_fdata())
+
+    def test_save_img(self):
+        """Expect image saved under extension matching compression level."""
+        for compress_level, expected in ((0, 'img.nii'), (1, 'img.nii.gz'), (9, 'img.nii.gz')):
+            with self.subTest(compress_level=compress_level):
+                directory = tempfile.mkdtemp(dir=self.temp_dir.name)
+                path = save_img(self.img, os.path.join(directory, 'img.nii.gz'), compress_level, n_threads=2)
+                self.assertEqual(os.path.join(directory, expected), path)
+                self.assertEqual([expected], os.listdir(directory))
+                assert_array_equal(self.img.get_fdata(), nb.load(path).get_fdata())
+
+    def test_copy_nifti(self):
+        """Expect files compressed or decompressed when extension changes."""
+        nb.save(self.img, self.path('img.nii'))
+        copy_nifti(self.path('img.nii'), self.path('compressed.nii.gz'))
+        copy_nifti(self.path('compressed.nii.gz'), self.path('decompressed.nii'))
+        copy_nifti(self.path('compressed.nii.gz'), self.path('copied.nii.gz'))
+        with open(self.path('img.nii'), 'rb') as f, open(self.path('decompressed.nii'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        with open(self.path('compressed.nii.gz'), 'rb') as f, open(self.path('copied.nii.gz'), 'rb') as g:
+            self.assertEqual(f.read(), g.read())
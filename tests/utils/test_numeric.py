@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from scipy.stats import pearsonr, spearmanr
+
+from fmridenoise.utils import numeric
+from fmridenoise.utils.numeric import pearsonr_columns, normalized_ranks
+
+
+class TestPearsonrColumns(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y = rng.rand(30)
+        self.x = rng.randn(30, 50) + np.linspace(-1, 1, 50) * self.y[:, np.newaxis]
+
+    def assert_same_as_scipy(self, x: np.ndarray, y: np.ndarray):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = np.array([tuple(pearsonr(column, y)) for column in x.T]).T
+            result = pearsonr_columns(x, y)
+        assert_array_almost_equal(expected[0], result[0], decimal=12)
+        assert_array_almost_equal(expected[1], result[1], decimal=12)
+
+    def test_same_as_scipy(self):
+        self.assert_same_as_scipy(self.x, self.y)
+
+    def test_same_as_scipy_chunked(self):
+        chunk_size = numeric._CORRELATION_CHUNK_SIZE
+        numeric._CORRELATION_CHUNK_SIZE = 7
+        try:
+            self.assert_same_as_scipy(self.x, self.y)
+        finally:
+            numeric._CORRELATION_CHUNK_SIZE = chunk_size
+
+    def test_selected_rows(self):
+        """Expect correlations of selected rows (of memory mapped matrix) same as of their copy."""
+        rows = np.arange(0, 30, 2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'x.npy')
+            np.save(path, self.x.astype(np.float32))
+            x = np.load(path, mmap_mode='r')
+            r, p = pearsonr_columns(x, self.y[rows], rows)
+            expected_r, expected_p = pearsonr_columns(np.array(x[rows]), self.y[rows])
+            means = numeric.column_means(x, rows)
+            expected_means = np.array(x[rows], dtype=np.float64).mean(axis=0)
+            del x
+        assert_array_almost_equal(expected_r, r, decimal=12)
+        assert_array_almost_equal(expected_p, p, decimal=12)
+        assert_array_almost_equal(expected_means, means, decimal=12)
+
+    def test_constant_column(self):
+        self.x[:, 3] = 1
+        with self.assertWarns(Warning):
+            r, p = pearsonr_columns(self.x, self.y)
+        self.assertTrue(np.isnan(r[3]) and np.isnan(p[3]))
+        self.assertEqual(1, np.isnan(r).sum())
+        self.assert_same_as_scipy(self.x, self.y)
+
+    def test_two_observations(self):
+        self.assert_same_as_scipy(self.x[:2], self.y[:2])
+        assert_array_equal(np.ones(50), pearsonr_columns(self.x[:2], self.y[:2])[1])
+
+    def test_invalid_shapes(self):
+        with self.assertRaises(ValueError):
+            pearsonr_columns(self.x[:1], self.y[:1])
+        with self.assertRaises(ValueError):
+            pearsonr_columns(self.x, self.y[:-1])
+
+
+class TestNormalizedRanks(unittest.TestCase):
+
+    def test_spearman_as_dot_product(self):
+        x = np.random.RandomState(1).rand(3, 20).round(1)
+        ranks = normalized_ranks(x)
+        assert_array_almost_equal([spearmanr(row, x[2])[0] for row in x], ranks @ ranks[2])
+
+    def test_constant_row(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertTrue(np.isnan(normalized_ranks(np.ones(5))).all())
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+import warnings
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nilearn.maskers import NiftiLabelsMasker
+
+from fmridenoise.parcellation import (get_parcellation_file_path, parcel_index, get_atlas_name, get_atlas_label,
+                                      get_atlas_full_name, get_distance_matrix_file_path, compute_distance_matrix,
+                                      get_atlas_distance_matrix_file, DEFAULT_ATLAS)
+
+
+class TestParcelIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.parcellation_file = get_parcellation_file_path('MNI152NLin2009cAsym')
+        affine = np.diag([8., 8., 8., 1.])
+        affine[:3, 3] = [-96., -132., -78.]
+        self.img = nb.Nifti1Image(np.random.RandomState(0).randn(24, 28, 24, 20), affine)
+
+    def test_same_as_masker(self):
+        """Expect parcels means equal to NiftiLabelsMasker time series."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = NiftiLabelsMasker(labels_img=self.parcellation_file).fit_transform(self.img)
+        index = parcel_index(self.parcellation_file, self.img)
+        assert_array_almost_equal(expected, index.parcel_means(self.img.get_fdata()), decimal=12)
+        self.assertEqual(np.float32, index.parcel_means(self.img.get_fdata(), dtype=np.float32).dtype)
+
+    def test_cached(self):
+        """Expect index reused for images with the same grid."""
+        index = parcel_index(self.parcellation_file, self.img)
+        other = nb.Nifti1Image(np.zeros((24, 28, 24, 5)), self.img.affine.copy())
+        self.assertIs(index, parcel_index(self.parcellation_file, other))
+        shifted = nb.Nifti1Image(np.zeros((24, 28, 24, 5)), self.img.affine @ np.diag([2., 2., 2., 1.]))
+        self.assertIsNot(index, parcel_index(self.parcellation_file, shifted))
+        with self.assertRaises(ValueError):
+            index.parcel_means(np.zeros((24, 28, 23, 5)))
+
+    def test_atlas_name(self):
+        self.assertEqual('atlas-Schaefer2018_desc-200Parcels7Networks', get_atlas_name(self.parcellation_file))
+        assert_array_equal(np.arange(1, 201), parcel_index(self.parcellation_file, self.img).labels[:200])
+
+
+class TestAtlases(unittest.TestCase):
+
+    def setUp(self):
+        self.parcellation_file = get_parcellation_file_path('MNI152NLin2009cAsym')
+
+    def test_atlas_label(self):
+        """Expect no atlas entity for default atlas and alphanumeric one built
+        from atlas entities for parcellation files."""
+        self.assertIsNone(get_atlas_label(DEFAULT_ATLAS))
+        self.assertEqual('Schaefer2018desc200Parcels7Networks', get_atlas_label(self.parcellation_file))
+        self.assertEqual(get_atlas_name(self.parcellation_file), get_atlas_full_name(DEFAULT_ATLAS))
+
+    def test_distance_matrix_of_centroids(self):
+        """Expect distances between parcels centroids close to shipped distance
+        matrix of the same atlas."""
+        distance_matrix = compute_distance_matrix(self.parcellation_file)
+        shipped = np.load(get_distance_matrix_file_path())
+        self.assertEqual(shipped.shape, distance_matrix.shape)
+        assert_array_equal(0, np.diag(distance_matrix))
+        self.assertLess(np.abs(distance_matrix - shipped).max(), 10)
+        self.assertGreater(np.corrcoef(distance_matrix.ravel(), shipped.ravel())[0, 1], 0.99)
+
+    def test_atlas_distance_matrix_file(self):
+        """Expect shipped distance matrix for default atlas and computed one
+        saved once for other atlases."""
+        with tempfile.TemporaryDirectory() as output_dir:
+            self.assertEqual(get_distance_matrix_file_path(), get_atlas_distance_matrix_file(DEFAULT_ATLAS, output_dir))
+            self.assertEqual([], os.listdir(output_dir))
+            distance_matrix_file = get_atlas_distance_matrix_file(self.parcellation_file, output_dir)
+            self.assertEqual(os.path.dirname(distance_matrix_file), output_dir)
+            modification_time = os.path.getmtime(distance_matrix_file)
+            self.assertEqual(distance_matrix_file, get_atlas_distance_matrix_file(self.parcellation_file, output_dir))
+            self.assertEqual(modification_time, os.path.getmtime(distance_matrix_file))
+            assert_array_almost_equal(compute_distance_matrix(self.parcellation_file), np.load(distance_matrix_file))
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from fmridenoise.utils import permutations
+from fmridenoise.utils.numeric import pearsonr_columns
+from fmridenoise.utils.permutations import max_abs_correlation_null, fwe_corrected_pvalues
+
+
+class TestMaxAbsCorrelationNull(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.y = rng.rand(40)
+        self.x = rng.randn(40, 300)
+        self.x[:, 0] += 10 * self.y
+        self.x[:, 1] = 3
+
+    def test_independent_of_processes(self):
+        """Expect the same null distribution for any number of processes."""
+        batch_size = permutations.PERMUTATIONS_BATCH_SIZE
+        permutations.PERMUTATIONS_BATCH_SIZE = 7
+        try:
+            single = max_abs_correlation_null(self.x, self.y, 30, n_procs=1)
+            multiple = max_abs_correlation_null(self.x, self.y, 30, n_procs=2)
+        finally:
+            permutations.PERMUTATIONS_BATCH_SIZE = batch_size
+        self.assertEqual((30,), single.shape)
+        assert_array_equal(single, multiple)
+
+    def test_maximal_correlation(self):
+        """Expect null values equal to maximal absolute correlation with
+        permuted vector."""
+        null = max_abs_correlation_null(self.x, self.y, 5, seed=3)
+        rng = np.random.default_rng(np.random.SeedSequence(3).spawn(1)[0])
+        permuted = rng.permuted(np.tile(self.y - self.y.mean(), (5, 1)), axis=1)
+        expected = [np.nanmax(np.abs(pearsonr_columns(self.x, y)[0])) for y in permuted]
+        assert_array_almost_equal(expected, null)
+
+    def test_constant_vector(self):
+        assert_array_equal(np.zeros(10), max_abs_correlation_null(self.x, np.ones(40), 10))
+
+    def test_fwe_corrected_pvalues(self):
+        """Expect only edge correlated with vector significant after
+        correction."""
+        null = max_abs_correlation_null(self.x, self.y, 200)
+        r = np.nan_to_num(pearsonr_columns(self.x, self.y)[0])
+        pvalues = fwe_corrected_pvalues(r, null)
+        self.assertAlmostEqual(1 / 201, pvalues[0])
+        self.assertTrue((pvalues[1:] >= 0.05).all())
+        self.assertEqual(1, pvalues[1])
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nb
+from nilearn.image import clean_img
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+
+from fmridenoise.utils.signal import (confounds_projector, denoise_img_blockwise, denoise_img_parcels, block_size,
+                                     estimated_memory, parcel_means_blockwise)
+
+
+class TestDenoiseImgBlockwise(unittest.TestCase):
+    shape = (6, 7, 8, 50)
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        data = 100 + rng.randn(*self.shape)
+        data[0] = 0  # background voxels
+        data[1, 0, 0] = 5  # constant voxel
+        self.img = nb.Nifti1Image(data, np.diag([3., 3., 3., 1.]))
+        self.fmri_file = os.path.join(self.temp_dir.name, 'bold.nii.gz')
+        nb.save(self.img, self.fmri_file)
+        self.confounds = [None, rng.randn(self.shape[-1], 4)]
+        self.kwargs = dict(low_pass=0.1, high_pass=0.01, t_r=2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_same_as_clean_img(self):
+        """Expect results equal to clean_img for all projectors when image is
+        processed in several blocks."""
+        projectors = [confounds_projector(self.shape[-1], confounds, **self.kwargs) for confounds in self.confounds]
+        out_files = [os.path.join(self.temp_dir.name, f'denoised_{i}.nii.gz') for i in range(len(projectors))]
+        mem_mb = estimated_memory(self.shape, len(projectors), 3, write=True) / 2 ** 20
+        self.assertEqual(3, block_size(self.shape, len(projectors), mem_mb, write=True))
+        denoise_img_blockwise(self.fmri_file, projectors, out_files, mem_mb)
+        for confounds, out_file in zip(self.confounds, out_files):
+            expected = clean_img(self.img, confounds=confounds, **self.kwargs).get_fdata()
+            denoised = nb.load(out_file)
+            self.assertEqual(np.float64, denoised.get_data_dtype())
+            assert_array_almost_equal(self.img.affine, denoised.affine)
+            assert_array_almost_equal(expected, denoised.get_fdata())
+
+    def test_constant_voxel(self):
+        """Expect constant voxel denoised to zeros, as by clean_img (its
+        rounding errors after projection are not scaled to unit variance)."""
+        projectors = [confounds_projector(self.shape[-1], confounds, **self.kwargs) for confounds in self.confounds]
+        out_files = [os.path.join(self.temp_dir.name, f'denoised_{i}.nii.gz') for i in range(len(projectors))]
+        denoise_img_blockwise(self.fmri_file, projectors, out_files, 1e3)
+        for confounds, out_file in zip(self.confounds, out_files):
+            expected = clean_img(self.img, confounds=confounds, **self.kwargs).get_fdata()
+            assert_array_equal(0, expected[1, 0, 0])
+            assert_array_equal(0, nb.load(out_file).get_fdata()[1, 0, 0])
+
+    def test_memory_budget(self):
+        """Expect parcels sums and written blocks included in budget and
+        measured peak memory of denoising within budget."""
+        shape = (20, 20, 16, 100)
+        img = nb.Nifti1Image(np.random.RandomState(0).randn(*shape), np.eye(4))
+        fmri_file = os.path.join(self.temp_dir.name, 'large.nii')
+        nb.save(img, fmri_file)
+        projectors = [confounds_projector(shape[-1], None, **self.kwargs)] * 3
+        labels = 1 + np.arange(np.prod(shape[:-1])).reshape(shape[:-1]) % 100
+        mem_mb = estimated_memory(shape, len(projectors), 4, n_parcels=[100]) / 2 ** 20
+        self.assertEqual(4, block_size(shape, len(projectors), mem_mb, n_parcels=[100]))
+        self.assertGreater(4, block_size(shape, len(projectors), mem_mb, n_parcels=[100], write=True))
+        self.assertGreater(4, block_size(shape, len(projectors), mem_mb, n_parcels=[100, 1000]))
+        _, peak = denoise_img_parcels(fmri_file, projectors, labels, mem_mb)
+        self.assertLess(estimated_memory(shape, len(projectors), 3, n_parcels=[100]), peak)
+        self.assertLess(peak, mem_mb * 2 ** 20)
+
+    def test_parcel_means_blockwise(self):
+        """Expect raw signals averaged within parcels ordered by label (all
+        labelled voxels, also background ones, counted) when image is read in
+        several blocks."""
+        labels = np.zeros(self.shape[:-1], dtype=int)
+        labels[:, :, :5] = 3
+        labels[:, :, 5:] = 1 + np.arange(6 * 7 * 3).reshape(6, 7, 3) % 2
+        mem_mb = estimated_memory(self.shape, 1, 3, n_parcels=[3, 1]) / 2 ** 20
+        (means, shifted_means), _ = parcel_means_blockwise(self.fmri_file, [labels, labels + 1], mem_mb)
+        data = self.img.get_fdata()
+        expected = np.stack([data[labels == label].mean(axis=0) for label in (1, 2, 3)], axis=1)
+        assert_array_almost_equal(expected, means)
+        assert_array_almost_equal(expected, shifted_means)
+
+    def test_block_size_bounds(self):
+        """Expect at least one and at most all slices in single block."""
+        self.assertEqual(1, block_size(self.shape, 1, 0))
+        self.assertEqual(self.shape[-2], block_size(self.shape, 1, 1e6))
@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+import nibabel as nb
+from nilearn import image
+from numpy.testing import assert_array_almost_equal
+
+from fmridenoise.utils.smoothing import smooth_img
+
+
+class TestSmoothImg(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = 100 + 10 * rng.randn(11, 12, 13, 9)
+        self.data[0, 0, 0, 3] = np.nan
+        self.affine = np.array([[2., 0.5, 0., -20.],
+                                [0., 2.5, 0., -30.],
+                                [0., 0., 3., -40.],
+                                [0., 0., 0., 1.]])
+
+    def test_same_as_nilearn(self):
+        """Expect results equal to nilearn smooth_img for each data type and
+        number of threads."""
+        for dtype in (np.float64, np.float32, np.int16):
+            img = nb.Nifti1Image(self.data.astype(dtype) if dtype != np.int16 else
+                                 np.nan_to_num(self.data).astype(dtype), self.affine)
+            expected = image.smooth_img(img, fwhm=6)
+            for n_threads in (1, 3):
+                with self.subTest(dtype=dtype, n_threads=n_threads):
+                    smoothed = smooth_img(img, 6, n_threads)
+                    self.assertEqual(expected.get_data_dtype(), smoothed.get_data_dtype())
+                    assert_array_almost_equal(expected.get_fdata(), smoothed.get_fdata(), decimal=4)
+
+    def test_single_precision(self):
+        """Expect float32 smoothing within single precision accuracy."""
+        img = nb.Nifti1Image(self.data, self.affine)
+        expected = image.smooth_img(img, fwhm=6).get_fdata()
+        smoothed = smooth_img(img, 6, n_threads=2, dtype=np.float32)
+        self.assertEqual(np.float32, smoothed.get_data_dtype())
+        self.assertEqual(np.float32, np.asanyarray(smoothed.dataobj).dtype)
+        np.testing.assert_allclose(expected, smoothed.get_fdata(), rtol=1e-5)
+
+    def test_input_unchanged(self):
+        """Expect data of smoothed image not modified for any data type."""
+        for dtype in (None, np.float32, np.float64):
+            with self.subTest(dtype=dtype):
+                data = np.nan_to_num(self.data).astype(np.float32)
+                img = nb.Nifti1Image(data.copy(), self.affine)
+                smooth_img(img, 6, dtype=dtype)
+                assert_array_almost_equal(data, img.get_fdata())
+
+    def test_single_volume(self):
+        img = nb.Nifti1Image(self.data[..., 0], self.affine)
+        assert_array_almost_equal(image.smooth_img(img, fwhm=6).get_fdata(), smooth_img(img, 6).get_fdata())
@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nb
+from numpy.testing import assert_array_equal
+
+from fmridenoise.utils.staging import StagingCache
+
+
+class TestStagingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        os.mkdir(self.cache_dir)
+        rng = np.random.RandomState(0)
+        self.files = []
+        for i in range(3):
+            path = os.path.join(self.temp_dir.name, f'sub-0{i}_task-rest_bold.nii.gz')
+            nb.save(nb.Nifti1Image(rng.randn(8, 9, 10, 12), np.eye(4)), path)
+            self.files.append(path)
+        self.file_size = 8 * 9 * 10 * 12 * 8 + 352
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_stage(self):
+        """Expect memory mappable uncompressed copy with original name
+        decompressed only once."""
+        cache = StagingCache(self.cache_dir, 1e9)
+        staged = cache.stage(self.files[0])
+        self.assertEqual('sub-00_task-rest_bold.nii', os.path.basename(staged))
+        img = nb.load(staged)
+        self.assertIsInstance(img.dataobj.get_unscaled(), np.memmap)
+        assert_array_equal(nb.load(self.files[0]).get_fdata(), img.get_fdata())
+        self.assertEqual(staged, cache.stage(self.files[0]))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_uncompressed_not_staged(self):
+        cache = StagingCache(self.cache_dir, 1e9)
+        path = os.path.join(self.temp_dir.name, 'bold.nii')
+        self.assertEqual(path, cache.stage(path))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_lru_eviction(self):
+        """Expect least recently used file evicted when cache exceeds its
+        size and hit file kept."""
+        cache = StagingCache(self.cache_dir, 2.5 * self.file_size)
+        first, second = cache.stage(self.files[0]), cache.stage(self.files[1])
+        os.utime(first, (0, 0))
+        os.utime(second, (1, 1))
+        cache.stage(self.files[0])
+        third = cache.stage(self.files[2])
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertEqual(2, len(os.listdir(self.cache_dir)))
+        self.assertEqual((1, 3), (cache.hits, cache.misses))
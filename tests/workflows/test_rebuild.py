@@ -0,0 +1,155 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from nilearn.connectome import sym_matrix_to_vec
+from numpy.testing import assert_array_almost_equal
+
+from fmridenoise.interfaces.connectivity import correlation_matrices, TIME_SERIES_DTYPE
+from fmridenoise.pipelines import load_pipeline_from_json, get_pipeline_path
+from fmridenoise.utils.connectome import load_connectome, load_group_connectome, save_connectome
+from fmridenoise.workflows.rebuild import rebuild_connectivity, rerun_quality_measures
+
+
+class TestRebuildConnectivity(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fmridenoise_dir = os.path.join(self.temp_dir.name, 'derivatives', 'fmridenoise')
+        os.makedirs(self.fmridenoise_dir)
+        rng = np.random.RandomState(0)
+        self.subjects = ['03', '01', '02']
+        pd.DataFrame({'subject': self.subjects, 'task': 'rest'}).to_csv(
+            os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupConfSummary.tsv'), sep='\t', index=False)
+        self.time_series = rng.randn(3, 50, 6).astype(TIME_SERIES_DTYPE)
+        for subject, time_series in zip(self.subjects, self.time_series):
+            os.makedirs(os.path.join(self.fmridenoise_dir, f'sub-{subject}'))
+            np.save(os.path.join(self.fmridenoise_dir, f'sub-{subject}',
+                                 f'sub-{subject}_task-rest_pipeline-Null_timeseries.npy'), time_series)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_rebuild(self):
+        """Expect connectomes of saved time series replaced and group
+        connectome in order of group confounds summary."""
+        connectome_file = os.path.join(self.fmridenoise_dir, 'sub-01', 'sub-01_task-rest_pipeline-Null_connMat.npz')
+        open(connectome_file, 'w').close()
+        paths = rebuild_connectivity(self.fmridenoise_dir)
+        self.assertIn(connectome_file, paths)
+        expected = sym_matrix_to_vec(correlation_matrices(self.time_series.astype(np.float64)))
+        assert_array_almost_equal(expected[1], load_connectome(connectome_file).edges)
+        group_corr_vec = load_group_connectome(
+            os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupCorrMat.npy'))
+        assert_array_almost_equal(expected, group_corr_vec)
+
+    def test_missing_time_series(self):
+        os.remove(os.path.join(self.fmridenoise_dir, 'sub-02', 'sub-02_task-rest_pipeline-Null_timeseries.npy'))
+        with self.assertRaises(ValueError):
+            rebuild_connectivity(self.fmridenoise_dir)
+
+
+class TestRerunQualityMeasures(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.fmridenoise_dir = os.path.join(self.temp_dir.name, 'derivatives', 'fmridenoise')
+        rng = np.random.RandomState(0)
+        self.subjects = [f'{i:02d}' for i in range(1, 13)]
+        corr_mats = np.tanh(rng.randn(len(self.subjects), 200, 200))
+        self.corr_mats = (corr_mats + corr_mats.transpose(0, 2, 1)) / 2
+        for subject, corr_mat, include in zip(self.subjects, self.corr_mats, [True, True, False] * 4):
+            subject_dir = os.path.join(self.fmridenoise_dir, f'sub-{subject}')
+            os.makedirs(subject_dir)
+            with open(os.path.join(subject_dir, f'sub-{subject}_task-rest_pipeline-Null_desc-confounds_summary.json'),
+                      'w') as f:
+                # excluded subjects exceed mean framewise displacement threshold of spikes_pipeline
+                json.dump({'subject': subject, 'task': 'rest', 'mean_fd': rng.gamma(2, 0.1) + (not include),
+                           'max_fd': rng.rand(), 'n_conf': 0, 'include': include}, f)
+            save_connectome(os.path.join(subject_dir, f'sub-{subject}_task-rest_pipeline-Null_connMat.npz'),
+                            corr_mat, 'atlas-test')
+        self.pipeline = load_pipeline_from_json(get_pipeline_path('pipeline-Null'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def spikes_pipeline(fd_th: float) -> dict:
+        """Pipeline with motion criteria named as pipeline of derivatives."""
+        pipeline = load_pipeline_from_json(get_pipeline_path('pipeline-24HMP_8Phys_SpikeReg'))
+        pipeline['name'] = 'Null'
+        pipeline['spikes']['fd_th'] = fd_th
+        return pipeline
+
+    def test_rerun(self):
+        """Expect group outputs and report created from subjects derivatives."""
+        paths = rerun_quality_measures(self.fmridenoise_dir, [self.pipeline])
+        group_corr_file = os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupCorrMat.npy')
+        summary_file = os.path.join(self.fmridenoise_dir, 'task-rest_pipelinesFcFdSummary.tsv')
+        self.assertIn(group_corr_file, paths)
+        self.assertIn(summary_file, paths)
+        assert_array_almost_equal(sym_matrix_to_vec(self.corr_mats), load_group_connectome(group_corr_file))
+        conf_summary = pd.read_csv(os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupConfSummary.tsv'),
+                                   sep='\t', dtype={'subject': str})
+        self.assertEqual(self.subjects, list(conf_summary['subject']))
+        summary = pd.read_csv(summary_file, sep='\t')
+        self.assertEqual([12, 12], list(summary['n_subjects']))
+        self.assertTrue(os.path.exists(os.path.join(self.fmridenoise_dir, 'report', 'fMRIdenoise_report.html')))
+
+    def test_rerun_skipped_excluded(self):
+        """Expect quality measures of subjects without high motion only if
+        connectomes of excluded subjects were not saved."""
+        for subject in self.subjects[2::3]:
+            os.remove(os.path.join(self.fmridenoise_dir, f'sub-{subject}',
+                                   f'sub-{subject}_task-rest_pipeline-Null_connMat.npz'))
+        rerun_quality_measures(self.fmridenoise_dir, [self.spikes_pipeline(0.9)])
+        group_corr_vec = load_group_connectome(
+            os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupCorrMat.npy'))
+        included = [i for i in range(len(self.subjects)) if i % 3 != 2]
+        assert_array_almost_equal(sym_matrix_to_vec(self.corr_mats[included]), group_corr_vec)
+        summary = pd.read_csv(os.path.join(self.fmridenoise_dir, 'task-rest_pipelinesFcFdSummary.tsv'), sep='\t')
+        self.assertEqual([False], list(summary['all']))
+        self.assertEqual([12], list(summary['n_subjects']))
+        self.assertEqual([4], list(summary['n_excluded']))
+        # plots of all subjects are not created
+        self.assertFalse(os.path.exists(os.path.join(self.fmridenoise_dir, 'task-rest_desc-fcFdPearson_plot.svg')))
+        self.assertTrue(os.path.exists(os.path.join(self.fmridenoise_dir,
+                                                    'task-rest_desc-fcFdPearsonNoHighMotion_plot.svg')))
+        self.assertTrue(os.path.exists(os.path.join(self.fmridenoise_dir, 'report', 'fMRIdenoise_report.html')))
+
+    def test_missing_included(self):
+        os.remove(os.path.join(self.fmridenoise_dir, 'sub-01', 'sub-01_task-rest_pipeline-Null_connMat.npz'))
+        with self.assertRaises(ValueError):
+            rerun_quality_measures(self.fmridenoise_dir, [self.spikes_pipeline(0.9)])
+
+    def test_changed_threshold(self):
+        """Expect subjects excluded by changed mean framewise displacement
+        threshold of pipeline, not by inclusion saved in summaries."""
+        mean_fd = {}
+        for subject in self.subjects:
+            summary_file = os.path.join(self.fmridenoise_dir, f'sub-{subject}',
+                                        f'sub-{subject}_task-rest_pipeline-Null_desc-confounds_summary.json')
+            with open(summary_file) as f:
+                summary = json.load(f)
+            summary.update(n_spikes=1, perc_spikes=100 / 60)
+            mean_fd[subject] = summary['mean_fd']
+            with open(summary_file, 'w') as f:
+                json.dump(summary, f)
+        pipeline = self.spikes_pipeline(float(np.median(list(mean_fd.values()))))
+        rerun_quality_measures(self.fmridenoise_dir, [pipeline])
+        conf_summary = pd.read_csv(os.path.join(self.fmridenoise_dir, 'task-rest_pipeline-Null_groupConfSummary.tsv'),
+                                   sep='\t', dtype={'subject': str})
+        expected = [mean_fd[subject] <= pipeline['spikes']['fd_th'] for subject in conf_summary['subject']]
+        self.assertEqual(expected, list(conf_summary['include']))
+        self.assertEqual(6, sum(expected))
+        self.assertNotEqual([True, True, False] * 4, expected)
+        with open(os.path.join(self.fmridenoise_dir, 'sub-01',
+                               'sub-01_task-rest_pipeline-Null_desc-confounds_summary.json')) as f:
+            self.assertEqual(mean_fd['01'] <= pipeline['spikes']['fd_th'], json.load(f)['include'])
+
+    def test_unknown_pipeline(self):
+        with self.assertRaises(ValueError):
+            rerun_quality_measures(self.fmridenoise_dir, [])
@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from nilearn.connectome import vec_to_sym_matrix
+from numpy.testing import assert_array_almost_equal
+
+from fmridenoise.interfaces.quality_measures import QualityMeasures
+from fmridenoise.utils.connectome import save_connectome
+from fmridenoise.utils.group_statistics import RunningStatistics, GroupStatistics
+from fmridenoise.workflows.update import group_statistics_summary, update_group_statistics
+from tests.utils import GroupStatisticsTestBase
+
+
+class TestGroupStatisticsSummary(GroupStatisticsTestBase):
+
+    def test_summary_same_as_quality_measures(self):
+        statistics = GroupStatistics.from_subjects(self.conf_summary[:4], self.group_corr_vec[:4]).merge(
+            GroupStatistics.from_subjects(self.conf_summary[4:], self.group_corr_vec[4:]))
+        summaries = group_statistics_summary(statistics, self.distance_ranks.normalized_ranks)
+        for all_subjects, summary in zip((True, False), summaries):
+            expected, *_ = QualityMeasures._quality_measure(self.conf_summary, self.distance_ranks.normalized_ranks,
+                                                            self.group_corr_vec, all_subjects)
+            self.assertEqual(expected.keys(), summary.keys())
+            for key, value in expected.items():
+                self.assertAlmostEqual(value, summary[key], msg=key)
+
+
+class TestUpdateGroupStatistics(GroupStatisticsTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.state_dir = os.path.join(self.temp_dir.name, 'state')
+        self.distance_matrix_file = os.path.join(self.temp_dir.name, 'distance_matrix.npy')
+        np.save(self.distance_matrix_file, self.distance_matrix)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_fmridenoise_dir(self, name: str, subjects: slice, legacy: bool = False) -> str:
+        fmridenoise_dir = os.path.join(self.temp_dir.name, name, 'derivatives', 'fmridenoise')
+        os.makedirs(fmridenoise_dir)
+        # connectivity of other atlas, with subjects in reversed order, expected to be ignored by default
+        for subject, corr_vec in zip(self.conf_summary['subject'][subjects], self.group_corr_vec[subjects][::-1]):
+            os.makedirs(os.path.join(fmridenoise_dir, f'sub-{subject}'))
+            save_connectome(os.path.join(fmridenoise_dir, f'sub-{subject}',
+                                         f'sub-{subject}_task-rest_atlas-Other_pipeline-Null_connMat.npz'),
+                            vec_to_sym_matrix(corr_vec), 'atlas-Other')
+        conf_summary = self.conf_summary[subjects]
+        conf_summary.to_csv(os.path.join(fmridenoise_dir, 'task-rest_pipeline-Null_groupConfSummary.tsv'),
+                            sep='\t', index=False)
+        for subject, corr_vec in zip(conf_summary['subject'], self.group_corr_vec[subjects]):
+            path = os.path.join(fmridenoise_dir, f'sub-{subject}', f'sub-{subject}_task-rest_pipeline-Null_connMat')
+            if legacy:
+                np.save(f'{path}.npy', vec_to_sym_matrix(corr_vec))
+            else:
+                save_connectome(f'{path}.npz', vec_to_sym_matrix(corr_vec), 'atlas-test')
+        return fmridenoise_dir
+
+    def test_update(self):
+        """Expect subjects merged from consecutive outputs (and already merged
+        subjects skipped), connectivity matrices of previous versions read."""
+        first = self.make_fmridenoise_dir('first', slice(0, 8))
+        second = self.make_fmridenoise_dir('second', slice(5, 12), legacy=True)
+        update_group_statistics(self.state_dir, [first], distance_matrix_file=self.distance_matrix_file)
+        paths = update_group_statistics(self.state_dir, [second, first],
+                                        distance_matrix_file=self.distance_matrix_file)
+        state = GroupStatistics.load(os.path.join(self.state_dir, 'task-rest_pipeline-Null_groupStats.npz'))
+        self.assertEqual(list(self.conf_summary['subject']), state.subjects)
+        expected = RunningStatistics.from_subjects(self.group_corr_vec, self.conf_summary['mean_fd'].values)
+        assert_array_almost_equal(expected.comoment, state.all_subjects.comoment)
+        summary = pd.read_csv(paths[0], sep='\t')
+        self.assertEqual([12, 12], list(summary['n_subjects']))
+        self.assertEqual(['Null', 'Null'], list(summary['pipeline']))
+        expected, *_ = QualityMeasures._quality_measure(self.conf_summary, self.distance_ranks.normalized_ranks,
+                                                        self.group_corr_vec, True)
+        self.assertAlmostEqual(expected['distance_dependence'], summary['distance_dependence'][0])
+
+    def test_update_atlas(self):
+        """Expect connectivity matrices and states of given atlas used, states
+        of default atlas left untouched."""
+        fmridenoise_dir = self.make_fmridenoise_dir('first', slice(0, 8))
+        update_group_statistics(self.state_dir, [fmridenoise_dir], distance_matrix_file=self.distance_matrix_file)
+        paths = update_group_statistics(self.state_dir, [fmridenoise_dir], atlas='/atlases/atlas-Other_dseg.nii.gz',
+                                        distance_matrix_file=self.distance_matrix_file)
+        self.assertEqual([os.path.join(self.state_dir, 'task-rest_atlas-Other_desc-cohort_pipelinesFcFdSummary.tsv')],
+                         paths[:1])
+        state = GroupStatistics.load(os.path.join(self.state_dir, 'task-rest_atlas-Other_pipeline-Null_groupStats.npz'))
+        expected = RunningStatistics.from_subjects(self.group_corr_vec[:8][::-1],
+                                                   self.conf_summary['mean_fd'].values[:8])
+        assert_array_almost_equal(expected.comoment, state.all_subjects.comoment)
+        state = GroupStatistics.load(os.path.join(self.state_dir, 'task-rest_pipeline-Null_groupStats.npz'))
+        expected = RunningStatistics.from_subjects(self.group_corr_vec[:8], self.conf_summary['mean_fd'].values[:8])
+        assert_array_almost_equal(expected.comoment, state.all_subjects.comoment)